@@ -1,6 +1,7 @@
 {
   buildPythonApplication,
   aggft-core,
+  numpy,
 }:
 buildPythonApplication {
   pname = "aggft-simulate";
@@ -9,5 +10,5 @@ buildPythonApplication {
   src = ../../src/simulate;
   doCheck = false;
 
-  propagatedBuildInputs = [aggft-core];
+  propagatedBuildInputs = [aggft-core numpy];
 }
@@ -4,7 +4,7 @@
   # example = pkgs.callPackage ./example { };
 
   aggft-simulate = pkgs.callPackage ./aggft-simulate {
-    inherit (pkgs.python3.pkgs) buildPythonApplication aggft-core;
+    inherit (pkgs.python3.pkgs) buildPythonApplication aggft-core numpy;
   };
 
   aggft-simulate-p = pkgs.callPackage ./aggft-simulate-p {};
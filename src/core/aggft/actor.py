@@ -0,0 +1,245 @@
+from dataclasses import dataclass
+from typing import Any, Generator, List, Sequence, Tuple
+
+from .health import LinkHealth
+from .metadata import Metadata
+from .metrics import NO_METRICS, QUEUE_DEPTH, Metrics
+from .network import Address, Message, NetworkManager
+from .participants import Participants
+from .report import ReportLog
+from . import crypto, time
+
+################################################################################
+# Blocking Operations
+################################################################################
+
+# DCs and SMs run their rounds as generators, that yield the blocking
+# operations below and are sent back their results. The round logic never
+# blocks itself, so the threaded and async classes share it, and only differ in
+# how they run the operations.
+
+
+# Returns the queue of incoming requests
+@dataclass(frozen=True)
+class Listen:
+    address: Address
+
+
+@dataclass(frozen=True)
+class Stop:
+    pass
+
+
+# Returns whether the message was delivered
+@dataclass(frozen=True)
+class Send:
+    address: Address
+    msg: Message
+    deadline: time.Time
+
+
+# Returns the index of the first reachable address, or -1
+@dataclass(frozen=True)
+class Probe:
+    addresses: Sequence[Address]
+    deadline: time.Time
+
+
+# Returns the next incoming request, or None if none arrived before the deadline
+@dataclass(frozen=True)
+class Get:
+    deadline: time.Time
+
+
+@dataclass(frozen=True)
+class SleepUntil:
+    time: time.Time
+
+
+Steps = Generator[Any, Any, Any]
+
+################################################################################
+# Runners
+################################################################################
+
+
+# Run `steps` of `actor` with blocking calls on its network manager and clock
+def run_steps(actor, steps: Steps):
+    result = None
+    while True:
+        try:
+            op = steps.send(result)
+        except StopIteration as e:
+            return e.value
+        result = _run(actor, op)
+
+
+def _run(actor, op):
+    if isinstance(op, Send):
+        return actor.net_mngr.send(op.address, op.msg, op.deadline)
+    if isinstance(op, Get):
+        return actor.clock.get(actor.req_q, op.deadline)
+    if isinstance(op, Probe):
+        return actor.net_mngr.probe(op.addresses, op.deadline)
+    if isinstance(op, SleepUntil):
+        return actor.clock.sleep_until(op.time)
+    if isinstance(op, Listen):
+        return actor.net_mngr.listen(op.address)
+    return actor.net_mngr.stop()
+
+
+# Run `steps` of `actor` as a coroutine, on its async network manager
+# Waits on the event loop, so the clock of the actor should run in real time.
+async def async_run_steps(actor, steps: Steps):
+    result = None
+    while True:
+        try:
+            op = steps.send(result)
+        except StopIteration as e:
+            return e.value
+        result = await _async_run(actor, op)
+
+
+async def _async_run(actor, op):
+    if isinstance(op, Send):
+        return await actor.net_mngr.send(op.address, op.msg, op.deadline)
+    if isinstance(op, Get):
+        return await time.async_get(actor.req_q, op.deadline, actor.clock)
+    if isinstance(op, Probe):
+        return await actor.net_mngr.probe(op.addresses, op.deadline)
+    if isinstance(op, SleepUntil):
+        return await time.async_sleep_until(op.time, actor.clock)
+    if isinstance(op, Listen):
+        return await actor.net_mngr.listen(op.address)
+    return await actor.net_mngr.stop()
+
+
+################################################################################
+# Shared Logic
+################################################################################
+
+
+# Round timing, next hops, and report bookkeeping of DCs and SMs
+class Actor:
+    def __init__(
+        self,
+        meta: Metadata,
+        net_mngr: NetworkManager,
+        *,
+        clock: time.Clock = time.REAL_CLOCK,
+        health: LinkHealth | None = None,
+        probe_width: int = 1,
+        reports: ReportLog | None = None,
+        metrics: Metrics = NO_METRICS,
+    ):
+        self.meta = meta
+        self.net_mngr = net_mngr
+        self.clock = clock
+        # Link failures of past rounds, to pick the SMs to send to with
+        # Without one, SMs are tried in ID order.
+        self.health = health
+        # Number of next SMs to probe at once before sending to them
+        # A run of unreachable SMs then costs one timeout instead of one each.
+        self.probe_width = probe_width
+        # Reports of the recent rounds
+        self.reports = ReportLog() if reports is None else reports
+        # Histograms of round timings, see the metrics module
+        self.metrics = metrics
+        self.req_q = None
+
+    # NOTE: Override these to run background work while the DC or SM runs
+    def _on_start(self):
+        pass
+
+    def _on_stop(self):
+        pass
+
+    def _round_start(self, round: int) -> time.Time:
+        return self.meta.t_start + self.meta.t_round_len * round
+
+    def _phase_1_end(self, round: int) -> time.Time:
+        return self._round_start(round) + self.meta.t_phase_1_len
+
+    def _phase_2_end(self, round: int) -> time.Time:
+        return self._round_start(round) + self.meta.t_round_len
+
+    def _record_rcv(self, round: int, msg: Message):
+        self.reports[round].net_rcv += 1
+        self.reports[round].net_rcv_size += msg.size
+        self.net_mngr.received(msg)
+        self.metrics.observe(QUEUE_DEPTH, self.req_q.qsize())
+
+    def _record_snd(self, round: int, msg: Message, ok: bool):
+        if ok:
+            self.reports[round].net_snd_succ += 1
+            self.reports[round].net_snd_succ_size += msg.size
+        else:
+            self.reports[round].net_snd_fail += 1
+            self.reports[round].net_snd_fail_size += msg.size
+
+    # Next SM to activate, and the suspect SMs passed over for it
+    def _next_hop(self, round: int, l_rem: Participants) -> Tuple[int, Participants]:
+        if self.health is None:
+            return l_rem.first(), Participants()
+        return self.health.choose(l_rem, round)
+
+    # Passed over SMs stay in l_rem, so only count them once we moved on
+    def _record_hop(self, round: int, sm_id: int, ok: bool, passed: Participants):
+        if self.health is None:
+            return
+        self.health.record(sm_id, ok, round)
+        if ok:
+            self.reports[round].net_snd_skip += len(passed)
+
+    # Next SMs to try, in order, and at most probe_width of them
+    def _next_hops(self, round: int, l_rem: Participants) -> List[int]:
+        hops = []
+        while l_rem and len(hops) < self.probe_width:
+            sm_id, _ = self._next_hop(round, l_rem)
+            hops.append(sm_id)
+            l_rem = l_rem.remove(sm_id)
+        return hops
+
+    # `first` is the index of the first reachable SM in `hops`, or -1
+    # Returns the probed SMs, and the unreachable ones among them.
+    def _record_probe(
+        self,
+        round: int,
+        hops: List[int],
+        first: int,
+        probed: Participants,
+        down: Participants,
+    ) -> Tuple[Participants, Participants]:
+        # SMs after the first reachable one may not have been checked
+        decided = hops if first == -1 else hops[: first + 1]
+        for i, sm_id in enumerate(decided):
+            probed = probed.add(sm_id)
+            # We don't send to invalid addresses anyway
+            if not self.meta.sm_addresses[sm_id].valid:
+                continue
+            self.reports[round].net_probe += 1
+            if i != first:
+                self.reports[round].net_probe_fail += 1
+                down = down.add(sm_id)
+                if self.health is not None:
+                    self.health.record(sm_id, False, round)
+        return probed, down
+
+
+# Precomputed obfuscators of homomorphic DCs and SMs
+# They keep encryption off the phase 2 hot path. A pool passed by the caller is
+# managed by the caller.
+class Obfuscating:
+    def _use_obfuscators(
+        self, pk: crypto.HomomorphicPublicKey, obfuscators: crypto.ObfuscatorPool | None
+    ):
+        self.own_obfuscators = obfuscators is None
+        self.obfuscators = obfuscators or crypto.ObfuscatorPool(pk)
+
+    def _on_start(self):
+        if self.own_obfuscators:
+            self.obfuscators.start()
+
+    def _on_stop(self):
+        if self.own_obfuscators:
+            self.obfuscators.stop()
@@ -0,0 +1,222 @@
+import json
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import Any, Dict, Tuple
+
+################################################################################
+# Types
+################################################################################
+
+Payload = Dict[str, Any]
+
+
+class CODEC(Enum):
+    JSON = 0
+    BINARY = 1
+
+
+################################################################################
+# Abstract Codec
+################################################################################
+
+# Codecs turn message payloads into bytes and back.
+# Payloads are dicts of ints, strings, lists, dicts, booleans and None.
+# Implement the Codec abstract class for new wire formats.
+
+
+class Codec(ABC):
+    @abstractmethod
+    def encode(self, data: Payload) -> bytes:
+        pass
+
+    # Raises ValueError if the bytes are malformed.
+    @abstractmethod
+    def decode(self, encoded: bytes) -> Payload:
+        pass
+
+    # Whether the bytes look like they were made by this codec
+    @abstractmethod
+    def sniff(self, encoded: bytes) -> bool:
+        pass
+
+
+################################################################################
+# JSON Codec
+################################################################################
+
+
+class JSONCodec(Codec):
+    def encode(self, data: Payload) -> bytes:
+        return json.dumps(data).encode()
+
+    def decode(self, encoded: bytes) -> Payload:
+        return json.loads(encoded)
+
+    def sniff(self, encoded: bytes) -> bool:
+        return encoded[:1] == b"{"
+
+
+################################################################################
+# Binary Codec
+################################################################################
+
+# Compact binary format.
+# A magic byte, followed by the payload as a tagged value:
+#   int    : tag, length (varint), magnitude (length bytes, big-endian)
+#   str    : tag, length (varint), UTF-8 bytes
+#   list   : tag, count (varint), values
+#   dict   : tag, count (varint), (key as untagged str, value) pairs
+#   others : tag
+#
+# Integers of any size (e.g. ciphertexts, masked values) take their raw byte
+# size, instead of one byte per decimal digit like in JSON.
+
+_MAGIC = b"\x00"
+
+_INT = 1
+_NEG_INT = 2
+_STR = 3
+_LIST = 4
+_DICT = 5
+_NONE = 6
+_TRUE = 7
+_FALSE = 8
+
+
+class BinaryCodec(Codec):
+    def encode(self, data: Payload) -> bytes:
+        out = bytearray(_MAGIC)
+        _write_value(out, data)
+        return bytes(out)
+
+    def decode(self, encoded: bytes) -> Payload:
+        if not self.sniff(encoded):
+            raise ValueError("Not a binary message.")
+        try:
+            data, pos = _read_value(encoded, len(_MAGIC))
+        except IndexError:
+            raise ValueError("Truncated message.")
+        if pos != len(encoded) or not isinstance(data, dict):
+            raise ValueError("Malformed message.")
+        return data
+
+    def sniff(self, encoded: bytes) -> bool:
+        return encoded[: len(_MAGIC)] == _MAGIC
+
+
+def _write_uint(out: bytearray, x: int):
+    # LEB128
+    while x >= 0x80:
+        out.append((x & 0x7F) | 0x80)
+        x >>= 7
+    out.append(x)
+
+
+def _read_uint(buf: bytes, pos: int) -> Tuple[int, int]:
+    x = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        x |= (b & 0x7F) << shift
+        if b < 0x80:
+            return x, pos
+        shift += 7
+
+
+def _write_bytes(out: bytearray, b: bytes):
+    _write_uint(out, len(b))
+    out += b
+
+
+def _read_bytes(buf: bytes, pos: int) -> Tuple[bytes, int]:
+    length, pos = _read_uint(buf, pos)
+    if pos + length > len(buf):
+        raise ValueError("Truncated message.")
+    return buf[pos : pos + length], pos + length
+
+
+def _write_value(out: bytearray, v: Any):
+    # NOTE: bool is a subclass of int, so check it first
+    if v is None:
+        out.append(_NONE)
+    elif v is True:
+        out.append(_TRUE)
+    elif v is False:
+        out.append(_FALSE)
+    elif isinstance(v, int):
+        out.append(_INT if v >= 0 else _NEG_INT)
+        v = abs(v)
+        _write_bytes(out, v.to_bytes((v.bit_length() + 7) // 8, "big"))
+    elif isinstance(v, str):
+        out.append(_STR)
+        _write_bytes(out, v.encode())
+    elif isinstance(v, (list, tuple)):
+        out.append(_LIST)
+        _write_uint(out, len(v))
+        for i in v:
+            _write_value(out, i)
+    elif isinstance(v, dict):
+        out.append(_DICT)
+        _write_uint(out, len(v))
+        for key, i in v.items():
+            _write_bytes(out, key.encode())
+            _write_value(out, i)
+    else:
+        raise TypeError(f"Can't encode {type(v).__name__}.")
+
+
+def _read_value(buf: bytes, pos: int) -> Tuple[Any, int]:
+    tag = buf[pos]
+    pos += 1
+    if tag == _NONE:
+        return None, pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _INT or tag == _NEG_INT:
+        b, pos = _read_bytes(buf, pos)
+        v = int.from_bytes(b, "big")
+        return (v if tag == _INT else -v), pos
+    if tag == _STR:
+        b, pos = _read_bytes(buf, pos)
+        return b.decode(), pos
+    if tag == _LIST:
+        count, pos = _read_uint(buf, pos)
+        lst = []
+        for _ in range(count):
+            v, pos = _read_value(buf, pos)
+            lst.append(v)
+        return lst, pos
+    if tag == _DICT:
+        count, pos = _read_uint(buf, pos)
+        dct = {}
+        for _ in range(count):
+            key, pos = _read_bytes(buf, pos)
+            dct[key.decode()], pos = _read_value(buf, pos)
+        return dct, pos
+    raise ValueError(f"Unknown tag {tag}.")
+
+
+################################################################################
+# Functions
+################################################################################
+
+CODECS: Dict[CODEC, Codec] = {
+    CODEC.JSON: JSONCodec(),
+    CODEC.BINARY: BinaryCodec(),
+}
+
+
+def encode_payload(data: Payload, codec: CODEC = CODEC.JSON) -> bytes:
+    return CODECS[codec].encode(data)
+
+
+# Decode bytes made by any codec.
+# Raises ValueError if they are malformed.
+def decode_payload(encoded: bytes) -> Payload:
+    for codec in CODECS.values():
+        if codec.sniff(encoded):
+            return codec.decode(encoded)
+    raise ValueError("Unknown message codec.")
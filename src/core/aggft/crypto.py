@@ -1,15 +1,26 @@
 import secrets
+import threading
 
-from typing import Tuple
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Callable, Deque, Iterable, Sequence, Tuple
 
 import pyaes
 
+# Optional fast AES backend
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+from phe.encoding import EncodedNumber
 from phe.paillier import (
     generate_paillier_keypair,
     PaillierPrivateKey,
     PaillierPublicKey,
     EncryptedNumber,
 )
+from phe.util import mulmod, powmod
 
 ################################################################################
 # PRF Types
@@ -28,9 +39,101 @@ def generate_prf_key(length: int) -> PRFKey:
 
 # Use AES with CTR mode as a PRF
 def prf(key: PRFKey, input: int) -> int:
-    aes = pyaes.AESModeOfOperationCTR(key)
-    ctx = aes.encrypt(f"{input}")
-    return int.from_bytes(ctx, byteorder="little")
+    return prf_engine.prf(key, input)
+
+
+# Compute the PRF of many keys for the same input
+def prf_many(keys: Iterable[PRFKey], input: int) -> Tuple[int, ...]:
+    return prf_engine.prf_many(keys, input)
+
+
+################################################################################
+# PRF Engine
+################################################################################
+
+# Maximum number of key-scheduled ciphers kept by the default PRF engine
+DEFAULT_PRF_CACHE_SIZE = 1024
+
+
+# AES-CTR PRF that keeps a key-scheduled cipher per key.
+# The AES key schedule dominates the cost of a pure Python PRF call, so ciphers
+# are cached, least recently used first out, instead of rebuilt on every call.
+# Produces the same values as encrypting the decimal input with
+# `pyaes.AESModeOfOperationCTR` and its default counter.
+class PRFEngine:
+    def __init__(self, max_keys: int = DEFAULT_PRF_CACHE_SIZE):
+        if max_keys < 1:
+            raise ValueError("PRF engine should cache at least one key.")
+        self.max_keys = max_keys
+        self._ciphers: OrderedDict[PRFKey, Callable[[bytes], bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prf(self, key: PRFKey, input: int) -> int:
+        return self.prf_many((key,), input)[0]
+
+    def prf_many(self, keys: Iterable[PRFKey], input: int) -> Tuple[int, ...]:
+        # The plaintext and counter blocks only depend on the input
+        plaintext = f"{input}".encode()
+        blocks = _ctr_blocks(len(plaintext))
+        plain = int.from_bytes(plaintext, byteorder="little")
+        return tuple(
+            plain
+            ^ int.from_bytes(
+                self._cipher(key)(blocks)[: len(plaintext)], byteorder="little"
+            )
+            for key in keys
+        )
+
+    def _cipher(self, key: PRFKey) -> Callable[[bytes], bytes]:
+        with self._lock:
+            cipher = self._ciphers.get(key)
+            if cipher is not None:
+                self._ciphers.move_to_end(key)
+                return cipher
+
+        cipher = _make_ecb_cipher(key)
+
+        with self._lock:
+            self._ciphers[key] = cipher
+            while len(self._ciphers) > self.max_keys:
+                self._ciphers.popitem(last=False)
+        return cipher
+
+
+# Counter blocks covering `length` bytes of keystream
+# The counter starts at 1, like the default `pyaes.Counter`.
+def _ctr_blocks(length: int) -> bytes:
+    count = (length + 15) // 16
+    return b"".join(i.to_bytes(16, byteorder="big") for i in range(1, count + 1))
+
+
+# Key-scheduled AES block encryption of whole blocks
+# Uses the `cryptography` package when it is installed, and pyaes otherwise.
+def _make_ecb_cipher(key: PRFKey) -> Callable[[bytes], bytes]:
+    if Cipher is not None:
+        # ECB keeps no state across whole blocks, so one encryption context
+        # serves every call. Contexts aren't thread-safe, hence the lock.
+        encryptor = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+        lock = threading.Lock()
+
+        def encrypt_fast(blocks: bytes) -> bytes:
+            with lock:
+                return encryptor.update(blocks)
+
+        return encrypt_fast
+
+    aes = pyaes.AES(key)
+
+    def encrypt(blocks: bytes) -> bytes:
+        return b"".join(
+            bytes(aes.encrypt(list(blocks[i : i + 16])))
+            for i in range(0, len(blocks), 16)
+        )
+
+    return encrypt
+
+
+prf_engine = PRFEngine()
 
 
 ################################################################################
@@ -53,11 +156,148 @@ def generate_homomorphic_keypair(
     return sk, pk
 
 
-def serialize_homomorphic_number(m: HomomorphicNumber) -> Tuple[str, str]:
-    return (str(m.ciphertext()), str(m.exponent))
+# NOTE:
+# Set `be_secure` to False only if `m` is already obfuscated, e.g. it was
+# encrypted with an obfuscator pool or includes a term that was.
+# Otherwise, the ciphertext is obfuscated before serialization.
+# Numbers are serialized as decimal strings, as JSON can't carry big integers.
+# Codecs that can (e.g. the binary codec) should use `as_int`.
+def serialize_homomorphic_number(
+    m: HomomorphicNumber, be_secure: bool = True, as_int: bool = False
+) -> Tuple[str, str] | Tuple[int, int]:
+    if as_int:
+        return (m.ciphertext(be_secure), m.exponent)
+    return (str(m.ciphertext(be_secure)), str(m.exponent))
 
 
 def deserialize_homomorphic_number(
-    m: Tuple[str, str], pk: HomomorphicPublicKey
+    m: Tuple[str, str] | Tuple[int, int], pk: HomomorphicPublicKey
 ) -> HomomorphicNumber:
     return HomomorphicNumber(pk, int(m[0]), int(m[1]))
+
+
+################################################################################
+# Homomorphic Encryption Obfuscator Pool
+################################################################################
+
+# Default number of precomputed obfuscators kept by a pool
+DEFAULT_OBFUSCATOR_POOL_SIZE = 16
+
+
+# Pool of precomputed Paillier obfuscators (r^n mod n^2 for a random r < n).
+# Computing an obfuscator is a full modular exponentiation, which dominates the
+# cost of an encryption. With a filled pool, an encryption on the hot path only
+# costs one modular multiplication.
+#
+# Fill the pool synchronously with `fill`, or start a background thread that
+# refills it whenever obfuscators are taken with `start`.
+# If the pool is empty, obfuscators are computed on demand.
+class ObfuscatorPool:
+    def __init__(
+        self, pk: HomomorphicPublicKey, size: int = DEFAULT_OBFUSCATOR_POOL_SIZE
+    ):
+        if size < 1:
+            raise ValueError("Obfuscator pool should hold at least one obfuscator.")
+        self.pk = pk
+        self.size = size
+        self._obfuscators: Deque[int] = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    # Top up the pool in the calling thread
+    def fill(self):
+        while len(self._obfuscators) < self.size:
+            self._obfuscators.append(self._compute())
+
+    # Start the refill thread
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._refill, daemon=True)
+        self._thread.start()
+
+    # Stop the refill thread
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def take(self) -> int:
+        try:
+            obfuscator = self._obfuscators.popleft()
+        except IndexError:
+            obfuscator = self._compute()
+        with self._cond:
+            self._cond.notify_all()
+        return obfuscator
+
+    # Same as `pk.encrypt(value)`, but uses a precomputed obfuscator
+    def encrypt(self, value) -> HomomorphicNumber:
+        encoding = EncodedNumber.encode(self.pk, value)
+        # An obfuscator of 1 makes the raw encryption deterministic and cheap
+        nude = self.pk.raw_encrypt(encoding.encoding, r_value=1)
+        ciphertext = mulmod(nude, self.take(), self.pk.nsquare)
+        return HomomorphicNumber(self.pk, ciphertext, encoding.exponent)
+
+    def _refill(self):
+        while True:
+            with self._cond:
+                while self._running and len(self._obfuscators) >= self.size:
+                    self._cond.wait()
+                if not self._running:
+                    return
+            # Compute outside the lock, so takers never wait on an exponentiation
+            self._obfuscators.append(self._compute())
+
+    def _compute(self) -> int:
+        r = self.pk.get_random_lt_n()
+        return powmod(r, self.pk.n, self.pk.nsquare)
+
+
+################################################################################
+# Homomorphic Encryption Slot Packing
+################################################################################
+
+
+# Packs a vector of readings into one plaintext, so one encryption and one
+# decryption carry all of them.
+# Each reading takes a slot of its own. A slot holds readings of up to `bits`
+# bits, plus enough headroom bits for the sum of `n` of them, so the slots of a
+# sum never carry into each other.
+@dataclass(frozen=True)
+class SlotPacking:
+    # Number of readings per plaintext
+    slots: int
+
+    # Readings should be in [0, 2 ** bits)
+    bits: int
+
+    # Maximum number of summands, e.g. the number of SMs
+    n: int
+
+    # Bits of one slot, with headroom
+    @property
+    def slot_bits(self) -> int:
+        return self.bits + (self.n - 1).bit_length()
+
+    # Whether sums of `n` packed vectors can be encrypted with `pk`
+    def fits(self, pk: HomomorphicPublicKey) -> bool:
+        return (1 << (self.slots * self.slot_bits)) - 1 <= pk.max_int
+
+    def pack(self, readings: Sequence[int]) -> int:
+        if len(readings) != self.slots:
+            raise ValueError(f"Expected {self.slots} readings, got {len(readings)}.")
+        m = 0
+        for reading in reversed(readings):
+            if not 0 <= reading < 1 << self.bits:
+                raise ValueError(f"Reading {reading} doesn't fit in {self.bits} bits.")
+            m = (m << self.slot_bits) | reading
+        return m
+
+    # The slot sums of a sum of packed vectors
+    def unpack(self, m: int) -> Tuple[int, ...]:
+        mask = (1 << self.slot_bits) - 1
+        return tuple(m >> (i * self.slot_bits) & mask for i in range(self.slots))
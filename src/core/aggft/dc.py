@@ -1,10 +1,21 @@
-import json
+import itertools
 import secrets
 from abc import ABC, abstractmethod
-from time import sleep
-from time import time as now
-from typing import Dict, Tuple
-
+from typing import Dict, List
+
+from .actor import (
+    Actor,
+    Get,
+    Listen,
+    Obfuscating,
+    Probe,
+    Send,
+    SleepUntil,
+    Steps,
+    Stop,
+    async_run_steps,
+    run_steps,
+)
 from .metadata import (
     DCMaskingMetadata,
     DCHomomorphicMetadata,
@@ -12,8 +23,18 @@ from .metadata import (
     is_valid_dc_masking_metadata,
     is_valid_dc_homomorphic_metadata,
 )
-from .report import DCReport
-from .network import NetworkManager
+from .codec import CODEC
+from .health import LinkHealth
+from .metrics import CRYPTO, NO_METRICS, PHASE_1_ARRIVAL, Metrics
+from .report import DCReport, ReportLog
+from .network import (
+    AsyncNetworkManager,
+    Message,
+    NetworkManager,
+    decode_ids,
+    encode_ids,
+)
+from .participants import Participants
 from . import crypto, time
 
 ################################################################################
@@ -26,90 +47,129 @@ from . import crypto, time
 
 # Generic DC
 # Abstract Class - Use concrete implemententations
-class DC(ABC):
-    def __init__(self, meta: Metadata, net_mngr: NetworkManager):
-        self.meta = meta
-        self.net_mngr = net_mngr
-        self.reports = []
+class DC(Actor, ABC):
+    def __init__(
+        self,
+        meta: Metadata,
+        net_mngr: NetworkManager,
+        *,
+        clock: time.Clock = time.REAL_CLOCK,
+        health: LinkHealth | None = None,
+        probe_width: int = 1,
+        reports: ReportLog | None = None,
+        metrics: Metrics = NO_METRICS,
+    ):
+        super().__init__(
+            meta,
+            net_mngr,
+            clock=clock,
+            health=health,
+            probe_width=probe_width,
+            reports=reports,
+            metrics=metrics,
+        )
 
     def run_forever(self):
-        self._listen()
-
-        # Wait for the right time to start operation
-        sleep(time.remaining_until(self.meta.t_start))
-
-        round = 0
-        while True:
-            self._run_single_round(round)
-            round += 1
+        run_steps(self, self._run(None))
 
     def run_once(self):
-        self._listen()
+        self.run_rounds(1)
 
-        # Wait for the right time to start operation
-        sleep(time.remaining_until(self.meta.t_start))
+    def run_rounds(self, count: int):
+        run_steps(self, self._run(count))
 
-        self._run_single_round(0)
+    # Runs `count` rounds, or rounds forever if `count` is None
+    def _run(self, count: int | None) -> Steps:
+        # Start listening to incoming requests
+        self.req_q = yield Listen(self.meta.dc_address)
+        self._on_start()
 
-        self._stop()
+        # Wait for the right time to start operation
+        yield SleepUntil(self.meta.t_start)
 
-    def _listen(self):
-        # Start listening to incoming requests
-        self.req_q = self.net_mngr.listen(self.meta.dc_address)
+        for round in itertools.count() if count is None else range(count):
+            yield from self._run_single_round(round)
 
-    def _stop(self):
         # Stop listening to incoming requests
-        self.net_mngr.stop()
+        yield Stop()
+        self._on_stop()
+
+    def _run_single_round(self, round: int) -> Steps:
+        # Use the idle time before the round for preparations
+        self._prepare_round(round)
 
-    def _run_single_round(self, round: int):
         # Wait for the right time to start round
-        round_start = self.meta.t_start + self.meta.t_round_len * round
-        sleep(time.remaining_until(round_start))
+        yield SleepUntil(self._round_start(round))
 
-        self.reports.append(DCReport(t_start=now()))
+        self._start_round(round)
 
-        data, l_rem = self._run_phase_1(round)
-        self.reports[round].phase_1_count = len(l_rem)
-        self.reports[round].phase_1_sms = l_rem
-        self.reports[round].t_phase_1 = now()
-        if len(l_rem) < self.meta.n_min:
-            self.reports[round].terminated = True
-            self.reports[round].t_end = now()
+        data, l_rem = yield from self._run_phase_1(round)
+        if not self._end_phase_1(round, l_rem):
+            self._end_round(round)
             return
 
-        s_initial = self._generate_s_initial()
-        activated = self._activate_first_sm(round, s_initial, l_rem)
+        chains = self._split_chains(l_rem)
+        s_initials = {}
+        activated = {}
+        for chain, members in enumerate(chains):
+            s_initials[chain] = self._generate_s_initial()
+            tag = chain if len(chains) > 1 else None
+            ok = yield from self._activate_first_sm(
+                round, s_initials[chain], members, tag
+            )
+            if ok:
+                activated[chain] = members
         if not activated:
-            self.reports[round].terminated = True
-            self.reports[round].t_end = now()
+            self._end_round(round)
             return
-        self._run_phase_2(round, data, s_initial)
+        yield from self._run_phase_2(round, data, s_initials, activated)
+        self._end_round(round)
+
+    # NOTE: Override this to precompute round data before the round starts
+    def _prepare_round(self, round: int):
+        pass
+
+    def _start_round(self, round: int):
+        self.reports.append(DCReport(t_start=self.clock.now()))
+
+    # Returns whether enough SMs are left to continue with phase 2
+    def _end_phase_1(self, round: int, l_rem: Participants) -> bool:
+        self.reports[round].phase_1_count = len(l_rem)
+        self.reports[round].phase_1_sms = tuple(l_rem)
+        self.reports[round].t_phase_1 = self.clock.now()
+        return len(l_rem) >= self.meta.n_min
+
+    def _end_round(self, round: int):
         self.reports[round].terminated = True
-        self.reports[round].t_end = now()
+        self.reports[round].t_end = self.clock.now()
+        self.reports.emit(round)
 
-    def _run_phase_1(self, round: int) -> Tuple[Dict, Tuple[int, ...]]:
-        round_start = self.meta.t_start + self.meta.t_round_len * round
-        phase_1_end = round_start + self.meta.t_phase_1_len
+    # Returns the data of the SMs that reported, and their IDs
+    def _run_phase_1(self, round: int) -> Steps:
+        phase_1_end = self._phase_1_end(round)
 
         data = {}
-        l_rem = []
-        while now() < phase_1_end:
-            if self.req_q.empty():
-                sleep(0.1)
+        while self.clock.now() < phase_1_end:
+            msg = yield Get(phase_1_end)
+            if msg is None:
                 continue
+            if self._handle_phase_1_request(round, msg, data):
+                break
 
-            req = self.req_q.get()
-            self.reports[round].net_rcv += 1
-            self.reports[round].net_rcv_size += len(json.dumps(req))
+        return data, Participants.of(data)
 
-            if self._is_phase_1_request_valid(round, req) and req["id"] not in l_rem:
-                data[req["id"]] = self._parse_phase_1_request(round, req)
-                l_rem.append(req["id"])
+    # Returns whether all SMs reported
+    # SMs that reported are the keys of `data`.
+    def _handle_phase_1_request(self, round: int, msg: Message, data: Dict) -> bool:
+        self._record_rcv(round, msg)
+        req = msg.data
 
-            if len(l_rem) == len(self.meta.sm_addresses):
-                break
+        if self._is_phase_1_request_valid(round, req) and req["id"] not in data:
+            data[req["id"]] = self._parse_phase_1_request(round, req)
+            arrival = self.clock.now() - self._round_start(round)
+            self.metrics.observe(PHASE_1_ARRIVAL, arrival)
 
-        return data, tuple(sorted(l_rem))
+        return len(data) == len(self.meta.sm_addresses)
 
     def _is_phase_1_request_valid(self, round: int, req: Dict) -> bool:
         generic_valid = self._generic_is_phase_1_request_valid(round, req)
@@ -142,45 +202,102 @@ class DC(ABC):
     def _generate_s_initial(self):
         pass
 
-    def _activate_first_sm(self, round: int, s_initial, l_rem: Tuple[int, ...]) -> bool:
-        round_start = self.meta.t_start + self.meta.t_round_len * round
-        phase_2_end = round_start + self.meta.t_round_len
-        while len(l_rem) > 0:
-            data = {"round": round, "s": s_initial, "l_rem": l_rem, "l_act": []}
-            sm_id = l_rem[0]
+    # Split the SMs into disjoint phase 2 chains of consecutive IDs
+    # Every chain has at least n_min SMs, so each one can reach the threshold
+    # on its own, and the DC never learns the sum of less than n_min SMs.
+    def _split_chains(self, l_rem: Participants) -> List[Participants]:
+        count = max(1, min(self.meta.chains, len(l_rem) // self.meta.n_min))
+        ids = list(l_rem)
+        bounds = [len(ids) * i // count for i in range(count + 1)]
+        return [Participants.of(ids[bounds[i] : bounds[i + 1]]) for i in range(count)]
+
+    # `chain` tags the messages of the chain, if there are multiple chains
+    # Returns whether an SM was activated
+    def _activate_first_sm(
+        self, round: int, s_initial, l_rem: Participants, chain: int | None = None
+    ) -> Steps:
+        phase_2_end = self._phase_2_end(round)
+        probed = Participants()
+        down = Participants()
+        while l_rem:
+            sm_id, passed = self._next_hop(round, l_rem)
+            # Probe the next SMs at once, and only send to reachable ones
+            if self.probe_width > 1 and sm_id not in probed:
+                hops = self._next_hops(round, l_rem)
+                addresses = [self.meta.sm_addresses[id] for id in hops]
+                first = yield Probe(addresses, phase_2_end)
+                probed, down = self._record_probe(round, hops, first, probed, down)
             address = self.meta.sm_addresses[sm_id]
-            if not address.valid:
-                l_rem = l_rem[1:]
-                continue
-            ok = self.net_mngr.send(address, data, phase_2_end)
-            if ok:
-                self.reports[round].net_snd_succ += 1
-                self.reports[round].net_snd_succ_size += len(json.dumps(data))
-                return True
-            self.reports[round].net_snd_fail += 1
-            self.reports[round].net_snd_fail_size += len(json.dumps(data))
-            l_rem = l_rem[1:]
+            if address.valid and sm_id not in down:
+                msg = self._activation_message(round, s_initial, l_rem, chain)
+                ok = yield Send(address, msg, phase_2_end)
+                self._record_snd(round, msg, ok)
+                self._record_hop(round, sm_id, ok, passed)
+                if ok:
+                    return True
+            l_rem = l_rem.remove(sm_id)
         return False
 
-    def _run_phase_2(self, round: int, data: Dict, s_initial):
-        round_start = self.meta.t_start + self.meta.t_round_len * round
-        phase_2_end = round_start + self.meta.t_round_len
-
-        while now() < phase_2_end:
-            if self.req_q.empty():
-                sleep(0.1)
+    def _activation_message(
+        self, round: int, s_initial, l_rem: Participants, chain: int | None = None
+    ) -> Message:
+        encoding = self.meta.id_encoding
+        data = {
+            "round": round,
+            "s": s_initial,
+            "l_rem": encode_ids(l_rem, encoding, self.meta.codec),
+            "l_act": encode_ids(Participants(), encoding, self.meta.codec),
+        }
+        if chain is not None:
+            data["chain"] = chain
+        return Message.encode(data, self.meta.codec)
+
+    # `chains` are the activated chains, by chain number
+    def _run_phase_2(
+        self, round: int, data: Dict, s_initials: Dict, chains: Dict[int, Participants]
+    ) -> Steps:
+        phase_2_end = self._phase_2_end(round)
+
+        results = {}
+        while self.clock.now() < phase_2_end:
+            msg = yield Get(phase_2_end)
+            if msg is None:
                 continue
-
-            req = self.req_q.get()
-            self.reports[round].net_rcv += 1
-            self.reports[round].net_rcv_size += len(json.dumps(req))
-
-            if self._is_phase_2_request_valid(round, req):
-                aggregate = self._calc_aggregate(round, data, s_initial, req)
-                self.reports[round].success = True
-                self.reports[round].phase_2_count = len(req["l_act"])
-                self.reports[round].phase_2_sms = req["l_act"]
+            if self._handle_phase_2_request(round, msg, chains, results):
                 break
+        self._end_phase_2(round, data, s_initials, results)
+
+    # Returns whether all chains reported
+    # Results are the requests of the chains that reported, by chain number.
+    def _handle_phase_2_request(
+        self,
+        round: int,
+        msg: Message,
+        chains: Dict[int, Participants],
+        results: Dict[int, Dict],
+    ) -> bool:
+        self._record_rcv(round, msg)
+        req = msg.data
+
+        if self._is_phase_2_request_valid(round, req):
+            chain = req.get("chain", 0)
+            l_act = decode_ids(req["l_act"], len(self.meta.sm_addresses))
+            # Chains are disjoint, so a chain can only contain its own SMs
+            if chain in chains and chain not in results and not l_act - chains[chain]:
+                results[chain] = req
+
+        return len(results) == len(chains)
+
+    def _end_phase_2(self, round: int, data: Dict, s_initials: Dict, results: Dict):
+        if not results:
+            return
+        aggregate = self._calc_aggregate(round, data, s_initials, results)
+        l_act = Participants()
+        for req in results.values():
+            l_act |= decode_ids(req["l_act"], len(self.meta.sm_addresses))
+        self.reports[round].success = True
+        self.reports[round].phase_2_count = len(l_act)
+        self.reports[round].phase_2_sms = tuple(l_act)
 
     def _is_phase_2_request_valid(self, round: int, req: Dict) -> bool:
         generic_valid = self._generic_is_phase_2_request_valid(round, req)
@@ -196,11 +313,14 @@ class DC(ABC):
         if req["round"] != round:
             return False
 
-        if not isinstance(req["l_act"], list):
+        try:
+            decode_ids(req["l_act"], len(self.meta.sm_addresses))
+        except (TypeError, ValueError):
+            return False
+
+        # Chain number is only there with multiple chains
+        if "chain" in req and type(req["chain"]) is not int:
             return False
-        for i in req["l_act"]:
-            if i not in range(len(self.meta.sm_addresses)):
-                return False
 
         return True
 
@@ -208,27 +328,60 @@ class DC(ABC):
     def _specific_is_phase_2_request_valid(self, round: int, req: Dict) -> bool:
         pass
 
+    # Combines the results of all chains that reported
+    # `s_initials` and `results` are by chain number.
     @abstractmethod
-    def _calc_aggregate(self, round: int, data: Dict, s_initial, req: Dict):
+    def _calc_aggregate(self, round: int, data: Dict, s_initials: Dict, results: Dict):
         pass
 
 
 # Masking DC
 # Concrete implemententation of DC
 class MaskingDC(DC):
-    def __init__(self, meta: DCMaskingMetadata, net_mngr: NetworkManager):
+    def __init__(
+        self,
+        meta: DCMaskingMetadata,
+        net_mngr: NetworkManager,
+        *,
+        clock: time.Clock = time.REAL_CLOCK,
+        health: LinkHealth | None = None,
+        probe_width: int = 1,
+        reports: ReportLog | None = None,
+        metrics: Metrics = NO_METRICS,
+    ):
         if not is_valid_dc_masking_metadata(meta):
             raise ValueError("Invalid data concentrator masking metadata.")
-        super().__init__(meta, net_mngr)
+        super().__init__(
+            meta,
+            net_mngr,
+            clock=clock,
+            health=health,
+            probe_width=probe_width,
+            reports=reports,
+            metrics=metrics,
+        )
         self.meta = meta
+        # Keeps the ciphers of all the PRF keys, since every round uses them all
+        self.prf_engine = crypto.PRFEngine(max(1, len(meta.prf_keys)))
+        # PRF values of all SMs for one round
+        self.prfs_round = None
+        self.prfs = ()
+
+    def _prepare_round(self, round: int):
+        # One batch computation instead of one PRF per phase 1 request
+        with self.metrics.timer(CRYPTO, op="prf"):
+            self.prfs = self.prf_engine.prf_many(self.meta.prf_keys, round)
+        self.prfs_round = round
 
     def _specific_is_phase_1_request_valid(self, round: int, req: Dict) -> bool:
         return "data" in req and isinstance(req["data"], int)
 
     def _parse_phase_1_request(self, round: int, req: Dict) -> Dict:
+        if self.prfs_round != round:
+            self._prepare_round(round)
         return {
             "masked": req["data"],
-            "prf": crypto.prf(self.meta.prf_keys[req["id"]], round),
+            "prf": self.prfs[req["id"]],
         }
 
     def _generate_s_initial(self):
@@ -237,20 +390,44 @@ class MaskingDC(DC):
     def _specific_is_phase_2_request_valid(self, round: int, req: Dict) -> bool:
         return True
 
-    def _calc_aggregate(self, round: int, data: Dict, s_initial, req: Dict):
-        masked_sum = sum(map(lambda id: data[id]["masked"], req["l_act"]))
-        prfs_l_act = sum(map(lambda id: data[id]["prf"], req["l_act"]))
-        return (masked_sum - (req["s"] - s_initial) - prfs_l_act) % self.meta.k
+    def _calc_aggregate(self, round: int, data: Dict, s_initials: Dict, results: Dict):
+        aggregate = 0
+        for chain, req in results.items():
+            l_act = decode_ids(req["l_act"], len(self.meta.sm_addresses))
+            masked_sum = sum(map(lambda id: data[id]["masked"], l_act))
+            prfs_l_act = sum(map(lambda id: data[id]["prf"], l_act))
+            aggregate += masked_sum - (req["s"] - s_initials[chain]) - prfs_l_act
+        return aggregate % self.meta.k
 
 
 # Homomorphic Encryption DC
 # Concrete implemententation of DC
-class HomomorphicDC(DC):
-    def __init__(self, meta: DCHomomorphicMetadata, net_mngr: NetworkManager):
+class HomomorphicDC(Obfuscating, DC):
+    def __init__(
+        self,
+        meta: DCHomomorphicMetadata,
+        net_mngr: NetworkManager,
+        *,
+        clock: time.Clock = time.REAL_CLOCK,
+        obfuscators: crypto.ObfuscatorPool | None = None,
+        health: LinkHealth | None = None,
+        probe_width: int = 1,
+        reports: ReportLog | None = None,
+        metrics: Metrics = NO_METRICS,
+    ):
         if not is_valid_dc_homomorphic_metadata(meta):
             raise ValueError("Invalid data concentrator homomorphic metadata.")
-        super().__init__(meta, net_mngr)
+        super().__init__(
+            meta,
+            net_mngr,
+            clock=clock,
+            health=health,
+            probe_width=probe_width,
+            reports=reports,
+            metrics=metrics,
+        )
         self.meta = meta
+        self._use_obfuscators(meta.pk, obfuscators)
 
     def _specific_is_phase_1_request_valid(self, round: int, req: Dict) -> bool:
         return True
@@ -259,16 +436,66 @@ class HomomorphicDC(DC):
         return {}
 
     def _generate_s_initial(self):
-        m = self.meta.pk.encrypt(0)
-        return crypto.serialize_homomorphic_number(m)
+        with self.metrics.timer(CRYPTO, op="encrypt"):
+            m = self.obfuscators.encrypt(0)
+        return crypto.serialize_homomorphic_number(
+            m, be_secure=False, as_int=self.meta.codec == CODEC.BINARY
+        )
 
     def _specific_is_phase_2_request_valid(self, round: int, req: Dict) -> bool:
         return True
 
-    def _calc_aggregate(self, round: int, data: Dict, s_initial, req: Dict):
-        m = req["s"]
-        s = crypto.deserialize_homomorphic_number(m, self.meta.pk)
-        return self.meta.sk.decrypt(s)
+    def _calc_aggregate(self, round: int, data: Dict, s_initials: Dict, results: Dict):
+        # Add the chains homomorphically, so only the total is decrypted
+        ms = [req["s"] for req in results.values()]
+        s = sum(crypto.deserialize_homomorphic_number(m, self.meta.pk) for m in ms)
+        with self.metrics.timer(CRYPTO, op="decrypt"):
+            m = self.meta.sk.decrypt(s)
+        # One decryption gives the sums of all slots
+        if self.meta.packing is not None:
+            return self.meta.packing.unpack(m)
+        return m
+
+
+################################################################################
+# Asynchronous Classes
+# Run the same rounds as the classes above as coroutines, over an
+# AsyncNetworkManager. Many DCs can share one event loop.
+# NOTE:
+# These always run in real time, so they don't take a virtual clock.
+# Use the async factory method to make instances.
+################################################################################
+
+
+# Generic Async DC
+# Abstract Class - Use concrete implemententations
+class AsyncDC(DC):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Coroutines wait on the event loop, which only runs in real time
+        if isinstance(self.clock, time.VirtualClock):
+            raise ValueError("Async DCs can't run on a virtual clock.")
+
+    async def run_forever(self):
+        await async_run_steps(self, self._run(None))
+
+    async def run_once(self):
+        await self.run_rounds(1)
+
+    async def run_rounds(self, count: int):
+        await async_run_steps(self, self._run(count))
+
+
+# Async Masking DC
+# Concrete implemententation of AsyncDC
+class AsyncMaskingDC(AsyncDC, MaskingDC):
+    pass
+
+
+# Async Homomorphic Encryption DC
+# Concrete implemententation of AsyncDC
+class AsyncHomomorphicDC(AsyncDC, HomomorphicDC):
+    pass
 
 
 ################################################################################
@@ -278,8 +505,21 @@ class HomomorphicDC(DC):
 
 # Construct the correct type of DC based on the given metadata
 def make_dc(
-    meta: DCMaskingMetadata | DCHomomorphicMetadata, net_mngr: NetworkManager
+    meta: DCMaskingMetadata | DCHomomorphicMetadata,
+    net_mngr: NetworkManager,
+    **kwargs,
 ) -> DC:
     if isinstance(meta, DCMaskingMetadata):
-        return MaskingDC(meta, net_mngr)
-    return HomomorphicDC(meta, net_mngr)
+        return MaskingDC(meta, net_mngr, **kwargs)
+    return HomomorphicDC(meta, net_mngr, **kwargs)
+
+
+# Construct the correct type of async DC based on the given metadata
+def make_async_dc(
+    meta: DCMaskingMetadata | DCHomomorphicMetadata,
+    net_mngr: AsyncNetworkManager,
+    **kwargs,
+) -> AsyncDC:
+    if isinstance(meta, DCMaskingMetadata):
+        return AsyncMaskingDC(meta, net_mngr, **kwargs)
+    return AsyncHomomorphicDC(meta, net_mngr, **kwargs)
@@ -0,0 +1,61 @@
+from typing import Dict, Tuple
+
+from .participants import Participants
+
+################################################################################
+# Link Health
+################################################################################
+
+# Remembers failed sends to peers across rounds.
+#
+# In long runs, links that failed in the last rounds are likely to fail again.
+# Each failed send to a dead peer costs a timeout, so next-hop selection tries
+# peers with a recent failure after all the others. Peers are never dropped for
+# their history alone: they stay candidates, and are tried first again once
+# their backoff is over.
+#
+# After f consecutive failed rounds, a peer is suspect for the next
+# min(2^(f - 1), max_backoff) rounds. A round counts once, however many sends
+# and probes to the peer failed in it. One successful send clears its history.
+
+# Default maximum number of rounds a peer stays suspect
+DEFAULT_MAX_BACKOFF = 16
+
+
+class LinkHealth:
+    def __init__(self, max_backoff: int = DEFAULT_MAX_BACKOFF):
+        self.max_backoff = max_backoff
+        # Consecutive failed rounds per peer
+        self.fails: Dict[int, int] = {}
+        # Last round each peer failed in
+        self.failed_in: Dict[int, int] = {}
+        # Last round each peer is suspect in
+        self.suspect_until: Dict[int, int] = {}
+
+    def is_suspect(self, peer: int, round: int) -> bool:
+        return self.suspect_until.get(peer, -1) >= round
+
+    # Failed sends and probes of the same round only count once
+    def record(self, peer: int, ok: bool, round: int):
+        if ok:
+            self.fails.pop(peer, None)
+            self.failed_in.pop(peer, None)
+            self.suspect_until.pop(peer, None)
+            return
+        if self.failed_in.get(peer) == round:
+            return
+        self.failed_in[peer] = round
+        fails = self.fails.get(peer, 0) + 1
+        self.fails[peer] = fails
+        self.suspect_until[peer] = round + min(2 ** (fails - 1), self.max_backoff)
+
+    # Next peer to try from `candidates`
+    # The first peer that is not suspect, or the first peer if all of them are.
+    # Also returns the suspect peers that were passed over.
+    def choose(self, candidates: Participants, round: int) -> Tuple[int, Participants]:
+        passed = Participants()
+        for peer in candidates:
+            if not self.is_suspect(peer, round):
+                return peer, passed
+            passed = passed.add(peer)
+        return candidates.first(), Participants()
@@ -1,8 +1,14 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from typing import Tuple
 
-from .crypto import HomomorphicPrivateKey, HomomorphicPublicKey, PRFKey
+from .codec import CODEC
+from .crypto import (
+    HomomorphicPrivateKey,
+    HomomorphicPublicKey,
+    PRFKey,
+    SlotPacking,
+)
 from . import network
 
 ################################################################################
@@ -47,6 +53,24 @@ class Metadata:
     # The length of phase 2 is determined by t_round_len and t_phase_1_len.
     t_phase_1_len: float
 
+    # Wire Encoding Of SM ID Sets
+    # Used for l_rem and l_act in the phase 2 messages we send.
+    # We accept messages in any encoding.
+    id_encoding: network.ID_ENCODING = field(
+        default=network.ID_ENCODING.LIST, kw_only=True
+    )
+
+    # Wire Format Of The Messages We Send
+    # We accept messages in any format.
+    codec: CODEC = field(default=CODEC.JSON, kw_only=True)
+
+    # Maximum Number Of Phase 2 Chains
+    # Only used by the DC.
+    # The DC splits the SMs into up to this many disjoint chains, that run
+    # phase 2 at the same time, and adds up their results. Every chain has at
+    # least n_min SMs, so there are less chains if there are too few SMs.
+    chains: int = field(default=1, kw_only=True)
+
 
 # AggFT Rounds Metadata
 # Specific for using masking.
@@ -89,6 +113,11 @@ class HomomorphicMetadata(Metadata):
     # Homomorphic Public Key
     pk: HomomorphicPublicKey
 
+    # Slot Packing Of Readings
+    # When set, every SM contributes a vector of readings, packed into one
+    # plaintext, and the aggregate is the vector of their sums.
+    packing: SlotPacking | None = field(default=None, kw_only=True)
+
 
 # AggFT Rounds Metadata
 # Specific for a DC using homomorphic encryption.
@@ -129,6 +158,10 @@ def is_valid_metadata(m: Metadata) -> bool:
     if m.t_phase_1_len <= 0 or m.t_phase_1_len >= m.t_round_len:
         return False
 
+    # At least one chain should run phase 2
+    if m.chains < 1:
+        return False
+
     return True
 
 
@@ -163,7 +196,23 @@ def is_valid_sm_masking_metadata(m: SMMaskingMetadata) -> bool:
 
 def is_valid_homomorphic_metadata(m: HomomorphicMetadata) -> bool:
     # Should be a valid metadata
-    return is_valid_metadata(m)
+    if not is_valid_metadata(m):
+        return False
+
+    if m.packing is not None:
+        # Should hold at least one reading of at least one bit
+        if m.packing.slots < 1 or m.packing.bits < 1:
+            return False
+
+        # Should have headroom for the sum of all smart meters
+        if m.packing.n < len(m.sm_addresses):
+            return False
+
+        # Sums should fit in one plaintext
+        if not m.packing.fits(m.pk):
+            return False
+
+    return True
 
 
 def is_valid_dc_homomorphic_metadata(m: DCHomomorphicMetadata) -> bool:
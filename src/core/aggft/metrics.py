@@ -0,0 +1,197 @@
+import os
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import thread_time
+from typing import Dict, List, Sequence, Tuple
+
+################################################################################
+# Metric Definitions
+################################################################################
+
+# Histograms recorded by DCs, SMs and metered network managers.
+# Times are in seconds. Crypto times are CPU times of the timed thread, even with
+# a virtual clock.
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+CRYPTO_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 50, 100, 500, 1000)
+
+PHASE_1_ARRIVAL = "aggft_phase_1_arrival_seconds"
+PHASE_2_HOP = "aggft_phase_2_hop_seconds"
+SEND = "aggft_send_seconds"
+PROBE = "aggft_probe_seconds"
+CRYPTO = "aggft_crypto_seconds"
+QUEUE_DEPTH = "aggft_queue_depth"
+
+# Name: (help, buckets)
+DEFINITIONS: Dict[str, Tuple[str, Sequence[float]]] = {
+    PHASE_1_ARRIVAL: (
+        "Time from round start to the arrival of each phase 1 message at the DC.",
+        TIME_BUCKETS,
+    ),
+    PHASE_2_HOP: (
+        "Time an SM holds the phase 2 aggregate, from activation to hand-off.",
+        TIME_BUCKETS,
+    ),
+    SEND: ("Time of message sends, by outcome.", TIME_BUCKETS),
+    PROBE: ("Time of reachability probes, by outcome.", TIME_BUCKETS),
+    CRYPTO: ("CPU time of cryptographic operations, by operation.", CRYPTO_BUCKETS),
+    QUEUE_DEPTH: (
+        "Messages waiting in the incoming queue when a message is taken.",
+        DEPTH_BUCKETS,
+    ),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+################################################################################
+# Histogram
+################################################################################
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # Per bucket counts, the last one for values above all buckets
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Cumulative counts per upper bound, as in the Prometheus format
+    def cumulative(self) -> List[Tuple[str, int]]:
+        out = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            out.append((_format(bound), total))
+        out.append(("+Inf", self.count))
+        return out
+
+
+################################################################################
+# Metrics
+################################################################################
+
+# Set of histograms, shared by any number of actors and threads.
+# Exposed in the Prometheus text format, through `render`, `dump` or `serve`.
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(DEFINITIONS[name][1])
+            histogram.observe(value)
+
+    # Context manager observing the CPU time of its body
+    def timer(self, name: str, **labels: str) -> "_Timer":
+        return _Timer(self, name, labels)
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# HELP {name} {DEFINITIONS[name][0]}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    for bound, count in histogram.cumulative():
+                        le = _labels(labels + (("le", bound),))
+                        lines.append(f"{name}_bucket{le} {count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {histogram.sum!r}")
+                    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    # Write to a file, e.g. for the textfile collector of the node exporter
+    # Readers never see a partial file.
+    def dump(self, path: str):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    # Serve on http://host:port/metrics from a background thread
+    # Call `shutdown` on the returned server to stop.
+    def serve(self, host: str, port: int) -> ThreadingHTTPServer:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# Records nothing
+# The default of DCs and SMs, so metrics cost nothing unless enabled.
+class NullMetrics(Metrics):
+    def observe(self, name: str, value: float, **labels: str):
+        pass
+
+    def timer(self, name: str, **labels: str) -> "_Timer":
+        return _NULL_TIMER
+
+
+NO_METRICS = NullMetrics()
+
+
+# Times the CPU time of the current thread, so time spent by other threads, e.g.
+# while waiting on the GIL, doesn't count
+class _Timer:
+    def __init__(self, metrics: Metrics, name: str, labels: Dict[str, str]):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, thread_time() - self.start, **self.labels)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def _format(bound: float) -> str:
+    return repr(float(bound))
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
@@ -1,14 +1,19 @@
 import asyncio
-import json
 import threading
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from enum import Enum
 from queue import Queue
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Sequence, Tuple
 
 import aiohttp
 from aiohttp import web
 
+from . import time
+from .codec import CODEC, CODECS, decode_payload, encode_payload
+from .metrics import PROBE, SEND, Metrics
+from .participants import Participants
+
 ################################################################################
 # Types
 ################################################################################
@@ -16,6 +21,7 @@ from aiohttp import web
 Host = str
 Port = int
 Registry = Dict[Tuple[Host, Port], Queue]
+AsyncRegistry = Dict[Tuple[Host, Port], asyncio.Queue]
 
 
 @dataclass(frozen=True)
@@ -25,6 +31,128 @@ class Address:
     valid: bool
 
 
+# A message as sent over the network.
+# Carries both the payload and its encoding, so the message is encoded once
+# and its size (bytes) is known without encoding it again.
+@dataclass(frozen=True)
+class Message:
+    data: Dict[str, Any]
+    encoded: bytes
+
+    @property
+    def size(self) -> int:
+        return len(self.encoded)
+
+    @staticmethod
+    def encode(data: Dict[str, Any], codec: CODEC = CODEC.JSON) -> "Message":
+        return Message(data, encode_payload(data, codec))
+
+    # Detects the codec the message was encoded with
+    @staticmethod
+    def decode(encoded: bytes) -> "Message":
+        return Message(decode_payload(encoded), encoded)
+
+
+# Wire encodings of SM ID sets (l_rem and l_act in phase 2 messages)
+# Receivers detect the encoding, so senders can pick any of them.
+class ID_ENCODING(Enum):
+    # JSON array of IDs
+    # Size grows with the number of IDs.
+    LIST = 0
+
+    # Hex string of the bitmap of IDs
+    # Size grows with the largest ID.
+    BITMAP = 1
+
+    # JSON array of [start, length] pairs of consecutive IDs
+    # Size grows with the number of gaps between IDs.
+    RANGES = 2
+
+    # The smaller one of BITMAP and RANGES, in the codec of the message
+    COMPACT = 3
+
+
+# Extra time (seconds) a simulated send takes, e.g. for the network round trip.
+# Failed sends can take a different time, e.g. for waiting on a timeout.
+@dataclass(frozen=True)
+class LatencyModel:
+    succ: float = 0.0
+    fail: float = 0.0
+
+    def delay(self, ok: bool) -> float:
+        return self.succ if ok else self.fail
+
+
+NO_LATENCY = LatencyModel()
+
+
+################################################################################
+# ID Set Encoding
+################################################################################
+
+
+# `codec` is the codec of the message, that COMPACT sizes the encodings with
+def encode_ids(
+    ids: Participants, encoding: ID_ENCODING, codec: CODEC = CODEC.JSON
+) -> Any:
+    if encoding == ID_ENCODING.LIST:
+        return list(ids)
+    if encoding == ID_ENCODING.BITMAP:
+        return f"{ids.bits:x}"
+    if encoding == ID_ENCODING.RANGES:
+        return [[start, length] for start, length in _runs(ids.bits)]
+    bitmap = encode_ids(ids, ID_ENCODING.BITMAP)
+    ranges = encode_ids(ids, ID_ENCODING.RANGES)
+    return bitmap if _size(bitmap, codec) < _size(ranges, codec) else ranges
+
+
+# Encoded size of a value, plus the same overhead for any value
+def _size(value: Any, codec: CODEC) -> int:
+    return len(encode_payload({"": value}, codec))
+
+
+# Decode an ID set in any encoding.
+# Raises ValueError or TypeError if it is malformed, or has IDs not less than n.
+def decode_ids(value: Any, n: int) -> Participants:
+    if isinstance(value, str):
+        # Reject before parsing, so huge bitmaps are cheap to reject
+        if len(value) > n // 4 + 1:
+            raise ValueError("ID out of range.")
+        ids = Participants(int(value, 16) if value else 0)
+    elif not isinstance(value, (list, tuple)):
+        raise TypeError("Unknown ID set encoding.")
+    elif len(value) > 0 and isinstance(value[0], (list, tuple)):
+        bits = 0
+        for start, length in value:
+            if start < 0 or length < 0 or start + length > n:
+                raise ValueError("ID out of range.")
+            bits |= ((1 << length) - 1) << start
+        ids = Participants(bits)
+    else:
+        for id in value:
+            if not 0 <= id < n:
+                raise ValueError("ID out of range.")
+        ids = Participants.of(value)
+    if ids.bits < 0 or not ids.within(n):
+        raise ValueError("ID out of range.")
+    return ids
+
+
+# Runs of consecutive set bits as (start, length)
+def _runs(bits: int):
+    start = 0
+    while bits:
+        # Skip unset bits
+        skip = (bits & -bits).bit_length() - 1
+        bits >>= skip
+        start += skip
+        # Count set bits
+        length = (bits ^ (bits + 1)).bit_length() - 1
+        yield start, length
+        bits >>= length
+        start += length
+
+
 ################################################################################
 # Abstract Network Manager
 ################################################################################
@@ -34,10 +162,19 @@ class Address:
 
 
 class NetworkManager(ABC):
+    # Returns whether the message was delivered.
+    # Sends not completed before the deadline (Unix Time) fail.
     @abstractmethod
-    def send(self, address: Address, data: Dict[str, Any], timeout: float) -> bool:
+    def send(self, address: Address, msg: Message, deadline: float) -> bool:
         pass
 
+    # Returns the index of the first reachable address, or -1 if there is none.
+    # Addresses are checked at the same time, without sending a message, so this
+    # takes one timeout at most. Returns as soon as the index is known.
+    # NOTE: Override this for network protocols that can check liveness
+    def probe(self, addresses: Sequence[Address], deadline: float) -> int:
+        return _first(address.valid for address in addresses)
+
     @abstractmethod
     def listen(self, address: Address) -> Queue:
         pass
@@ -46,6 +183,43 @@ class NetworkManager(ABC):
     def stop(self) -> None:
         pass
 
+    # Called by DCs and SMs for every message they take from the queue.
+    # NOTE: Override this to observe incoming messages, e.g. for tracing
+    def received(self, msg: Message) -> None:
+        pass
+
+
+# Same interface for async DCs and SMs.
+# Implementations must not block the event loop.
+
+
+class AsyncNetworkManager(ABC):
+    # Returns whether the message was delivered.
+    # Sends not completed before the deadline (Unix Time) fail.
+    @abstractmethod
+    async def send(self, address: Address, msg: Message, deadline: float) -> bool:
+        pass
+
+    # Returns the index of the first reachable address, or -1 if there is none.
+    # Addresses are checked at the same time, without sending a message, so this
+    # takes one timeout at most. Returns as soon as the index is known.
+    # NOTE: Override this for network protocols that can check liveness
+    async def probe(self, addresses: Sequence[Address], deadline: float) -> int:
+        return _first(address.valid for address in addresses)
+
+    @abstractmethod
+    async def listen(self, address: Address) -> asyncio.Queue:
+        pass
+
+    @abstractmethod
+    async def stop(self) -> None:
+        pass
+
+    # Called by DCs and SMs for every message they take from the queue.
+    # NOTE: Override this to observe incoming messages, e.g. for tracing
+    def received(self, msg: Message) -> None:
+        pass
+
 
 ################################################################################
 # Shared Memory Networking
@@ -54,29 +228,60 @@ class NetworkManager(ABC):
 
 # Uses shared memory instead of sending actual network requests.
 # Can be used for simulations on one physical machine.
+#
+# By default, messages are copied through JSON, like a real network would do.
+# With `zero_copy`, the sent message itself is delivered, with its lists, e.g.
+# ID ranges, frozen into tuples. Actors never modify messages, so they can be
+# safely shared.
+#
+# Sends take no time besides the copy, unless a latency model is given. Without
+# one, failed sends copy the message too, so both take similar time.
 
 
 class SharedMemoryNetworkManager(NetworkManager):
-    def __init__(self, id, registry: Registry, link_status, sm_status):
+    def __init__(
+        self,
+        id,
+        registry: Registry,
+        link_status,
+        sm_status,
+        zero_copy: bool = False,
+        latency: LatencyModel = NO_LATENCY,
+        clock: time.Clock = time.REAL_CLOCK,
+    ):
         self.id = id
         self.registry = registry
-        self.dummy_queue = Queue()
         self.link_status = link_status
         self.sm_status = sm_status
+        self.zero_copy = zero_copy
+        self.latency = latency
+        self.clock = clock
 
-    def send(self, address: Address, data: Dict[str, Any], _) -> bool:
-        if self.link_status[(self.id, address.port)] and (
+    def send(self, address: Address, msg: Message, _) -> bool:
+        ok = self.link_status[(self.id, address.port)] and (
             address.port == -1 or self.sm_status[address.port]
-        ):
-            self.registry[(address.host, address.port)].put(
-                json.loads(json.dumps(data))
-            )
-            return True
-        # Use dummy queue to make successful and failed send operation take
-        # similar time
-        self.dummy_queue.put(json.loads(json.dumps(data)))
-        self.dummy_queue.get()
-        return False
+        )
+        if ok or self.latency == NO_LATENCY:
+            copy = _copy(msg, self.zero_copy)
+        if ok:
+            self.registry[(address.host, address.port)].put(copy)
+        delay = self.latency.delay(ok)
+        if delay > 0:
+            self.clock.sleep(delay)
+        return ok
+
+    def probe(self, addresses: Sequence[Address], _) -> int:
+        first, delay = _probe(addresses, self._is_up, self.latency)
+        if delay > 0:
+            self.clock.sleep(delay)
+        return first
+
+    def _is_up(self, address: Address) -> bool:
+        return (
+            address.valid
+            and self.link_status[(self.id, address.port)]
+            and (address.port == -1 or self.sm_status[address.port])
+        )
 
     def listen(self, address: Address) -> Queue:
         return self.registry[(address.host, address.port)]
@@ -85,6 +290,166 @@ class SharedMemoryNetworkManager(NetworkManager):
         pass
 
 
+# Async variant of SharedMemoryNetworkManager.
+# All actors must run on the same event loop.
+
+
+class AsyncSharedMemoryNetworkManager(AsyncNetworkManager):
+    def __init__(
+        self,
+        id,
+        registry: AsyncRegistry,
+        link_status,
+        sm_status,
+        zero_copy: bool = False,
+        latency: LatencyModel = NO_LATENCY,
+    ):
+        self.id = id
+        self.registry = registry
+        self.link_status = link_status
+        self.sm_status = sm_status
+        self.zero_copy = zero_copy
+        self.latency = latency
+
+    async def send(self, address: Address, msg: Message, _) -> bool:
+        ok = self.link_status[(self.id, address.port)] and (
+            address.port == -1 or self.sm_status[address.port]
+        )
+        if ok or self.latency == NO_LATENCY:
+            copy = _copy(msg, self.zero_copy)
+        if ok:
+            self.registry[(address.host, address.port)].put_nowait(copy)
+        delay = self.latency.delay(ok)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return ok
+
+    async def probe(self, addresses: Sequence[Address], _) -> int:
+        first, delay = _probe(addresses, self._is_up, self.latency)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return first
+
+    def _is_up(self, address: Address) -> bool:
+        return (
+            address.valid
+            and self.link_status[(self.id, address.port)]
+            and (address.port == -1 or self.sm_status[address.port])
+        )
+
+    async def listen(self, address: Address) -> asyncio.Queue:
+        return self.registry[(address.host, address.port)]
+
+    async def stop(self) -> None:
+        pass
+
+
+# Index of the first true value, or -1
+def _first(oks) -> int:
+    return next((i for i, ok in enumerate(oks) if ok), -1)
+
+
+# Result and duration of simulated probes
+# Probes run at the same time, so they take as long as the slowest one that
+# decides the result.
+def _probe(addresses, is_up, latency: LatencyModel) -> Tuple[int, float]:
+    oks = [is_up(address) for address in addresses]
+    first = _first(oks)
+    decided = oks if first == -1 else oks[: first + 1]
+    return first, max((latency.delay(ok) for ok in decided), default=0)
+
+
+# Copy of a message as the receiver sees it
+def _copy(msg: Message, zero_copy: bool) -> Message:
+    if not zero_copy:
+        return Message.decode(msg.encoded)
+    data = {k: _freeze(v) for k, v in msg.data.items()}
+    return Message(data, msg.encoded)
+
+
+# Lists as tuples, at any depth
+def _freeze(value):
+    if isinstance(value, list):
+        return tuple(map(_freeze, value))
+    return value
+
+
+################################################################################
+# Metered Networking
+################################################################################
+
+
+# Wraps a network manager to record the time of its sends and probes.
+# Failed sends show how much of the round goes to timeouts.
+
+
+class MeteredNetworkManager(NetworkManager):
+    def __init__(
+        self,
+        net_mngr: NetworkManager,
+        metrics: Metrics,
+        clock: time.Clock = time.REAL_CLOCK,
+    ):
+        self.net_mngr = net_mngr
+        self.metrics = metrics
+        self.clock = clock
+
+    def send(self, address: Address, msg: Message, deadline: float) -> bool:
+        start = self.clock.now()
+        ok = self.net_mngr.send(address, msg, deadline)
+        self.metrics.observe(SEND, self.clock.now() - start, outcome=_outcome(ok))
+        return ok
+
+    def probe(self, addresses: Sequence[Address], deadline: float) -> int:
+        start = self.clock.now()
+        first = self.net_mngr.probe(addresses, deadline)
+        elapsed = self.clock.now() - start
+        self.metrics.observe(PROBE, elapsed, outcome=_outcome(first != -1))
+        return first
+
+    def listen(self, address: Address) -> Queue:
+        return self.net_mngr.listen(address)
+
+    def stop(self) -> None:
+        self.net_mngr.stop()
+
+    def received(self, msg: Message) -> None:
+        self.net_mngr.received(msg)
+
+
+class AsyncMeteredNetworkManager(AsyncNetworkManager):
+    def __init__(self, net_mngr: AsyncNetworkManager, metrics: Metrics):
+        self.net_mngr = net_mngr
+        self.metrics = metrics
+
+    async def send(self, address: Address, msg: Message, deadline: float) -> bool:
+        start = time.REAL_CLOCK.now()
+        ok = await self.net_mngr.send(address, msg, deadline)
+        elapsed = time.REAL_CLOCK.now() - start
+        self.metrics.observe(SEND, elapsed, outcome=_outcome(ok))
+        return ok
+
+    async def probe(self, addresses: Sequence[Address], deadline: float) -> int:
+        start = time.REAL_CLOCK.now()
+        first = await self.net_mngr.probe(addresses, deadline)
+        elapsed = time.REAL_CLOCK.now() - start
+        self.metrics.observe(PROBE, elapsed, outcome=_outcome(first != -1))
+        return first
+
+    async def listen(self, address: Address) -> asyncio.Queue:
+        return await self.net_mngr.listen(address)
+
+    async def stop(self) -> None:
+        await self.net_mngr.stop()
+
+    def received(self, msg: Message) -> None:
+        self.net_mngr.received(msg)
+
+
+def _outcome(ok: bool) -> str:
+    return "ok" if ok else "fail"
+
+
 ################################################################################
 # HTTP Networking
 ################################################################################
@@ -92,53 +457,160 @@ class SharedMemoryNetworkManager(NetworkManager):
 
 # Uses the HTTP network protocol.
 # Can be used for simulations on one physical machine or multiple.
+#
+# All networking runs on one long-lived event loop thread. Sends from protocol
+# threads are submitted to that loop, and share one client session, so
+# connections to a peer are pooled and kept alive across messages and rounds.
+
+# Default maximum number of open connections to one peer
+DEFAULT_CONNECTIONS_PER_HOST = 4
+
+# Default time (seconds) to keep idle connections open
+DEFAULT_KEEPALIVE = 60.0
 
 
 class HTTPNetworkManager(NetworkManager):
-    def __init__(self):
-        self.port = 8000
+    def __init__(
+        self,
+        connections_per_host: int = DEFAULT_CONNECTIONS_PER_HOST,
+        keepalive: float = DEFAULT_KEEPALIVE,
+    ):
         self.queue = Queue()
-        self.thread = threading.Thread(target=asyncio.run, args=(self._run(),))
-        self.running = True
-
-    async def _run(self):
-        async def handler(request):
-            data = await request.json()
-            self.queue.put(data)
-            return web.Response(text="OK")
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.async_net_mngr = AsyncHTTPNetworkManager(
+            connections_per_host, keepalive, self.queue
+        )
 
-        app = web.Application()
-        app.add_routes([web.post("/", handler)])
+    def send(self, address: Address, msg: Message, deadline: float) -> bool:
+        if not address.valid:
+            return False
+        if time.remaining_until(deadline) <= 0:
+            return False
+        return self._call(self.async_net_mngr.send(address, msg, deadline))
 
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner, "localhost", self.port, reuse_port=True)
-        await site.start()
+    def probe(self, addresses: Sequence[Address], deadline: float) -> int:
+        return self._call(self.async_net_mngr.probe(addresses, deadline))
 
-        while self.running:
-            await asyncio.sleep(1)
+    def listen(self, address: Address) -> Queue:
+        self._call(self.async_net_mngr.listen(address))
+        return self.queue
 
-        await runner.cleanup()
+    # Also ends the event loop thread, so the manager can't be used afterwards
+    def stop(self) -> None:
+        if self.loop.is_closed():
+            return
+        self._call(self.async_net_mngr.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    # Run a coroutine on the event loop thread and wait for its result
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+# Async variant of HTTPNetworkManager.
+# Runs on the event loop of the caller.
+# Incoming requests are put in `queue`, an asyncio.Queue by default.
+
+
+class AsyncHTTPNetworkManager(AsyncNetworkManager):
+    def __init__(
+        self,
+        connections_per_host: int = DEFAULT_CONNECTIONS_PER_HOST,
+        keepalive: float = DEFAULT_KEEPALIVE,
+        queue: Queue | asyncio.Queue | None = None,
+    ):
+        self.connections_per_host = connections_per_host
+        self.keepalive = keepalive
+        self.queue = asyncio.Queue() if queue is None else queue
+        self.runner = None
+        # Made on first use, as it needs a running event loop
+        self.session = None
+
+    async def send(self, address: Address, msg: Message, deadline: float) -> bool:
+        if not address.valid:
+            return False
+        timeout = time.remaining_until(deadline)
+        if timeout <= 0:
+            return False
+        url = f"http://{address.host}:{address.port}"
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        try:
+            async with self._session().post(
+                url,
+                data=msg.encoded,
+                headers={"Content-Type": _content_type(msg)},
+                timeout=client_timeout,
+            ) as resp:
+                return resp.status == 200
+        except Exception:
+            return False
 
-    def send(self, address: Address, data: Dict[str, Any], timeout: float) -> bool:
+    # Probes are GET requests, which the listener answers without queueing
+    async def probe(self, addresses: Sequence[Address], deadline: float) -> int:
+        pings = [asyncio.ensure_future(self._ping(a, deadline)) for a in addresses]
+        try:
+            for i, ping in enumerate(pings):
+                if await ping:
+                    return i
+            return -1
+        finally:
+            # Don't wait for probes after the first reachable address
+            for ping in pings:
+                ping.cancel()
+
+    async def _ping(self, address: Address, deadline: float) -> bool:
         if not address.valid:
             return False
-        return asyncio.run(self._send(address, data, timeout))
+        timeout = time.remaining_until(deadline)
+        if timeout <= 0:
+            return False
+        url = f"http://{address.host}:{address.port}"
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        try:
+            async with self._session().get(url, timeout=client_timeout) as resp:
+                return resp.status == 200
+        except Exception:
+            return False
 
-    def listen(self, address: Address) -> Queue:
-        self.port = address.port
-        self.thread.start()
+    async def listen(self, address: Address) -> Queue | asyncio.Queue:
+        async def handler(request):
+            msg = Message.decode(await request.read())
+            self.queue.put_nowait(msg)
+            return web.Response(text="OK")
+
+        async def ping_handler(request):
+            return web.Response(text="OK")
+
+        app = web.Application()
+        app.add_routes([web.post("/", handler), web.get("/", ping_handler)])
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, address.host, address.port, reuse_port=True)
+        await site.start()
         return self.queue
 
-    def stop(self) -> None:
-        self.running = False
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+        if self.session is not None:
+            await self.session.close()
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.connections_per_host,
+                keepalive_timeout=self.keepalive,
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
 
-    async def _send(self, address: Address, data: Dict[str, Any], timeout: float):
-        client_timeout = aiohttp.ClientTimeout(total=timeout)
-        async with aiohttp.ClientSession(timeout=client_timeout) as session:
-            url = f"http://{address.host}:{address.port}"
-            try:
-                async with session.post(url, json=data) as resp:
-                    return resp.status == 200
-            except:
-                return False
+
+def _content_type(msg: Message) -> str:
+    if CODECS[CODEC.JSON].sniff(msg.encoded):
+        return "application/json"
+    return "application/octet-stream"
@@ -0,0 +1,71 @@
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+################################################################################
+# Types
+################################################################################
+
+
+# Set of SM IDs
+# Stored as an int bitmap: bit `i` is set if SM `i` is in the set.
+#
+# Set operations work on whole machine words, so checking membership,
+# intersections and bounds costs O(n / 64) instead of O(n) Python steps. This
+# keeps the bookkeeping of a round cheap with thousands of SMs.
+#
+# Iteration is in increasing ID order.
+@dataclass(frozen=True)
+class Participants:
+    bits: int = 0
+
+    # Raises ValueError for negative IDs and TypeError for non-integer IDs.
+    @staticmethod
+    def of(ids: Iterable[int]) -> "Participants":
+        bits = 0
+        for id in ids:
+            bits |= 1 << id
+        return Participants(bits)
+
+    # All SMs with IDs in [0, n)
+    @staticmethod
+    def all(n: int) -> "Participants":
+        return Participants((1 << n) - 1)
+
+    def __contains__(self, id: int) -> bool:
+        return id >= 0 and (self.bits >> id) & 1 == 1
+
+    def __len__(self) -> int:
+        return self.bits.bit_count()
+
+    def __iter__(self) -> Iterator[int]:
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            yield low.bit_length() - 1
+            bits ^= low
+
+    def __or__(self, other: "Participants") -> "Participants":
+        return Participants(self.bits | other.bits)
+
+    def __and__(self, other: "Participants") -> "Participants":
+        return Participants(self.bits & other.bits)
+
+    def __sub__(self, other: "Participants") -> "Participants":
+        return Participants(self.bits & ~other.bits)
+
+    def add(self, id: int) -> "Participants":
+        return Participants(self.bits | (1 << id))
+
+    def remove(self, id: int) -> "Participants":
+        return Participants(self.bits & ~(1 << id))
+
+    # Smallest ID, or -1 if empty
+    def first(self) -> int:
+        return (self.bits & -self.bits).bit_length() - 1
+
+    def isdisjoint(self, other: "Participants") -> bool:
+        return self.bits & other.bits == 0
+
+    # Whether all IDs are less than n
+    def within(self, n: int) -> bool:
+        return self.bits >> n == 0
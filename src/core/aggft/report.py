@@ -1,5 +1,7 @@
-from dataclasses import dataclass
-from typing import Tuple
+import json
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Iterator, List, Sequence, Tuple
 
 ################################################################################
 # Types
@@ -43,21 +45,32 @@ class DCReport:
     # Total network requests received by DC
     net_rcv: int = 0
 
-    # Total characters received over the network
+    # Total bytes received over the network
     net_rcv_size: int = 0
 
     # Total successful network requests sent by DC
     net_snd_succ: int = 0
 
-    # Total successful characters send over the network
+    # Total successful bytes sent over the network
     net_snd_succ_size: int = 0
 
     # Total failed network requests sent by DC
     net_snd_fail: int = 0
 
-    # Total failed characters send over the network
+    # Total failed bytes sent over the network
     net_snd_fail_size: int = 0
 
+    # Total peers passed over for a recent link failure
+    # Each of them is a failed send (and its timeout) we likely avoided.
+    # Only counted with a link health cache.
+    net_snd_skip: int = 0
+
+    # Total reachability probes sent by DC
+    net_probe: int = 0
+
+    # Total probes to unreachable peers
+    net_probe_fail: int = 0
+
 
 # Smart Meter (SM) Report
 # SM generates such a report each round.
@@ -79,17 +92,135 @@ class SMReport:
     # Total network requests received by SM
     net_rcv: int = 0
 
-    # Total characters received over the network
+    # Total bytes received over the network
     net_rcv_size: int = 0
 
     # Total successful network requests sent by SM
     net_snd_succ: int = 0
 
-    # Total successful characters send over the network
+    # Total successful bytes sent over the network
     net_snd_succ_size: int = 0
 
     # Total failed network requests sent by SM
     net_snd_fail: int = 0
 
-    # Total failed characters send over the network
+    # Total failed bytes sent over the network
     net_snd_fail_size: int = 0
+
+    # Total peers passed over for a recent link failure
+    # Each of them is a failed send (and its timeout) we likely avoided.
+    # Only counted with a link health cache.
+    net_snd_skip: int = 0
+
+    # Total reachability probes sent by SM
+    net_probe: int = 0
+
+    # Total probes to unreachable peers
+    net_probe_fail: int = 0
+
+
+################################################################################
+# Report History
+################################################################################
+
+# Default number of recent rounds to keep reports of
+# A day of 15 minute rounds.
+DEFAULT_REPORT_HISTORY = 96
+
+
+# Reports of the recent rounds
+# A ring buffer, so DCs and SMs that run forever use fixed memory. Older
+# reports are dropped, after being streamed to the sinks at the end of their
+# round.
+#
+# Indexed by round number, like a list of all reports. Looking up a report
+# that is not kept anymore raises IndexError.
+class ReportLog:
+    def __init__(
+        self,
+        capacity: int = DEFAULT_REPORT_HISTORY,
+        sinks: Sequence["ReportSink"] = (),
+    ):
+        if capacity < 1:
+            raise ValueError("Report history should keep at least one round.")
+        self.capacity = capacity
+        self.sinks = list(sinks)
+        self.buffer: List[Any] = [None] * capacity
+        # Number of rounds so far
+        self.count = 0
+
+    def append(self, report):
+        self.buffer[self.count % self.capacity] = report
+        self.count += 1
+
+    # Stream the report of a finished round to the sinks
+    def emit(self, round: int):
+        report = self[round]
+        for sink in self.sinks:
+            sink.emit(round, report)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, round: int):
+        if round < 0:
+            round += self.count
+        if not max(0, self.count - self.capacity) <= round < self.count:
+            raise IndexError("Report of the round is not kept.")
+        return self.buffer[round % self.capacity]
+
+    # Kept reports, oldest first
+    def __iter__(self) -> Iterator:
+        for round in range(max(0, self.count - self.capacity), self.count):
+            yield self.buffer[round % self.capacity]
+
+
+################################################################################
+# Report Sinks
+################################################################################
+
+# Receive the report of every round once the round ends.
+# Implement the ReportSink abstract class for new destinations.
+# NOTE: Sinks are managed by the caller, e.g. closing files
+
+
+class ReportSink(ABC):
+    @abstractmethod
+    def emit(self, round: int, report) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+# Calls a function with the round and its report
+class CallbackSink(ReportSink):
+    def __init__(self, callback: Callable[[int, Any], None]):
+        self.callback = callback
+
+    def emit(self, round: int, report) -> None:
+        self.callback(round, report)
+
+
+# Puts (round, report) pairs in a queue
+# Works with both queue.Queue and asyncio.Queue.
+class QueueSink(ReportSink):
+    def __init__(self, queue):
+        self.queue = queue
+
+    def emit(self, round: int, report) -> None:
+        self.queue.put_nowait((round, report))
+
+
+# Appends one JSON object per report to a file
+# The object has the fields of the report, and its round.
+class FileSink(ReportSink):
+    def __init__(self, path: str):
+        self.file = open(path, "a")
+
+    def emit(self, round: int, report) -> None:
+        self.file.write(json.dumps({"round": round, **asdict(report)}) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
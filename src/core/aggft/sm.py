@@ -1,10 +1,22 @@
-import json
+import asyncio
+import itertools
 import secrets
 from abc import ABC, abstractmethod
-from time import sleep
-from time import time as now
-from typing import Any, Dict, Tuple
-
+from typing import Any, Dict, Sequence, Tuple
+
+from .actor import (
+    Actor,
+    Get,
+    Listen,
+    Obfuscating,
+    Probe,
+    Send,
+    SleepUntil,
+    Steps,
+    Stop,
+    async_run_steps,
+    run_steps,
+)
 from .metadata import (
     Metadata,
     SMMaskingMetadata,
@@ -12,8 +24,18 @@ from .metadata import (
     is_valid_sm_masking_metadata,
     is_valid_sm_homomorphic_metadata,
 )
-from .report import SMReport
-from .network import NetworkManager
+from .codec import CODEC
+from .health import LinkHealth
+from .metrics import CRYPTO, NO_METRICS, PHASE_2_HOP, Metrics
+from .report import SMReport, ReportLog
+from .network import (
+    AsyncNetworkManager,
+    Message,
+    NetworkManager,
+    decode_ids,
+    encode_ids,
+)
+from .participants import Participants
 from . import crypto, time
 
 ################################################################################
@@ -26,146 +48,198 @@ from . import crypto, time
 
 # Generic SM
 # Abstract Class - Use concrete implemententations
-class SM(ABC):
-    def __init__(self, id: int, meta: Metadata, net_mngr: NetworkManager):
+class SM(Actor, ABC):
+    def __init__(
+        self,
+        id: int,
+        meta: Metadata,
+        net_mngr: NetworkManager,
+        *,
+        clock: time.Clock = time.REAL_CLOCK,
+        health: LinkHealth | None = None,
+        probe_width: int = 1,
+        reports: ReportLog | None = None,
+        metrics: Metrics = NO_METRICS,
+    ):
         self.id = id
-        self.meta = meta
-        self.net_mngr = net_mngr
-        self.reports = []
+        super().__init__(
+            meta,
+            net_mngr,
+            clock=clock,
+            health=health,
+            probe_width=probe_width,
+            reports=reports,
+            metrics=metrics,
+        )
         self.killed = False
 
     def run_forever(self):
-        self._listen()
-
-        # Wait for the right time to start operation
-        sleep(time.remaining_until(self.meta.t_start))
-
-        round = 0
-        while True:
-            self._run_single_round(round)
-            round += 1
+        run_steps(self, self._run(None))
 
     def run_once(self):
-        self._listen()
-
-        # Wait for the right time to start operation
-        sleep(time.remaining_until(self.meta.t_start))
+        self.run_rounds(1)
 
-        self._run_single_round(0)
+    def run_rounds(self, count: int):
+        run_steps(self, self._run(count))
 
-        self._stop()
+    # Stop waiting for phase 2 requests
+    def kill(self):
+        self.killed = True
+        # Wake up the SM if it is waiting on its queue
+        if self.req_q is not None:
+            self.req_q.put_nowait(None)
 
     # NOTE: Override this in production
     def get_raw_measurement(self, round: int):
         return 1
 
-    def _listen(self):
+    # Runs `count` rounds, or rounds forever if `count` is None
+    def _run(self, count: int | None) -> Steps:
         # Start listening to incoming requests
-        self.req_q = self.net_mngr.listen(self.meta.sm_addresses[self.id])
+        self.req_q = yield Listen(self.meta.sm_addresses[self.id])
+        self._on_start()
+
+        # Wait for the right time to start operation
+        yield SleepUntil(self.meta.t_start)
+
+        for round in itertools.count() if count is None else range(count):
+            yield from self._run_single_round(round)
 
-    def _stop(self):
         # Stop listening to incoming requests
-        self.net_mngr.stop()
+        yield Stop()
+        self._on_stop()
 
-    def _run_single_round(self, round: int):
+    def _run_single_round(self, round: int) -> Steps:
         # Wait for the right time to start round
-        round_start = self.meta.t_start + self.meta.t_round_len * round
-        sleep(time.remaining_until(round_start))
+        yield SleepUntil(self._round_start(round))
 
-        self.reports.append(SMReport(id=self.id, t_start=now()))
+        self._start_round(round)
 
         passthru, data = self._prep_data(round)
 
-        ok = self._run_phase_1(round, data)
+        ok = yield from self._run_phase_1(round, data)
         if not ok:
-            self.reports[round].t_end = now()
+            self._end_round(round)
             return
 
-        self._run_phase_2(round, passthru)
-        self.reports[round].t_end = now()
+        yield from self._run_phase_2(round, passthru)
+        self._end_round(round)
         return
 
+    def _start_round(self, round: int):
+        self.reports.append(SMReport(id=self.id, t_start=self.clock.now()))
+
+    def _end_round(self, round: int):
+        self.reports[round].t_end = self.clock.now()
+        self.reports.emit(round)
+
     @abstractmethod
     def _prep_data(self, round: int) -> Tuple[Any, Any]:
         pass
 
-    def _run_phase_1(self, round: int, data) -> bool:
-        round_start = self.meta.t_start + self.meta.t_round_len * round
-        phase_1_end = round_start + self.meta.t_phase_1_len
-        req = {"id": self.id, "round": round, "data": data}
-        ok = self.net_mngr.send(self.meta.dc_address, req, phase_1_end)
-        if ok:
-            self.reports[round].net_snd_succ += 1
-            self.reports[round].net_snd_succ_size += len(json.dumps(req))
-        else:
-            self.reports[round].net_snd_fail += 1
-            self.reports[round].net_snd_fail_size += len(json.dumps(req))
+    # Returns whether the DC got our data
+    def _run_phase_1(self, round: int, data) -> Steps:
+        msg = Message.encode(
+            {"id": self.id, "round": round, "data": data}, self.meta.codec
+        )
+        ok = yield Send(self.meta.dc_address, msg, self._phase_1_end(round))
+        self._record_snd(round, msg, ok)
         return ok
 
-    def _run_phase_2(self, round: int, passthru):
-        round_start = self.meta.t_start + self.meta.t_round_len * round
-        phase_2_end = round_start + self.meta.t_round_len
+    def _run_phase_2(self, round: int, passthru) -> Steps:
+        phase_2_end = self._phase_2_end(round)
 
-        while now() < phase_2_end and not self.killed:
-            if self.req_q.empty():
-                sleep(0.1)
+        while self.clock.now() < phase_2_end and not self.killed:
+            msg = yield Get(phase_2_end)
+            if msg is None:
                 continue
-
-            req = self.req_q.get()
-            self.reports[round].net_rcv += 1
-            self.reports[round].net_rcv_size += len(json.dumps(req))
-
-            if self._is_phase_2_request_valid(round, req):
-                self.reports[round].activated = True
-                self._act_phase_2(round, req, passthru)
+            if self._handle_phase_2_request(round, msg):
+                start = self.clock.now()
+                yield from self._act_phase_2(round, msg.data, passthru)
+                self.metrics.observe(PHASE_2_HOP, self.clock.now() - start)
                 break
 
-    def _act_phase_2(self, round: int, req: Dict, passthru):
-        round_start = self.meta.t_start + self.meta.t_round_len * round
-        phase_2_end = round_start + self.meta.t_round_len
+    # Returns whether the request activated us
+    def _handle_phase_2_request(self, round: int, msg: Message) -> bool:
+        self._record_rcv(round, msg)
+
+        if not self._is_phase_2_request_valid(round, msg.data):
+            return False
+        self.reports[round].activated = True
+        return True
 
-        # Move ourself from remaining to acted
-        l_rem = tuple([sm for sm in req["l_rem"] if sm != self.id])
-        l_act = tuple(req["l_act"] + [self.id])
+    def _act_phase_2(self, round: int, req: Dict, passthru) -> Steps:
+        phase_2_end = self._phase_2_end(round)
 
-        s_new = self._aggregate_to_s(round, req, passthru)
+        l_rem, l_act, s_new = self._enter_phase_2(round, req, passthru)
+        chain = req.get("chain")
+        probed = Participants()
+        down = Participants()
 
         while not self._is_last(l_rem, l_act):
             # Don't exceed time limit
-            if now() >= phase_2_end:
+            if self.clock.now() >= phase_2_end:
                 return
-            next_sm = l_rem[0]
-            data = {"round": round, "s": s_new, "l_rem": l_rem, "l_act": l_act}
-            if self.meta.sm_addresses[next_sm].valid:
-                ok = self.net_mngr.send(
-                    self.meta.sm_addresses[next_sm],
-                    data,
-                    phase_2_end,
-                )
+            next_sm, passed = self._next_hop(round, l_rem)
+            # Probe the next SMs at once, and only send to reachable ones
+            if self.probe_width > 1 and next_sm not in probed:
+                hops = self._next_hops(round, l_rem)
+                addresses = [self.meta.sm_addresses[id] for id in hops]
+                first = yield Probe(addresses, phase_2_end)
+                probed, down = self._record_probe(round, hops, first, probed, down)
+            if self.meta.sm_addresses[next_sm].valid and next_sm not in down:
+                msg = self._phase_2_message(round, s_new, l_rem, l_act, chain)
+                ok = yield Send(self.meta.sm_addresses[next_sm], msg, phase_2_end)
+                self._record_snd(round, msg, ok)
+                self._record_hop(round, next_sm, ok, passed)
                 # We activated the next SM
                 if ok:
-                    self.reports[round].net_snd_succ += 1
-                    self.reports[round].net_snd_succ_size += len(json.dumps(data))
                     return
-                self.reports[round].net_snd_fail += 1
-                self.reports[round].net_snd_fail_size += len(json.dumps(data))
             # We couldn't activate next SM
             # Remove it from the remaining SMs before trying with another one
-            l_rem = l_rem[1:]
+            l_rem = l_rem.remove(next_sm)
 
         # Report to DC if we reached the minimum participating SMs
-        if len(l_act) >= self.meta.n_min and self.meta.dc_address.valid:
+        if self._should_report(l_act):
             # Don't exceed time limit
-            if now() >= phase_2_end:
+            if self.clock.now() >= phase_2_end:
                 return
-            data = {"round": round, "s": s_new, "l_rem": l_rem, "l_act": l_act}
-            ok = self.net_mngr.send(self.meta.dc_address, data, phase_2_end)
-            if ok:
-                self.reports[round].net_snd_succ += 1
-                self.reports[round].net_snd_succ_size += len(json.dumps(data))
-            else:
-                self.reports[round].net_snd_fail += 1
-                self.reports[round].net_snd_fail_size += len(json.dumps(data))
+            msg = self._phase_2_message(round, s_new, l_rem, l_act, chain)
+            ok = yield Send(self.meta.dc_address, msg, phase_2_end)
+            self._record_snd(round, msg, ok)
+
+    # Move ourself from remaining to acted, and add our data to the aggregate
+    def _enter_phase_2(
+        self, round: int, req: Dict, passthru
+    ) -> Tuple[Participants, Participants, Any]:
+        n = len(self.meta.sm_addresses)
+        l_rem = decode_ids(req["l_rem"], n).remove(self.id)
+        l_act = decode_ids(req["l_act"], n).add(self.id)
+        s_new = self._aggregate_to_s(round, req, passthru)
+        return l_rem, l_act, s_new
+
+    # `chain` is passed on as is, so the DC knows which chain the result is of
+    def _phase_2_message(
+        self,
+        round: int,
+        s_new,
+        l_rem: Participants,
+        l_act: Participants,
+        chain: int | None = None,
+    ) -> Message:
+        encoding = self.meta.id_encoding
+        data = {
+            "round": round,
+            "s": s_new,
+            "l_rem": encode_ids(l_rem, encoding, self.meta.codec),
+            "l_act": encode_ids(l_act, encoding, self.meta.codec),
+        }
+        if chain is not None:
+            data["chain"] = chain
+        return Message.encode(data, self.meta.codec)
+
+    def _should_report(self, l_act: Participants) -> bool:
+        return len(l_act) >= self.meta.n_min and self.meta.dc_address.valid
 
     @abstractmethod
     def _aggregate_to_s(self, round: int, req: Dict, passthru):
@@ -180,49 +254,68 @@ class SM(ABC):
         if req["round"] != round:
             return False
 
-        if not isinstance(req["l_rem"], list):
-            return False
-        if not isinstance(req["l_act"], list):
+        # IDs should be valid
+        n = len(self.meta.sm_addresses)
+        try:
+            l_rem = decode_ids(req["l_rem"], n)
+            l_act = decode_ids(req["l_act"], n)
+        except (TypeError, ValueError):
             return False
 
         # If we have an intersection, data is invalid
-        intersection = set(req["l_rem"]) & set(req["l_act"])
-        if len(intersection) > 0:
+        if not l_rem.isdisjoint(l_act):
             return False
 
         # We shouldn't be doing phase 2 if we didn't do phase 1
-        if self.id not in req["l_rem"]:
+        # We shouldn't be doing phase 2 if we already did it
+        if self.id not in l_rem or self.id in l_act:
             return False
 
-        for i in req["l_rem"]:
-            if i not in range(len(self.meta.sm_addresses)):
-                return False
-
-        for i in req["l_act"]:
-            if i not in range(len(self.meta.sm_addresses)):
-                return False
-            # We shouldn't be doing phase 2 if we already did it
-            if i == self.id:
-                return False
+        # Chain number is only there if the DC runs multiple chains
+        if "chain" in req and type(req["chain"]) is not int:
+            return False
 
         return True
 
-    def _is_last(self, l_rem: Tuple[int, ...], l_act: Tuple[int, ...]) -> bool:
+    def _is_last(self, l_rem: Participants, l_act: Participants) -> bool:
         return len(l_rem) == 0 or (len(l_rem) + len(l_act)) < self.meta.n_min
 
 
 # Masking SM
 # Concrete implemententation of SM
 class MaskingSM(SM):
-    def __init__(self, id: int, meta: SMMaskingMetadata, net_mngr: NetworkManager):
+    def __init__(
+        self,
+        id: int,
+        meta: SMMaskingMetadata,
+        net_mngr: NetworkManager,
+        *,
+        clock: time.Clock = time.REAL_CLOCK,
+        health: LinkHealth | None = None,
+        probe_width: int = 1,
+        reports: ReportLog | None = None,
+        metrics: Metrics = NO_METRICS,
+    ):
         if not is_valid_sm_masking_metadata(meta):
             raise ValueError("Invalid smart meter masking metadata.")
-        super().__init__(id, meta, net_mngr)
+        super().__init__(
+            id,
+            meta,
+            net_mngr,
+            clock=clock,
+            health=health,
+            probe_width=probe_width,
+            reports=reports,
+            metrics=metrics,
+        )
         self.meta = meta
+        # Own cipher, not evicted by the keys of other SMs in the process
+        self.prf_engine = crypto.PRFEngine(1)
 
     def _prep_data(self, round: int) -> Tuple[Any, Any]:
         s = secrets.randbelow(self.meta.k)
-        p = crypto.prf(self.meta.prf_key, round)
+        with self.metrics.timer(CRYPTO, op="prf"):
+            p = self.prf_engine.prf(self.meta.prf_key, round)
         masked = (self.get_raw_measurement(round) + s + p) % self.meta.k
         return s, masked
 
@@ -232,20 +325,108 @@ class MaskingSM(SM):
 
 # Homomorphic Encryption SM
 # Concrete implemententation of SM
-class HomomorphicSM(SM):
-    def __init__(self, id: int, meta: SMHomomorphicMetadata, net_mngr: NetworkManager):
+class HomomorphicSM(Obfuscating, SM):
+    def __init__(
+        self,
+        id: int,
+        meta: SMHomomorphicMetadata,
+        net_mngr: NetworkManager,
+        *,
+        clock: time.Clock = time.REAL_CLOCK,
+        obfuscators: crypto.ObfuscatorPool | None = None,
+        health: LinkHealth | None = None,
+        probe_width: int = 1,
+        reports: ReportLog | None = None,
+        metrics: Metrics = NO_METRICS,
+    ):
         if not is_valid_sm_homomorphic_metadata(meta):
             raise ValueError("Invalid smart meter homomorphic metadata.")
-        super().__init__(id, meta, net_mngr)
+        super().__init__(
+            id,
+            meta,
+            net_mngr,
+            clock=clock,
+            health=health,
+            probe_width=probe_width,
+            reports=reports,
+            metrics=metrics,
+        )
         self.meta = meta
+        self._use_obfuscators(meta.pk, obfuscators)
+
+    # Readings of the slots, with slot packing
+    # NOTE: Override this in production
+    def get_raw_measurements(self, round: int) -> Sequence[int]:
+        return [self.get_raw_measurement(round)] * self.meta.packing.slots
 
     def _prep_data(self, round: int) -> Tuple[Any, Any]:
         return None, None
 
     def _aggregate_to_s(self, round: int, req: Dict, passthru):
         agg = crypto.deserialize_homomorphic_number(req["s"], self.meta.pk)
-        new = self.meta.pk.encrypt(self.get_raw_measurement(round))
-        return crypto.serialize_homomorphic_number(agg + new)
+        if self.meta.packing is None:
+            m = self.get_raw_measurement(round)
+        else:
+            m = self.meta.packing.pack(self.get_raw_measurements(round))
+        with self.metrics.timer(CRYPTO, op="encrypt"):
+            new = self.obfuscators.encrypt(m)
+        # The sum is obfuscated by the new term
+        return crypto.serialize_homomorphic_number(
+            agg + new, be_secure=False, as_int=self.meta.codec == CODEC.BINARY
+        )
+
+
+################################################################################
+# Asynchronous Classes
+# Run the same rounds as the classes above as coroutines, over an
+# AsyncNetworkManager. Thousands of SMs can share one event loop.
+# NOTE:
+# These always run in real time, so they don't take a virtual clock.
+# Use the async factory method to make instances.
+################################################################################
+
+
+# Generic Async SM
+# Abstract Class - Use concrete implemententations
+class AsyncSM(SM):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Coroutines wait on the event loop, which only runs in real time
+        if isinstance(self.clock, time.VirtualClock):
+            raise ValueError("Async SMs can't run on a virtual clock.")
+        # Event loop the SM runs on
+        self.loop = None
+
+    async def run_forever(self):
+        self.loop = asyncio.get_running_loop()
+        await async_run_steps(self, self._run(None))
+
+    async def run_once(self):
+        await self.run_rounds(1)
+
+    async def run_rounds(self, count: int):
+        self.loop = asyncio.get_running_loop()
+        await async_run_steps(self, self._run(count))
+
+    # Stop waiting for phase 2 requests
+    # asyncio queues aren't thread-safe, so the wake up goes through the loop.
+    # This way, other threads can kill the SM too.
+    def kill(self):
+        self.killed = True
+        if self.req_q is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.req_q.put_nowait, None)
+
+
+# Async Masking SM
+# Concrete implemententation of AsyncSM
+class AsyncMaskingSM(AsyncSM, MaskingSM):
+    pass
+
+
+# Async Homomorphic Encryption SM
+# Concrete implemententation of AsyncSM
+class AsyncHomomorphicSM(AsyncSM, HomomorphicSM):
+    pass
 
 
 ################################################################################
@@ -255,8 +436,23 @@ class HomomorphicSM(SM):
 
 # Construct the correct type of SM based on the given metadata
 def make_sm(
-    id: int, meta: SMMaskingMetadata | SMHomomorphicMetadata, net_mngr: NetworkManager
+    id: int,
+    meta: SMMaskingMetadata | SMHomomorphicMetadata,
+    net_mngr: NetworkManager,
+    **kwargs,
 ) -> SM:
     if isinstance(meta, SMMaskingMetadata):
-        return MaskingSM(id, meta, net_mngr)
-    return HomomorphicSM(id, meta, net_mngr)
+        return MaskingSM(id, meta, net_mngr, **kwargs)
+    return HomomorphicSM(id, meta, net_mngr, **kwargs)
+
+
+# Construct the correct type of async SM based on the given metadata
+def make_async_sm(
+    id: int,
+    meta: SMMaskingMetadata | SMHomomorphicMetadata,
+    net_mngr: AsyncNetworkManager,
+    **kwargs,
+) -> AsyncSM:
+    if isinstance(meta, SMMaskingMetadata):
+        return AsyncMaskingSM(id, meta, net_mngr, **kwargs)
+    return AsyncHomomorphicSM(id, meta, net_mngr, **kwargs)
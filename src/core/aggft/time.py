@@ -1,4 +1,11 @@
-from time import time as now
+import asyncio
+import heapq
+import itertools
+import threading
+import time as _time
+from abc import ABC, abstractmethod
+from queue import Empty, Queue
+from typing import Any, Callable, Dict, List, Tuple
 
 ################################################################################
 # Types
@@ -6,11 +13,196 @@ from time import time as now
 
 Time = float
 
+################################################################################
+# Clocks
+################################################################################
+
+# DCs and SMs never read the time or sleep directly.
+# They go through a clock, so the same protocol code can run against real time
+# (production, threaded simulations) or a simulated time (fast simulations).
+
+
+class Clock(ABC):
+    # Current time (Unix Time)
+    @abstractmethod
+    def now(self) -> Time:
+        pass
+
+    # Block the calling actor for the given duration (seconds)
+    @abstractmethod
+    def sleep(self, duration: float) -> None:
+        pass
+
+    # Returns the time remaining until a specific point in time (Unix Time).
+    def remaining_until(self, time: Time) -> float:
+        return max(time - self.now(), 0)
+
+    # Block the calling actor until a specific point in time (Unix Time).
+    def sleep_until(self, time: Time) -> None:
+        self.sleep(self.remaining_until(time))
+
+    # Take the next item from a queue as soon as it arrives.
+    # Returns None if nothing arrived before the deadline (Unix Time).
+    @abstractmethod
+    def get(self, q: Queue, deadline: Time) -> Any:
+        pass
+
+    # Make a queue that `get` can wait on
+    def make_queue(self) -> Queue:
+        return Queue()
+
+
+# Wall-clock time.
+# Used by default.
+
+
+class RealClock(Clock):
+    def now(self) -> Time:
+        return _time.time()
+
+    def sleep(self, duration: float) -> None:
+        _time.sleep(duration)
+
+    def get(self, q: Queue, deadline: Time) -> Any:
+        try:
+            return q.get(timeout=self.remaining_until(deadline))
+        except Empty:
+            return None
+
+
+REAL_CLOCK = RealClock()
+
+
+# Simulated time driven by an event queue.
+#
+# Every actor (DC or SM) runs in its own thread, but only one actor runs at a
+# time. When the running actor sleeps, it schedules a wake-up event and hands
+# control back to the scheduler, which jumps the clock straight to the earliest
+# pending event. No real time is spent waiting, so a round takes as long as
+# its computations, regardless of the round and phase lengths.
+#
+# Actors waiting on a queue with `get` are woken up when an item is put in it.
+# This only works for queues made by `make_queue`.
+#
+# Usage:
+#   clock = VirtualClock(t_start)
+#   clock.spawn(dc.run_once)
+#   clock.spawn(sm.run_once)
+#   clock.run()
+
+
+class VirtualClock(Clock):
+    def __init__(self, start: Time = 0):
+        self._now = start
+        # Pending wake-ups as (time, sequence, event)
+        # The sequence number makes ordering deterministic for equal times.
+        self._events: List[Tuple[Time, int, threading.Event]] = []
+        self._seq = itertools.count()
+        # Set by the running actor when it gives control back
+        self._yielded = threading.Event()
+        # Wake-ups of actors waiting on queues
+        self._waiters: Dict[Queue, threading.Event] = {}
+
+    def now(self) -> Time:
+        return self._now
+
+    def sleep(self, duration: float) -> None:
+        wake = self._schedule(self._now + max(duration, 0))
+        self._yield()
+        wake.wait()
+
+    def get(self, q: Queue, deadline: Time) -> Any:
+        if q.empty() and self._now < deadline:
+            # Woken up by the deadline or by `_notify`, whichever comes first
+            wake = self._schedule(deadline)
+            self._waiters[q] = wake
+            self._yield()
+            wake.wait()
+            self._waiters.pop(q, None)
+        try:
+            return q.get_nowait()
+        except Empty:
+            return None
+
+    def make_queue(self) -> Queue:
+        return _VirtualQueue(self)
+
+    # Start a new actor at the current simulated time.
+    # The actor does not run before the scheduler gets to it in run().
+    def spawn(self, target: Callable[..., None], *args) -> threading.Thread:
+        wake = self._schedule(self._now)
+
+        def body():
+            wake.wait()
+            try:
+                target(*args)
+            finally:
+                self._yield()
+
+        thread = threading.Thread(target=body, daemon=True)
+        thread.start()
+        return thread
+
+    # Process events until none are left, or until the next event would happen
+    # after `until` (Unix Time).
+    def run(self, until: Time = float("inf")) -> None:
+        while len(self._events) > 0 and self._events[0][0] <= until:
+            time, _, wake = heapq.heappop(self._events)
+            # Already woken up by an earlier event
+            if wake.is_set():
+                continue
+            self._now = max(self._now, time)
+            self._yielded.clear()
+            wake.set()
+            self._yielded.wait()
+
+    def _schedule(self, time: Time) -> threading.Event:
+        wake = threading.Event()
+        heapq.heappush(self._events, (time, next(self._seq), wake))
+        return wake
+
+    def _yield(self) -> None:
+        self._yielded.set()
+
+    # Wake up the actor waiting on a queue, after the running actor yields
+    def _notify(self, q: Queue) -> None:
+        wake = self._waiters.pop(q, None)
+        if wake is not None:
+            heapq.heappush(self._events, (self._now, next(self._seq), wake))
+
+
+# Queue that wakes up actors waiting on it in a virtual clock
+
+
+class _VirtualQueue(Queue):
+    def __init__(self, clock: VirtualClock):
+        super().__init__()
+        self.clock = clock
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self.clock._notify(self)
+
+
 ################################################################################
 # Functions
 ################################################################################
 
 
 # Returns the time remaining until a specific point in time (Unix Time).
-def remaining_until(time: Time):
-    return max(time - now(), 0)
+def remaining_until(time: Time, clock: Clock = REAL_CLOCK):
+    return clock.remaining_until(time)
+
+
+# Suspend the calling coroutine until a specific point in time (Unix Time).
+async def async_sleep_until(time: Time, clock: Clock = REAL_CLOCK):
+    await asyncio.sleep(clock.remaining_until(time))
+
+
+# Take the next item from an asyncio queue as soon as it arrives.
+# Returns None if nothing arrived before the deadline (Unix Time).
+async def async_get(q: asyncio.Queue, deadline: Time, clock: Clock = REAL_CLOCK):
+    try:
+        return await asyncio.wait_for(q.get(), clock.remaining_until(deadline))
+    except asyncio.TimeoutError:
+        return None
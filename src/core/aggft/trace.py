@@ -0,0 +1,321 @@
+import asyncio
+import struct
+import threading
+from dataclasses import dataclass
+from enum import Enum
+from queue import Queue
+from typing import Callable, Iterator, List, Mapping, Sequence
+
+from .network import Address, AsyncNetworkManager, Message, NetworkManager
+from . import time
+
+################################################################################
+# Types
+################################################################################
+
+
+class TRACE_KIND(Enum):
+    SEND = 0
+    RECV = 1
+    PROBE = 2
+
+
+# Peer of received messages, if the message doesn't tell
+UNKNOWN_PEER = -2
+
+
+# One network event of a DC or SM
+# Peers are SM IDs, or -1 for the DC.
+@dataclass(frozen=True)
+class TraceRecord:
+    kind: TRACE_KIND
+
+    # Start time (Unix Time)
+    t: float
+
+    # Duration (seconds)
+    # Time the send or probe took. Zero for received messages.
+    dur: float
+
+    src: int
+    dst: int
+
+    # Message size (bytes)
+    size: int
+
+    # Sends: 1 if delivered, 0 otherwise
+    # Probes: Index of the first reachable address, or -1
+    # Received messages: 1
+    result: int
+
+    # Encoded message, for received messages only
+    payload: bytes = b""
+
+
+################################################################################
+# Trace Files
+################################################################################
+
+# Compact append-only binary log.
+# A magic header, followed by fixed-size records:
+#   kind (u8), t (f64), dur (f32), src (i32), dst (i32), size (u32),
+#   result (i32), payload length (u32)
+# each followed by its payload. A truncated last record (e.g. after a crash) is
+# ignored when reading.
+
+_MAGIC = b"AGGFTTR1"
+_RECORD = struct.Struct("<BdfiiIiI")
+
+
+# Thread-safe, so actors of one process can share a trace
+class TraceWriter:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(_MAGIC)
+
+    def write(self, r: TraceRecord):
+        header = _RECORD.pack(
+            r.kind.value, r.t, r.dur, r.src, r.dst, r.size, r.result, len(r.payload)
+        )
+        with self.lock:
+            self.file.write(header + r.payload)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+# Raises ValueError if the file is not a trace
+def read_trace(path: str) -> Iterator[TraceRecord]:
+    with open(path, "rb") as f:
+        buf = f.read()
+    if buf[: len(_MAGIC)] != _MAGIC:
+        raise ValueError("Not a trace file.")
+    pos = len(_MAGIC)
+    while pos + _RECORD.size <= len(buf):
+        kind, t, dur, src, dst, size, result, length = _RECORD.unpack_from(buf, pos)
+        pos += _RECORD.size
+        if pos + length > len(buf):
+            break
+        payload = buf[pos : pos + length]
+        pos += length
+        yield TraceRecord(TRACE_KIND(kind), t, dur, src, dst, size, result, payload)
+
+
+# Records of the actor with the given ID
+def actor_records(records: Sequence[TraceRecord], id: int) -> List[TraceRecord]:
+    return [
+        r
+        for r in records
+        if (r.kind == TRACE_KIND.RECV and r.dst == id)
+        or (r.kind != TRACE_KIND.RECV and r.src == id)
+    ]
+
+
+################################################################################
+# Peers
+################################################################################
+
+# IDs of the peers of an actor by address, from its metadata
+# SMs are their index in `sm_addresses`, and the DC is -1.
+# Addresses of other peers are recorded as UNKNOWN_PEER.
+Peers = Mapping[Address, int]
+
+
+def peer_ids(meta) -> Peers:
+    peers = {address: id for id, address in enumerate(meta.sm_addresses)}
+    peers[meta.dc_address] = -1
+    return peers
+
+
+################################################################################
+# Tracing Networking
+################################################################################
+
+
+# Wraps the network manager of the actor with ID `id` (-1 for the DC), to
+# record every send, probe and received message.
+# `peers` are the IDs of the peers by address, e.g. `peer_ids(meta)`.
+
+
+class TracingNetworkManager(NetworkManager):
+    def __init__(
+        self,
+        id: int,
+        net_mngr: NetworkManager,
+        writer: TraceWriter,
+        peers: Peers,
+        clock: time.Clock = time.REAL_CLOCK,
+    ):
+        self.id = id
+        self.net_mngr = net_mngr
+        self.writer = writer
+        self.peers = peers
+        self.clock = clock
+
+    def send(self, address: Address, msg: Message, deadline: float) -> bool:
+        start = self.clock.now()
+        ok = self.net_mngr.send(address, msg, deadline)
+        end = self.clock.now()
+        dst = self.peers.get(address, UNKNOWN_PEER)
+        self.writer.write(_send_record(self.id, start, end, dst, msg, ok))
+        return ok
+
+    def probe(self, addresses: Sequence[Address], deadline: float) -> int:
+        start = self.clock.now()
+        first = self.net_mngr.probe(addresses, deadline)
+        end = self.clock.now()
+        self.writer.write(_probe_record(self.id, start, end, first))
+        return first
+
+    def listen(self, address: Address) -> Queue:
+        return self.net_mngr.listen(address)
+
+    def stop(self) -> None:
+        self.net_mngr.stop()
+
+    def received(self, msg: Message) -> None:
+        self.writer.write(_recv_record(self.id, self.clock.now(), msg))
+        self.net_mngr.received(msg)
+
+
+class AsyncTracingNetworkManager(AsyncNetworkManager):
+    def __init__(
+        self, id: int, net_mngr: AsyncNetworkManager, writer: TraceWriter, peers: Peers
+    ):
+        self.id = id
+        self.net_mngr = net_mngr
+        self.writer = writer
+        self.peers = peers
+
+    async def send(self, address: Address, msg: Message, deadline: float) -> bool:
+        start = time.REAL_CLOCK.now()
+        ok = await self.net_mngr.send(address, msg, deadline)
+        end = time.REAL_CLOCK.now()
+        dst = self.peers.get(address, UNKNOWN_PEER)
+        self.writer.write(_send_record(self.id, start, end, dst, msg, ok))
+        return ok
+
+    async def probe(self, addresses: Sequence[Address], deadline: float) -> int:
+        start = time.REAL_CLOCK.now()
+        first = await self.net_mngr.probe(addresses, deadline)
+        end = time.REAL_CLOCK.now()
+        self.writer.write(_probe_record(self.id, start, end, first))
+        return first
+
+    async def listen(self, address: Address) -> asyncio.Queue:
+        return await self.net_mngr.listen(address)
+
+    async def stop(self) -> None:
+        await self.net_mngr.stop()
+
+    def received(self, msg: Message) -> None:
+        self.writer.write(_recv_record(self.id, time.REAL_CLOCK.now(), msg))
+        self.net_mngr.received(msg)
+
+
+def _send_record(id, start, end, dst: int, msg: Message, ok: bool):
+    return TraceRecord(TRACE_KIND.SEND, start, end - start, id, dst, msg.size, int(ok))
+
+
+def _probe_record(id, start, end, first: int):
+    return TraceRecord(TRACE_KIND.PROBE, start, end - start, id, -1, 0, first)
+
+
+def _recv_record(id, t, msg: Message):
+    # Only phase 1 messages tell their sender
+    src = msg.data.get("id", UNKNOWN_PEER)
+    if type(src) is not int:
+        src = UNKNOWN_PEER
+    return TraceRecord(TRACE_KIND.RECV, t, 0.0, src, id, msg.size, 1, msg.encoded)
+
+
+################################################################################
+# Replay
+################################################################################
+
+
+# Plays back the trace of one actor on a virtual clock.
+# Received messages arrive at their recorded times. Sends and probes take their
+# recorded time, and have their recorded outcome, in the recorded order.
+#
+# If the actor sends to another peer than recorded, or more than recorded, the
+# replay diverged: the send fails, and `diverged` is set.
+
+
+class ReplayNetworkManager(NetworkManager):
+    def __init__(
+        self, records: Sequence[TraceRecord], clock: time.VirtualClock, peers: Peers
+    ):
+        self.clock = clock
+        self.peers = peers
+        self.received_records = [r for r in records if r.kind == TRACE_KIND.RECV]
+        self.sent = iter([r for r in records if r.kind == TRACE_KIND.SEND])
+        self.probed = iter([r for r in records if r.kind == TRACE_KIND.PROBE])
+        self.queue = clock.make_queue()
+        self.diverged = False
+
+    def send(self, address: Address, msg: Message, _) -> bool:
+        r = next(self.sent, None)
+        if r is None or r.dst != self.peers.get(address, UNKNOWN_PEER):
+            self.diverged = True
+            return False
+        self.clock.sleep(r.dur)
+        return r.result == 1
+
+    def probe(self, addresses: Sequence[Address], _) -> int:
+        r = next(self.probed, None)
+        if r is None or r.result >= len(addresses):
+            self.diverged = True
+            return -1
+        self.clock.sleep(r.dur)
+        return r.result
+
+    def listen(self, address: Address) -> Queue:
+        return self.queue
+
+    def stop(self) -> None:
+        pass
+
+    # Runs on the virtual clock, next to the actor
+    def _feed(self):
+        for r in self.received_records:
+            self.clock.sleep_until(r.t)
+            self.queue.put(Message.decode(r.payload))
+
+
+# Re-run `rounds` rounds of the actor with ID `id` (-1 for the DC) from a trace.
+# Runs as fast as the CPU allows, and always gives the same results.
+#
+# `make_actor` makes the actor from a network manager and a clock, e.g.
+#   lambda net_mngr, clock: make_dc(meta, net_mngr, clock=clock)
+# `peers` are the IDs of the peers by address, as when tracing.
+# `start` is the time to start at, e.g. the t_start of the actor metadata. It
+# defaults to the first recorded event.
+#
+# Returns the actor, with its reports. The replay diverged if
+# `actor.net_mngr.diverged` is set.
+def replay(
+    records: Sequence[TraceRecord],
+    id: int,
+    make_actor: Callable[[NetworkManager, time.Clock], object],
+    peers: Peers,
+    rounds: int = 1,
+    start: float | None = None,
+):
+    records = actor_records(records, id)
+    if start is None:
+        start = records[0].t if records else 0.0
+    clock = time.VirtualClock(start)
+    net_mngr = ReplayNetworkManager(records, clock, peers)
+    actor = make_actor(net_mngr, clock)
+    clock.spawn(net_mngr._feed)
+    clock.spawn(actor.run_rounds, rounds)
+    clock.run()
+    return actor
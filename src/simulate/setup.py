@@ -13,6 +13,7 @@ setup(
             "aggft-sim=simulate.sim:main",
             "aggft-sim-fig=simulate.sim_figure:main",
             "aggft-headers=simulate.print_csv_headers:main",
+            "aggft-results=simulate.results:main",
         ],
     },
 )
@@ -0,0 +1,401 @@
+from collections import defaultdict
+from dataclasses import dataclass, fields
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from aggft.codec import CODEC
+from aggft.network import ID_ENCODING, Message, encode_ids
+from aggft.participants import Participants
+from aggft.report import DCReport, SMReport
+
+################################################################################
+# Analytic Round Evaluation
+################################################################################
+
+# Computes the outcome of a round from the topology alone, without running the
+# DC and SMs.
+#
+# With working links, a round is decided by the walk over the sorted l_rem that
+# the DC and the SMs do in phase 2. The evaluator does the same walk, as the
+# actors would with:
+#   - no link health cache and no probing (`probe-width` 1)
+#   - no deadline hit, e.g. on a virtual clock without latency
+# Times in the reports are those of such a run, relative to the round start.
+#
+# Message counts are exact. Message sizes are those of messages with values of
+# full width, e.g. `k - 1` for masking, so they are an upper bound of the real
+# ones, which are random.
+
+# All links exist
+ALL_VALID = defaultdict(lambda: True)
+
+
+# Sizes of the messages of a round
+@dataclass(frozen=True)
+class Messages:
+    # Value of phase 1 messages
+    data: Any
+
+    # Value of phase 2 messages
+    s: Any
+
+    codec: CODEC = CODEC.JSON
+    id_encoding: ID_ENCODING = ID_ENCODING.LIST
+
+    def phase_1(self, id: int) -> int:
+        data = {"id": id, "round": 0, "data": self.data}
+        return Message.encode(data, self.codec).size
+
+    def phase_2(self, l_rem: Participants, l_act: Participants, chain) -> int:
+        data = {
+            "round": 0,
+            "s": self.s,
+            "l_rem": encode_ids(l_rem, self.id_encoding, self.codec),
+            "l_act": encode_ids(l_act, self.id_encoding, self.codec),
+        }
+        if chain is not None:
+            data["chain"] = chain
+        return Message.encode(data, self.codec).size
+
+
+def masking_messages(k: int, **options) -> Messages:
+    return Messages(k - 1, k - 1, **options)
+
+
+# `key_len` is the length of the public key in bits
+def homomorphic_messages(key_len, codec: CODEC = CODEC.JSON, **options) -> Messages:
+    ciphertext = 2 ** (2 * key_len) - 1
+    if codec == CODEC.BINARY:
+        return Messages(None, (ciphertext, 0), codec, **options)
+    return Messages(None, (str(ciphertext), "0"), codec, **options)
+
+
+# Reports of the round, like the ones of `simulate_one`
+# `sm_reports` has None for broken SMs.
+def evaluate_round(
+    n,
+    n_min,
+    link_status,
+    sm_status,
+    messages: Messages,
+    phase_1_len,
+    round_len,
+    chains=1,
+    link_valid=ALL_VALID,
+) -> Tuple[DCReport, Tuple[SMReport | None, ...]]:
+    dc_report = DCReport()
+    sm_reports = [SMReport(id) if sm_status[id] else None for id in range(n)]
+
+    # Phase 1
+    l_rem = Participants()
+    for id in range(n):
+        if not sm_status[id]:
+            continue
+        ok = link_status[(id, -1)]
+        _record_snd(sm_reports[id], messages.phase_1(id), ok)
+        if ok:
+            _record_rcv(dc_report, messages.phase_1(id))
+            l_rem = l_rem.add(id)
+
+    dc_report.phase_1_count = len(l_rem)
+    dc_report.phase_1_sms = tuple(l_rem)
+    # The DC stops waiting once all SMs reported
+    dc_report.t_phase_1 = 0 if len(l_rem) == n else phase_1_len
+    dc_report.t_end = dc_report.t_phase_1
+
+    # Phase 2
+    if len(l_rem) >= n_min:
+        chain = _Chain(n_min, link_status, sm_status, messages, link_valid)
+        groups = _split_chains(l_rem, n_min, chains)
+        activated = 0
+        results = []
+        for i, members in enumerate(groups):
+            tag = i if len(groups) > 1 else None
+            ok, l_act = chain.run(dc_report, sm_reports, members, tag)
+            activated += ok
+            if l_act is not None:
+                results.append(l_act)
+        if results:
+            l_act = Participants()
+            for i in results:
+                l_act |= i
+            dc_report.success = True
+            dc_report.phase_2_count = len(l_act)
+            dc_report.phase_2_sms = tuple(l_act)
+        # Otherwise, the DC waits for the missing chains until the round end
+        if len(results) < activated:
+            dc_report.t_end = round_len
+
+    dc_report.terminated = True
+
+    # Activated SMs are done right away, and the others are stopped by the DC
+    for id in dc_report.phase_1_sms:
+        report = sm_reports[id]
+        report.t_end = dc_report.t_phase_1 if report.activated else dc_report.t_end
+
+    return dc_report, tuple(sm_reports)
+
+
+# Same as `DC._split_chains`
+def _split_chains(l_rem: Participants, n_min, chains) -> List[Participants]:
+    count = max(1, min(chains, len(l_rem) // n_min))
+    ids = list(l_rem)
+    bounds = [len(ids) * i // count for i in range(count + 1)]
+    return [Participants.of(ids[bounds[i] : bounds[i + 1]]) for i in range(count)]
+
+
+class _Chain:
+    def __init__(self, n_min, link_status, sm_status, messages, link_valid):
+        self.n_min = n_min
+        self.link_status = link_status
+        self.sm_status = sm_status
+        self.messages = messages
+        self.link_valid = link_valid
+
+    # Walk one phase 2 chain
+    # Returns whether an SM was activated, and the reported l_act, if any.
+    def run(self, dc_report, sm_reports, l_rem: Participants, tag):
+        l_act = Participants()
+
+        # The DC activates the first reachable SM
+        holder, l_rem = self._hop(dc_report, sm_reports, -1, l_rem, l_act, tag)
+        if holder is None:
+            return False, None
+
+        # Each SM passes the aggregate on to the next reachable one
+        while holder is not None:
+            sender = holder
+            report = sm_reports[sender]
+            report.activated = True
+            l_rem = l_rem.remove(sender)
+            l_act = l_act.add(sender)
+            holder, l_rem = self._hop(report, sm_reports, sender, l_rem, l_act, tag)
+
+        # The last SM reports to the DC, if enough SMs took part
+        if len(l_act) < self.n_min or not self.link_valid[(sender, -1)]:
+            return True, None
+        size = self.messages.phase_2(l_rem, l_act, tag)
+        ok = self.link_status[(sender, -1)]
+        _record_snd(report, size, ok)
+        if not ok:
+            return True, None
+        _record_rcv(dc_report, size)
+        return True, l_act
+
+    # Send to the first reachable SM of `l_rem`, as `sender` (-1 for the DC)
+    # Returns the activated SM, or None, and l_rem without the failed SMs.
+    def _hop(self, report, sm_reports, sender, l_rem, l_act, tag):
+        while l_rem:
+            # Same as `SM._is_last`
+            if sender != -1 and len(l_rem) + len(l_act) < self.n_min:
+                break
+            next = l_rem.first()
+            if self.link_valid[(sender, next)]:
+                size = self.messages.phase_2(l_rem, l_act, tag)
+                ok = self.link_status[(sender, next)] and self.sm_status[next]
+                _record_snd(report, size, ok)
+                if ok:
+                    _record_rcv(sm_reports[next], size)
+                    return next, l_rem
+            l_rem = l_rem.remove(next)
+        return None, l_rem
+
+
+def _record_snd(report, size, ok):
+    if ok:
+        report.net_snd_succ += 1
+        report.net_snd_succ_size += size
+    else:
+        report.net_snd_fail += 1
+        report.net_snd_fail_size += size
+
+
+def _record_rcv(report, size):
+    report.net_rcv += 1
+    report.net_rcv_size += size
+
+
+################################################################################
+# Batch Evaluation
+################################################################################
+
+# Evaluates a batch of rounds at once, one per topology.
+# Same walk as `evaluate_round`, with one chain, and all links existing.
+#
+# `links` is a (batch, n + 1, n + 1) array of topology matrices, and
+# `sm_status` a (batch, n) array. Returns arrays of message counts and
+# participants, by name:
+#   success, phase_1_count, phase_2_count: (batch,)
+#   dc_snd_succ, dc_snd_fail, dc_rcv: (batch,)
+#   phase_1_sms, phase_2_sms, activated: (batch, n) boolean masks
+#   sm_snd_succ, sm_snd_fail, sm_rcv: (batch, n)
+
+
+def evaluate_batch(links, sm_status, n_min) -> Dict[str, np.ndarray]:
+    links = np.asarray(links, dtype=bool)
+    sm_status = np.asarray(sm_status, dtype=bool)
+    batch, n = sm_status.shape
+    rows = np.arange(batch)
+
+    # Phase 1
+    phase_1 = sm_status & links[:, :n, -1]
+    sm_snd_succ = phase_1.astype(np.int64)
+    sm_snd_fail = (sm_status & ~phase_1).astype(np.int64)
+    sm_rcv = np.zeros((batch, n), dtype=np.int64)
+    dc_rcv = phase_1.sum(axis=1)
+    dc_snd_succ = np.zeros(batch, dtype=np.int64)
+    dc_snd_fail = np.zeros(batch, dtype=np.int64)
+
+    # Phase 2
+    # The holder of the aggregate walks l_rem, -1 while the DC holds it.
+    l_rem = phase_1.copy()
+    activated = np.zeros((batch, n), dtype=bool)
+    holder = np.full(batch, -1)
+    success = np.zeros(batch, dtype=bool)
+    walking = dc_rcv >= n_min
+    while walking.any():
+        rem = l_rem.sum(axis=1)
+        act = activated.sum(axis=1)
+        by_dc = holder == -1
+
+        # The DC found no SM to activate
+        walking &= ~(by_dc & (rem == 0))
+        # The holder is the last SM, and reports to the DC if it can
+        last = walking & ~by_dc & ((rem == 0) | (rem + act < n_min))
+        sender = holder[last]
+        reports = last.copy()
+        reports[last] = act[last] >= n_min
+        ok = reports & links[rows, holder, -1]
+        sm_snd_succ[rows[ok], holder[ok]] += 1
+        fail = reports & ~ok
+        sm_snd_fail[rows[fail], holder[fail]] += 1
+        dc_rcv += ok
+        success |= ok
+        walking &= ~last
+        if not walking.any():
+            break
+
+        # Send to the next SM of l_rem
+        w = rows[walking]
+        next = np.argmax(l_rem[w], axis=1)
+        sender = holder[w]
+        ok = links[w, sender, next] & sm_status[w, next]
+        l_rem[w, next] = False
+        by_dc = sender == -1
+        dc_snd_succ[w[by_dc & ok]] += 1
+        dc_snd_fail[w[by_dc & ~ok]] += 1
+        sm_snd_succ[w[~by_dc & ok], sender[~by_dc & ok]] += 1
+        sm_snd_fail[w[~by_dc & ~ok], sender[~by_dc & ~ok]] += 1
+        sm_rcv[w[ok], next[ok]] += 1
+        activated[w[ok], next[ok]] = True
+        holder[w[ok]] = next[ok]
+
+    phase_2 = activated & success[:, None]
+    return {
+        "success": success,
+        "phase_1_count": phase_1.sum(axis=1),
+        "phase_2_count": phase_2.sum(axis=1),
+        "dc_snd_succ": dc_snd_succ,
+        "dc_snd_fail": dc_snd_fail,
+        "dc_rcv": dc_rcv,
+        "phase_1_sms": phase_1,
+        "phase_2_sms": phase_2,
+        "activated": activated,
+        "sm_snd_succ": sm_snd_succ,
+        "sm_snd_fail": sm_snd_fail,
+        "sm_rcv": sm_rcv,
+    }
+
+
+################################################################################
+# Cross-Check
+################################################################################
+
+# Report fields the evaluator gets exactly
+_DC_FIELDS = [
+    "terminated",
+    "success",
+    "phase_1_count",
+    "phase_1_sms",
+    "phase_2_count",
+    "phase_2_sms",
+    "net_snd_succ",
+    "net_snd_fail",
+    "net_rcv",
+]
+_SM_FIELDS = ["id", "activated", "net_rcv", "net_snd_succ", "net_snd_fail"]
+_SIZE_FIELDS = ["net_snd_succ_size", "net_snd_fail_size", "net_rcv_size"]
+_TIME_FIELDS = ["t_phase_1", "t_end"]
+
+
+# Differences between the reports of the evaluator and of a simulation, as
+# readable strings. Empty if they agree.
+# Times are only compared if `times` is set, e.g. for simulations on a virtual
+# clock without latency. Sizes are checked to be upper bounds.
+def compare_reports(expected, actual, times=True) -> List[str]:
+    (exp_dc, exp_sms), (act_dc, act_sms) = expected, actual
+    diffs = _compare("DC", exp_dc, act_dc, _DC_FIELDS, times, act_dc.t_start)
+    if len(exp_sms) != len(act_sms):
+        return diffs + ["SM count differs"]
+    for id, (exp, act) in enumerate(zip(exp_sms, act_sms)):
+        if (exp is None) != (act is None):
+            diffs.append(f"SM {id}: broken differs")
+        elif exp is not None:
+            diffs += _compare(f"SM {id}", exp, act, _SM_FIELDS, times, act_dc.t_start)
+    return diffs
+
+
+# Differences between the batch evaluation of `topologies` and the reports of
+# `evaluate_round` for each, as readable strings. Empty if they agree.
+# Rounds have one chain, and all SMs have the same `sm_status`.
+def compare_batch(topologies, sm_status, n_min, reports) -> List[str]:
+    links = np.stack([i.matrix for i in topologies])
+    batch = evaluate_batch(links, np.tile(sm_status, (len(links), 1)), n_min)
+    diffs = []
+    for i, (dc, sms) in enumerate(reports):
+        expected = _batch_row(dc, sms)
+        for f, value in expected.items():
+            if not np.array_equal(batch[f][i], value):
+                diffs.append(f"Topology {i}: {f} {batch[f][i]} != {value}")
+    return diffs
+
+
+# Row of `evaluate_batch` with the outcome of the reports
+def _batch_row(dc: DCReport, sms) -> Dict[str, Any]:
+    def mask(ids):
+        return np.isin(np.arange(len(sms)), ids)
+
+    def count(f):
+        return np.array([0 if i is None else getattr(i, f) for i in sms])
+
+    return {
+        "success": dc.success,
+        "phase_1_count": dc.phase_1_count,
+        "phase_2_count": dc.phase_2_count,
+        "dc_snd_succ": dc.net_snd_succ,
+        "dc_snd_fail": dc.net_snd_fail,
+        "dc_rcv": dc.net_rcv,
+        "phase_1_sms": mask(dc.phase_1_sms),
+        "phase_2_sms": mask(dc.phase_2_sms),
+        "activated": mask([i.id for i in sms if i is not None and i.activated]),
+        "sm_snd_succ": count("net_snd_succ"),
+        "sm_snd_fail": count("net_snd_fail"),
+        "sm_rcv": count("net_rcv"),
+    }
+
+
+def _compare(name, exp, act, names, times, t_start) -> List[str]:
+    diffs = []
+    for f in names:
+        if getattr(exp, f) != getattr(act, f):
+            diffs.append(f"{name}: {f} {getattr(exp, f)!r} != {getattr(act, f)!r}")
+    for f in _SIZE_FIELDS:
+        if getattr(exp, f) < getattr(act, f):
+            diffs.append(f"{name}: {f} {getattr(exp, f)} < {getattr(act, f)}")
+    if times:
+        for f in [i for i in _TIME_FIELDS if i in {j.name for j in fields(exp)}]:
+            t = getattr(act, f) - t_start
+            if abs(getattr(exp, f) - t) > 1e-6:
+                diffs.append(f"{name}: {f} {getattr(exp, f)!r} != {t!r}")
+    return diffs
@@ -0,0 +1,164 @@
+import json, multiprocessing, os, random
+
+from functools import lru_cache
+
+from aggft import crypto
+
+################################################################################
+# Key Store
+################################################################################
+
+# Pools of pre-generated keys, cached on disk and served by index, so
+# simulations don't pay for key generation.
+#
+# Pools are kept per key length, in the files:
+#   homomorphic-{length}.json: The primes (p, q) of each Paillier keypair
+#   prf-{length}.bin: PRF keys, back to back
+# Pools only grow, and the keys of an index never change. So simulations with
+# the same index get the same keys, across runs and processes.
+
+
+def default_path():
+    cache = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache, "aggft", "keys")
+
+
+class KeyStore:
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self._keypairs = {}
+        self._prf_keys = {}
+
+    # Generate keypairs of `length` bits until the pool has `size` keypairs.
+    # Keypairs are generated over `processes` worker processes.
+    def fill_homomorphic(self, length, size, processes=1):
+        primes = self._load_primes(length)
+        missing = size - len(primes)
+        if missing <= 0:
+            return
+
+        lengths = [length] * missing
+        if processes == 1:
+            primes += map(_generate_primes, lengths)
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                primes += pool.imap(_generate_primes, lengths, chunksize=1)
+
+        path = self._file(f"homomorphic-{length}.json")
+        data = {"length": length, "primes": [[hex(p), hex(q)] for p, q in primes]}
+        _write(path, json.dumps(data).encode())
+        self._keypairs.pop(length, None)
+
+    # Generate PRF keys of `length` bytes until the pool has `count` keys
+    def fill_prf(self, length, count):
+        keys = self._load_prf_keys(length)
+        missing = count - len(keys) // length
+        if missing <= 0:
+            return
+
+        keys += b"".join(crypto.generate_prf_key(length) for _ in range(missing))
+
+        _write(self._file(f"prf-{length}.bin"), keys)
+        self._prf_keys.pop(length, None)
+
+    # Keypair number `index` of the pool of `length` bits, as (sk, pk)
+    # Indexes wrap around the pool.
+    def homomorphic_keypair(self, length, index):
+        if length not in self._keypairs:
+            self._keypairs[length] = [
+                _make_keypair(p, q) for p, q in self._load_primes(length)
+            ]
+        keypairs = self._keypairs[length]
+        if not keypairs:
+            raise RuntimeError(f"No homomorphic keys of length {length} in the store.")
+        return keypairs[index % len(keypairs)]
+
+    # Set number `index` of `n` distinct PRF keys of `length` bytes
+    # The pool is split into sets of `n` keys, and indexes wrap around them.
+    def prf_keys(self, length, n, index):
+        if length not in self._prf_keys:
+            self._prf_keys[length] = self._load_prf_keys(length)
+        keys = self._prf_keys[length]
+        sets = len(keys) // (length * n)
+        if sets == 0:
+            raise RuntimeError(
+                f"Less than {n} PRF keys of length {length} in the store."
+            )
+        start = index % sets * n
+        return [keys[i * length : (i + 1) * length] for i in range(start, start + n)]
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load_primes(self, length):
+        path = self._file(f"homomorphic-{length}.json")
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            data = json.load(f)
+        return [(int(p, 16), int(q, 16)) for p, q in data["primes"]]
+
+    def _load_prf_keys(self, length):
+        path = self._file(f"prf-{length}.bin")
+        if not os.path.exists(path):
+            return b""
+        with open(path, "rb") as f:
+            return f.read()
+
+
+def _generate_primes(length):
+    sk, _ = crypto.generate_homomorphic_keypair(length)
+    return sk.p, sk.q
+
+
+def _make_keypair(p, q):
+    pk = crypto.HomomorphicPublicKey(p * q)
+    return crypto.HomomorphicPrivateKey(pk, p, q), pk
+
+
+# Written at once, so readers never see a partial file
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+################################################################################
+# Specs
+################################################################################
+
+
+# Key store of a spec, or None if simulations generate their own keys
+# One store per process, so pools are loaded once.
+def spec_key_store(spec):
+    if spec["key-pool-size"] == 0:
+        return None
+    return _open(spec["key-cache"])
+
+
+@lru_cache(maxsize=None)
+def _open(path):
+    return KeyStore(path)
+
+
+# Fill the pools of a spec, for simulations of up to `n` SMs
+def fill_spec_pools(spec, n):
+    store = spec_key_store(spec)
+    if store is None:
+        return
+    size = spec["key-pool-size"]
+    if "mask" in spec["privacy-types"]:
+        store.fill_prf(spec["prf-key-len"], size * n)
+    if "encr" in spec["privacy-types"]:
+        store.fill_homomorphic(spec["homomorphic-key-len"], size, spec["processes"])
+
+
+# Deterministic pool index of each simulation of a job
+# Independent of the random state of the job, so pools don't change its
+# topologies.
+def key_indexes(seed):
+    rng = random.Random(f"{seed}:keys")
+    while True:
+        yield rng.getrandbits(32)
@@ -1,4 +1,9 @@
 def main():
+    print(*headers(), sep=",")
+
+
+# Column names of the simulation results, in order
+def headers():
     sm_stats_headers = stats_headers(
         ["WORKING_SM", "PHASE_1_SM", "PHASE_2_SM"],
         [
@@ -12,8 +17,7 @@ def main():
         ],
     )
 
-    # Print CSV Headers
-    print(
+    return [
         "N",
         "N_MIN_CONST",
         "N_MIN",
@@ -48,8 +52,8 @@ def main():
         "SM_WITH_MAX_SND_FAILS_RCV_SIZE",
         *sm_stats_headers,
         "ISSUES",
-        sep=",",
-    )
+        "WEIGHT",
+    ]
 
 
 def stats_headers(lists, funcs):
@@ -1,4 +1,15 @@
-def report(
+import numpy as np
+
+from .topology import Topology
+
+
+# Print the CSV row of a simulation
+def report(*args):
+    print(*report_row(*args), sep=",")
+
+
+# Compute the CSV row of a simulation
+def report_row(
     n,
     n_min_const,
     n_min,
@@ -13,24 +24,26 @@ def report(
     sm_status,
     dc_report,
     sm_reports,
+    weight=1,
 ):
     terminated = int(dc_report.terminated)
     success = int(dc_report.success)
     dc_time = dc_report.t_end - dc_report.t_start
     dc_time_p_1 = dc_report.t_phase_1 - dc_report.t_start
 
-    all_sms = set([i for i in range(n)])
+    links = link_matrix(link_status, n)
 
     phase_1_cnt = dc_report.phase_1_count
     phase_1_sms = dc_report.phase_1_sms
     phase_2_cnt = dc_report.phase_2_count
     phase_2_sms = dc_report.phase_2_sms
 
-    broken_sms = set([i for i in range(n) if not sm_status[i]])
-    unlink_sms = set(
-        [i for i in range(n) if all([not link_status[(i, j)] for j in range(-1, n)])]
-    )
-    discon_sms = broken_sms.union(unlink_sms)
+    in_phase_1 = id_mask(n, phase_1_sms)
+    in_phase_2 = id_mask(n, phase_2_sms)
+
+    broken_sms = ~np.asarray(sm_status, dtype=bool)
+    unlink_sms = ~links[:n].any(axis=1)
+    discon_sms = broken_sms | unlink_sms
 
     dc_net_snd_succ_count = dc_report.net_snd_succ
     dc_net_snd_succ_size = dc_report.net_snd_succ_size
@@ -44,7 +57,7 @@ def report(
         consecutive_fails = 0
         activated = phase_1_sms[0]
         for i in (*phase_1_sms[1:], -1):
-            if link_status[(activated, i)]:
+            if links[activated, i]:
                 activated = i
                 if consecutive_fails > max_consecutive_fails:
                     max_consecutive_fails = consecutive_fails
@@ -52,56 +65,53 @@ def report(
             else:
                 consecutive_fails += 1
 
-    sm_with_max_snd_fails = max(
-        [i for i in sm_reports if i], key=lambda i: i.net_snd_fail
-    )
-    sm_with_max_snd_fails_snd_succ = sm_with_max_snd_fails.net_snd_succ
-    sm_with_max_snd_fails_snd_succ_size = sm_with_max_snd_fails.net_snd_succ_size
-    sm_with_max_snd_fails_snd_fail = sm_with_max_snd_fails.net_snd_fail
-    sm_with_max_snd_fails_snd_fail_size = sm_with_max_snd_fails.net_snd_fail_size
-    sm_with_max_snd_fails_rcv = sm_with_max_snd_fails.net_rcv
-    sm_with_max_snd_fails_rcv_size = sm_with_max_snd_fails.net_rcv_size
-
-    working_reports = [i for i in sm_reports if i]
-    phase_1_reports = [i for i in sm_reports if i and i.id in phase_1_sms]
-    phase_2_reports = [i for i in sm_reports if i and i.id in phase_2_sms]
+    sms = sm_report_columns(sm_reports)
+
+    # First SM with the most failed sends
+    idx = np.argmax(sms["net_snd_fail"])
+    sm_with_max_snd_fails_snd_succ = sms["net_snd_succ"][idx]
+    sm_with_max_snd_fails_snd_succ_size = sms["net_snd_succ_size"][idx]
+    sm_with_max_snd_fails_snd_fail = sms["net_snd_fail"][idx]
+    sm_with_max_snd_fails_snd_fail_size = sms["net_snd_fail_size"][idx]
+    sm_with_max_snd_fails_rcv = sms["net_rcv"][idx]
+    sm_with_max_snd_fails_rcv_size = sms["net_rcv_size"][idx]
+
+    working = np.ones(len(sms["id"]), dtype=bool)
     sm_stats = stats(
-        [working_reports, phase_1_reports, phase_2_reports],
-        [
-            lambda i: i.t_end - i.t_start,
-            lambda i: i.net_snd_succ,
-            lambda i: i.net_snd_succ_size,
-            lambda i: i.net_snd_fail,
-            lambda i: i.net_snd_fail_size,
-            lambda i: i.net_rcv,
-            lambda i: i.net_rcv_size,
-        ],
+        [working, in_phase_1[sms["id"]], in_phase_2[sms["id"]]],
+        np.stack(
+            [
+                sms["total_time"],
+                sms["net_snd_succ"],
+                sms["net_snd_succ_size"],
+                sms["net_snd_fail"],
+                sms["net_snd_fail_size"],
+                sms["net_rcv"],
+                sms["net_rcv_size"],
+            ]
+        ),
     )
 
     # Check for issues
 
     # SMs that should not participate in phase 1, but participated
-    should_not_phase_1 = discon_sms.union(
-        set([i for i in range(n) if not link_status[(i, -1)]])
-    )
-    should_not_phase_1_part = sum([i in phase_1_sms for i in should_not_phase_1])
-    issue_should_not_phase_1 = 1 if should_not_phase_1_part > 0 else 0
+    should_not_phase_1 = discon_sms | ~links[:n, -1]
+    issue_should_not_phase_1 = 1 if (should_not_phase_1 & in_phase_1).any() else 0
 
     # SMs that should participate in phase 1, but did not
-    should_phase_1 = all_sms - should_not_phase_1
-    should_phase_1_no_part = sum([i not in phase_1_sms for i in should_phase_1])
-    issue_should_phase_1 = 2 if should_phase_1_no_part > 0 else 0
+    should_phase_1 = ~should_not_phase_1
+    issue_should_phase_1 = 2 if (should_phase_1 & ~in_phase_1).any() else 0
 
     # No SM should send more than two successful messages
-    sm_sent_more_than_2_succ = sum([i.net_snd_succ > 2 for i in sm_reports if i])
-    issue_sm_sent_more_than_2_succ = 4 if sm_sent_more_than_2_succ > 0 else 0
+    sm_sent_more_than_2_succ = (sms["net_snd_succ"] > 2).any()
+    issue_sm_sent_more_than_2_succ = 4 if sm_sent_more_than_2_succ else 0
 
     # Combine detected issues into a bitfield
     issues = (
         issue_should_not_phase_1 | issue_should_phase_1 | issue_sm_sent_more_than_2_succ
     )
 
-    print(
+    return [
         n,
         n_min_const,
         n_min,
@@ -118,9 +128,9 @@ def report(
         f"{dc_time_p_1:.2f}",
         phase_1_cnt,
         phase_2_cnt,
-        len(broken_sms),
-        len(unlink_sms),
-        len(discon_sms),
+        int(broken_sms.sum()),
+        int(unlink_sms.sum()),
+        int(discon_sms.sum()),
         dc_net_snd_succ_count,
         dc_net_snd_succ_size,
         dc_net_snd_fail_count,
@@ -128,38 +138,82 @@ def report(
         dc_net_rcv_count,
         dc_net_rcv_size,
         max_consecutive_fails,
-        sm_with_max_snd_fails_snd_succ,
-        sm_with_max_snd_fails_snd_succ_size,
-        sm_with_max_snd_fails_snd_fail,
-        sm_with_max_snd_fails_snd_fail_size,
-        sm_with_max_snd_fails_rcv,
-        sm_with_max_snd_fails_rcv_size,
+        int(sm_with_max_snd_fails_snd_succ),
+        int(sm_with_max_snd_fails_snd_succ_size),
+        int(sm_with_max_snd_fails_snd_fail),
+        int(sm_with_max_snd_fails_snd_fail_size),
+        int(sm_with_max_snd_fails_rcv),
+        int(sm_with_max_snd_fails_rcv_size),
         *sm_stats,
         issues,
-        sep=",",
-    )
-
-
-# Calculate the mean
-def avg(lst):
-    return sum(lst) / len(lst)
-
-
-# Calculate sample standard deviation
-def std(lst):
-    n = len(lst)
-    a = avg(lst)
-    return (sum((x - a) ** 2 for x in lst) / n) ** 0.5
-
-
-def stats(lists, funcs):
+        weight,
+    ]
+
+
+################################################################################
+# Report Data
+################################################################################
+
+
+# Link status as an (n + 1) x (n + 1) boolean matrix, laid out as in `Topology`
+# Other link statuses, e.g. dicts, are copied into one.
+def link_matrix(link_status, n):
+    if isinstance(link_status, Topology):
+        return link_status.matrix
+    ids = (*range(n), -1)
+    return np.array([[link_status[(i, j)] for j in ids] for i in ids], dtype=bool)
+
+
+# Boolean mask of the given IDs among n SMs
+def id_mask(n, ids):
+    mask = np.zeros(n, dtype=bool)
+    mask[list(ids)] = True
+    return mask
+
+
+# Reports of the working SMs, one array per field
+# Broken SMs have no report.
+def sm_report_columns(sm_reports):
+    reports = [i for i in sm_reports if i]
+    columns = {
+        "id": np.array([i.id for i in reports], dtype=np.int64),
+        "total_time": np.array([i.t_end - i.t_start for i in reports], dtype=float),
+    }
+    for field in (
+        "net_snd_succ",
+        "net_snd_succ_size",
+        "net_snd_fail",
+        "net_snd_fail_size",
+        "net_rcv",
+        "net_rcv_size",
+    ):
+        columns[field] = np.array([getattr(i, field) for i in reports], dtype=np.int64)
+    return columns
+
+
+################################################################################
+# Stats
+################################################################################
+
+
+# Max, min, mean and population standard deviation of each row of `columns`,
+# over the columns selected by each of `masks`
+def stats(masks, columns):
     res = []
-    for lst in lists:
-        for f in funcs:
-            lst_f = [f(i) for i in lst]
-            res.append(f"{max(lst_f):.2f}" if len(lst_f) > 0 else "N/A")
-            res.append(f"{min(lst_f):.2f}" if len(lst_f) > 0 else "N/A")
-            res.append(f"{avg(lst_f):.2f}" if len(lst_f) > 0 else "N/A")
-            res.append(f"{std(lst_f):.2f}" if len(lst_f) > 0 else "N/A")
+    for mask in masks:
+        values = columns[:, mask]
+        if values.shape[1] == 0:
+            res.extend(["N/A"] * 4 * len(columns))
+            continue
+        reduced = np.stack(
+            [
+                values.max(axis=1),
+                values.min(axis=1),
+                values.mean(axis=1),
+                values.std(axis=1),
+            ],
+            axis=1,
+        )
+        res.extend(f"{v:.2f}" for v in reduced.ravel().tolist())
 
     return res
@@ -0,0 +1,308 @@
+import argparse, glob, math, os, sys
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .print_csv_headers import headers
+
+################################################################################
+# Columns
+################################################################################
+
+# Every column of the results has a kind, that decides its type and its CSV
+# format. Columns that may be `N/A` are floats, with NaN for `N/A`.
+#   INT: Integers, e.g. counts and sizes
+#   BIG: Integers past 64 bits, as floats, e.g. weights. Exact for powers of
+#     two, like the weights of link groups, and up to 2**53 otherwise.
+#   TIME: Floats, formatted with two decimals, e.g. times and stats
+#   PARAM: Floats, formatted as the shortest string that reads back exactly,
+#     e.g. failure probabilities
+#   TEXT: Strings
+INT, BIG, TIME, PARAM, TEXT = "int", "big", "time", "param", "text"
+
+DTYPES = {
+    INT: np.int64,
+    BIG: np.float64,
+    TIME: np.float64,
+    PARAM: np.float64,
+    TEXT: np.str_,
+}
+
+# Kinds of the columns that are not INT
+_KINDS = {
+    "N_MIN_CONST": PARAM,
+    "PRIVACY_TYPE": TEXT,
+    "DC_LINK_FAIL_P": PARAM,
+    "SM_LINK_FAIL_P": PARAM,
+    "SM_FULL_FAIL_P": PARAM,
+    "DC_LINK_FAIL_E": PARAM,
+    "SM_LINK_FAIL_E": PARAM,
+    "SM_FULL_FAIL_E": PARAM,
+    "DC_TIME": TIME,
+    "DC_TIME_P_1": TIME,
+    "WEIGHT": BIG,
+}
+
+
+def _kind(name):
+    # SM stats, e.g. AVG_WORKING_SM_TOTAL_TIME
+    if name[:4] in ("MAX_", "MIN_", "AVG_", "STD_") and "_SM_" in name:
+        return TIME
+    return _KINDS.get(name, INT)
+
+
+# (name, kind) of every column, in CSV order
+COLUMNS = [(name, _kind(name)) for name in headers()]
+
+# Number of rows per batch
+DEFAULT_BATCH_SIZE = 10000
+
+FORMATS = ["csv", "npz", "parquet"]
+
+################################################################################
+# Writers
+################################################################################
+
+# Writes result rows, as returned by `report_row`.
+# Use as a context manager, so the last batch is flushed.
+
+
+class ResultsWriter(ABC):
+    @abstractmethod
+    def write(self, row):
+        pass
+
+    @abstractmethod
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# CSV lines, as documented in `docs/output.md`, without the headers
+class CSVWriter(ResultsWriter):
+    def __init__(self, file=sys.stdout):
+        self.file = file
+
+    def write(self, row):
+        print(*row, sep=",", file=self.file)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+# Typed columns, written to a directory in batches of `batch_size` rows.
+# Each batch is one part file, written at once, so readers never see a partial
+# part. Part files are numbered after the parts already in the directory, so
+# runs can add to the same results.
+class ColumnarWriter(ResultsWriter):
+    extension = ""
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = []
+        os.makedirs(path, exist_ok=True)
+        self.part = len(_parts(path, self.extension))
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = _to_columns(self.rows)
+        self.rows = []
+        path = os.path.join(self.path, f"part-{self.part:05d}{self.extension}")
+        tmp = f"{path}.tmp"
+        self._write_part(tmp, columns)
+        os.replace(tmp, path)
+        self.part += 1
+
+    @abstractmethod
+    def _write_part(self, path, columns):
+        pass
+
+
+class NpzWriter(ColumnarWriter):
+    extension = ".npz"
+
+    def _write_part(self, path, columns):
+        with open(path, "wb") as f:
+            np.savez_compressed(f, **columns)
+
+
+# Requires `pyarrow`
+class ParquetWriter(ColumnarWriter):
+    extension = ".parquet"
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        if pyarrow is None:
+            raise RuntimeError("Parquet results need the pyarrow package.")
+        super().__init__(path, batch_size)
+
+    def _write_part(self, path, columns):
+        pyarrow.parquet.write_table(pyarrow.table(columns), path)
+
+
+# Writes CSV to stdout when `path` is None
+def make_writer(format="csv", path=None, batch_size=DEFAULT_BATCH_SIZE):
+    if format == "csv":
+        if path is None:
+            return CSVWriter()
+        return CSVWriter(open(path, "a"))
+    if path is None:
+        raise ValueError(f"{format} results need an output path.")
+    if format == "npz":
+        return NpzWriter(path, batch_size)
+    return ParquetWriter(path, batch_size)
+
+
+def _to_columns(rows):
+    columns = {}
+    for i, (name, kind) in enumerate(COLUMNS):
+        values = [_parse(row[i], kind) for row in rows]
+        columns[name] = np.array(values, dtype=DTYPES[kind])
+    return columns
+
+
+def _parse(value, kind):
+    if kind == TEXT:
+        return str(value)
+    if value == "N/A":
+        return math.nan
+    if kind == INT:
+        return int(value)
+    return float(value)
+
+
+################################################################################
+# Readers
+################################################################################
+
+
+def _parts(path, extension):
+    return sorted(glob.glob(os.path.join(glob.escape(path), f"part-*{extension}")))
+
+
+# Columns of all the parts in a results directory, as NumPy arrays by name
+# Filter rows with boolean masks, e.g.
+#   res = load_results("out")
+#   ok = res["SUCCESS"][res["N"] == 100]
+def load_results(path):
+    parts = [np.load(p, allow_pickle=False) for p in _parts(path, ".npz")]
+    if pyarrow is not None:
+        for p in _parts(path, ".parquet"):
+            table = pyarrow.parquet.read_table(p)
+            parts.append({name: table[name].to_numpy() for name, _ in COLUMNS})
+    elif _parts(path, ".parquet"):
+        raise RuntimeError("Parquet results need the pyarrow package.")
+
+    if not parts:
+        return {name: np.array([], dtype=DTYPES[kind]) for name, kind in COLUMNS}
+    return {
+        name: np.concatenate([part[name] for part in parts]).astype(DTYPES[kind])
+        for name, kind in COLUMNS
+    }
+
+
+# CSV lines of columnar results, as documented in `docs/output.md`
+def export_csv(path, file=sys.stdout, header=True):
+    columns = load_results(path)
+    if header:
+        print(*headers(), sep=",", file=file)
+    formatted = [
+        [_format(v, kind) for v in columns[name].tolist()] for name, kind in COLUMNS
+    ]
+    for row in zip(*formatted):
+        print(*row, sep=",", file=file)
+
+
+def _format(value, kind):
+    if kind == TEXT or kind == INT:
+        return value
+    if math.isnan(value):
+        return "N/A"
+    if kind == BIG:
+        return int(value)
+    if kind == TIME:
+        return f"{value:.2f}"
+    return repr(value)
+
+
+################################################################################
+# Command Line
+################################################################################
+
+
+# Output options of `aggft-sim` and `aggft-sim-fig`
+def add_arguments(parser):
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        default="csv",
+        help="Format of the results. Defaults to CSV lines on stdout.",
+    )
+    parser.add_argument(
+        "--output",
+        help="Results directory for npz and parquet, or file to append CSV to.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of rows per part file of npz and parquet results.",
+    )
+
+
+def writer_from_args(args):
+    if args.format != "csv" and args.output is None:
+        sys.exit(f"ERROR: --output is required for {args.format} results.")
+    if args.format == "parquet" and pyarrow is None:
+        sys.exit("ERROR: parquet results need the pyarrow package.")
+    if args.batch_size < 1:
+        sys.exit("ERROR: --batch-size should be larger than or equal to 1.")
+    return make_writer(args.format, args.output, args.batch_size)
+
+
+# Export columnar results to CSV
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export columnar AggFT simulation results to CSV."
+    )
+
+    parser.add_argument(
+        "results",
+        help="Path to the results directory.",
+    )
+
+    parser.add_argument(
+        "--no-headers",
+        action="store_true",
+        help="Don't print the CSV headers.",
+    )
+
+    args = parser.parse_args()
+
+    export_csv(args.results, header=not args.no_headers)
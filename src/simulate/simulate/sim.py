@@ -1,12 +1,37 @@
-import argparse, json, random
+import argparse, json, multiprocessing, random
 
+from collections import namedtuple
 from itertools import product
 
-from .report import report
+import aggft
+
+from .analytic import (
+    compare_batch,
+    compare_reports,
+    evaluate_round,
+    homomorphic_messages,
+    masking_messages,
+)
+from .keystore import fill_spec_pools, key_indexes, spec_key_store
+from .report import report_row
+from .results import add_arguments, writer_from_args
 from .validate import validate_spec
 from .sim_one import simulate_one_mask, simulate_one_homomorphic
+from .topology import RecordingTopology, topology_from_status
 from .utils import generate_link_status, generate_sm_status
 
+################################################################################
+# Types
+################################################################################
+
+# A unit of work for the process pool.
+# Each job runs one simulation of one configuration.
+# `config` is a tuple of failure probabilities, or the index of a link failure
+# combination when `all-failure-possibilities` is set. It is None when all the
+# combinations are run in groups, by one job that runs each group
+# `simulations-per-config` times.
+Job = namedtuple("Job", ["seed", "n", "n_min_const", "privacy_type", "config"])
+
 
 def main():
     args = parse_args()
@@ -14,9 +39,8 @@ def main():
 
     validate_spec(spec)
 
-    random.seed(spec["random-seed"])
-
-    simulate(spec)
+    with writer_from_args(args) as writer:
+        simulate(spec, writer)
 
 
 def parse_args():
@@ -30,6 +54,8 @@ def parse_args():
         help=f"Path to the JSON specification file.",
     )
 
+    add_arguments(parser)
+
     return parser.parse_args()
 
 
@@ -37,7 +63,82 @@ def get_spec(args):
     return json.loads(args.spec.read())
 
 
-def simulate(spec):
+def simulate(spec, writer):
+    fill_spec_pools(spec, max(spec["sm-counts"]))
+    for rows in run_jobs(simulate_job, spec, jobs(spec)):
+        for row in rows:
+            writer.write(row)
+
+
+################################################################################
+# Process Pool
+################################################################################
+
+# Spec of the current worker process
+# Set once per worker, so jobs don't have to carry it.
+worker_spec = None
+
+
+def init_worker(spec):
+    global worker_spec
+    worker_spec = spec
+
+
+# Run jobs over `processes` worker processes.
+# Idle workers pull the next job from a shared queue, so a slow job (e.g. a
+# large `n`) doesn't hold back the others. Results are yielded in job order.
+def run_jobs(worker, spec, jobs):
+    if spec["processes"] == 1:
+        init_worker(spec)
+        yield from map(worker, jobs)
+        return
+
+    with multiprocessing.Pool(
+        spec["processes"], initializer=init_worker, initargs=(spec,)
+    ) as pool:
+        yield from pool.imap(worker, jobs, chunksize=1)
+
+
+# Deterministic seed of a job
+# Derived from the job parameters, so it doesn't depend on the scheduling or
+# on the other jobs in the spec.
+def job_seed(spec, *params):
+    return ":".join(map(str, (spec["random-seed"], *params)))
+
+
+################################################################################
+# Jobs
+################################################################################
+
+
+# Enumerate the simulation grid once.
+# Each configuration is repeated `simulations-per-config` times, with a
+# different seed each time. The number of processes only decides how many jobs
+# run at once.
+def jobs(spec):
+    grid = product(
+        spec["sm-counts"],
+        spec["n-min-constants"],
+        spec["privacy-types"],
+    )
+    for n, n_min_const, privacy_type in grid:
+        if spec["all-failure-possibilities"] and spec["group-failure-possibilities"]:
+            seed = job_seed(spec, n, n_min_const, privacy_type, None)
+            yield Job(seed, n, n_min_const, privacy_type, None)
+            continue
+        if spec["all-failure-possibilities"]:
+            configs = range(2 ** link_count(n))
+        else:
+            configs = failure_probabilities(spec)
+        repetitions = range(spec["simulations-per-config"])
+        for config, repetition in product(configs, repetitions):
+            seed = job_seed(spec, n, n_min_const, privacy_type, config, repetition)
+            yield Job(seed, n, n_min_const, privacy_type, config)
+
+
+def simulate_job(job):
+    spec = worker_spec
+
     if "mask" in spec["privacy-types"]:
         masking_modulus = spec["masking-modulus"]
         prf_key_len = spec["prf-key-len"]
@@ -46,131 +147,296 @@ def simulate(spec):
         homomorphic_key_len = spec["homomorphic-key-len"]
 
     startup_wait = spec["startup-wait"]
+    virtual_time = spec["virtual-time"]
+    net_kwargs = network_options(spec)
+    meta_kwargs = metadata_options(spec)
+    actor_kwargs = actor_options(spec)
     round_len_constant = spec["round-len-constant"]
     phase_1_len_constant = spec["phase-1-len-constant"]
 
+    n = job.n
+    n_min_const = job.n_min_const
+    privacy_type = job.privacy_type
+
+    # All the repetitions of a configuration share its topology
+    random.seed(job_seed(spec, n, n_min_const, privacy_type, job.config))
+
     if spec["all-failure-possibilities"]:
         dc_link_fail_exact = "N/A"
         sm_link_fail_exact = "N/A"
         sm_full_fail_exact = "N/A"
+        link_status, sm_status, *failure_probs = configuration(n, job.config)
     else:
-        zip_failure_probs = spec["zip-failure-probabilities"]
-        dc_link_fail_probs = spec["dc-link-failure-probabilities"]
-        sm_link_fail_probs = spec["sm-link-failure-probabilities"]
-        sm_full_fail_probs = spec["sm-full-failure-probabilities"]
         dc_link_fail_exact = spec["dc-link-failure-exact"]
         sm_link_fail_exact = spec["sm-link-failure-exact"]
         sm_full_fail_exact = spec["sm-full-failure-exact"]
+        link_status, sm_status, *failure_probs = some_configuration(
+            n,
+            *job.config,
+            dc_link_fail_exact,
+            sm_link_fail_exact,
+            sm_full_fail_exact,
+        )
 
-    props = product(
-        spec["sm-counts"],
-        spec["n-min-constants"],
-        spec["privacy-types"],
-    )
+    random.seed(job.seed)
 
-    for n, n_min_const, privacy_type in props:
-        if spec["all-failure-possibilities"]:
-            configs = all_configurations(n)
+    n_min = int(max(2, n_min_const * n))
+    dc_link_fail_p, sm_link_fail_p, sm_full_fail_p = failure_probs
+    round_len = max(2.0, round_len_constant * n)
+    phase_1_len = max(1.0, phase_1_len_constant * n)
+
+    # Message sizes of the analytic evaluator
+    if spec["analytic"]:
+        encoding = {
+            "codec": meta_kwargs["codec"],
+            "id_encoding": meta_kwargs["id_encoding"],
+        }
+        if privacy_type == "mask":
+            messages = masking_messages(masking_modulus, **encoding)
         else:
-            configs = some_configurations(
-                n,
-                zip_failure_probs,
-                dc_link_fail_probs,
-                sm_link_fail_probs,
-                sm_full_fail_probs,
-                dc_link_fail_exact,
-                sm_link_fail_exact,
-                sm_full_fail_exact,
+            messages = homomorphic_messages(homomorphic_key_len, **encoding)
+
+    # Analytic rounds of the job, to check the batch evaluator against
+    evaluated = []
+
+    def simulate_one(link_status):
+        if not spec["analytic"]:
+            return simulate_actors(link_status)
+        reports = evaluate_round(
+            n,
+            n_min,
+            link_status,
+            sm_status,
+            messages,
+            phase_1_len,
+            round_len,
+            meta_kwargs["chains"],
+        )
+        if spec["analytic-cross-check"]:
+            diffs = compare_reports(
+                reports, simulate_actors(link_status), times=exact_times(spec)
             )
-        for link_status, sm_status, *failure_probs in configs:
-            n_min = int(max(2, n_min_const * n))
-            dc_link_fail_p, sm_link_fail_p, sm_full_fail_p = failure_probs
-            round_len = max(2.0, round_len_constant * n)
-            phase_1_len = max(1.0, phase_1_len_constant * n)
-
-            for _ in range(spec["simulations-per-config"]):
-                if privacy_type == "mask":
-                    dc_report, sm_reports = simulate_one_mask(
-                        n,
-                        n_min,
-                        link_status,
-                        sm_status,
-                        startup_wait,
-                        round_len,
-                        phase_1_len,
-                        prf_key_len,
-                        masking_modulus,
-                    )
-                else:
-                    dc_report, sm_reports = simulate_one_homomorphic(
-                        n,
-                        n_min,
-                        link_status,
-                        sm_status,
-                        startup_wait,
-                        round_len,
-                        phase_1_len,
-                        homomorphic_key_len,
-                    )
-
-                report(
-                    n,
-                    n_min_const,
-                    n_min,
-                    privacy_type,
-                    dc_link_fail_p,
-                    sm_link_fail_p,
-                    sm_full_fail_p,
-                    dc_link_fail_exact,
-                    sm_link_fail_exact,
-                    sm_full_fail_exact,
-                    link_status,
-                    sm_status,
-                    dc_report,
-                    sm_reports,
+            if diffs:
+                raise RuntimeError(
+                    f"Analytic evaluation differs from the simulation of {job}: "
+                    + "; ".join(diffs)
                 )
+            evaluated.append((link_status, reports))
+        return reports
 
+    key_store = spec_key_store(spec)
+    key_index = key_indexes(job.seed)
 
-def some_configurations(
+    def simulate_actors(link_status):
+        keys = {}
+        if privacy_type == "mask":
+            if key_store is not None:
+                keys["prf_keys"] = key_store.prf_keys(prf_key_len, n, next(key_index))
+            return simulate_one_mask(
+                n,
+                n_min,
+                link_status,
+                sm_status,
+                startup_wait,
+                round_len,
+                phase_1_len,
+                prf_key_len,
+                masking_modulus,
+                virtual_time=virtual_time,
+                net_kwargs=net_kwargs,
+                meta_kwargs=meta_kwargs,
+                actor_kwargs=actor_kwargs,
+                **keys,
+            )
+        if key_store is not None:
+            keys["keypair"] = key_store.homomorphic_keypair(
+                homomorphic_key_len, next(key_index)
+            )
+        return simulate_one_homomorphic(
+            n,
+            n_min,
+            link_status,
+            sm_status,
+            startup_wait,
+            round_len,
+            phase_1_len,
+            homomorphic_key_len,
+            virtual_time=virtual_time,
+            net_kwargs=net_kwargs,
+            meta_kwargs=meta_kwargs,
+            actor_kwargs=actor_kwargs,
+            packing=slot_packing(spec, n),
+            **keys,
+        )
+
+    def row(link_status, reports, weight=1):
+        return report_row(
+            n,
+            n_min_const,
+            n_min,
+            privacy_type,
+            dc_link_fail_p,
+            sm_link_fail_p,
+            sm_full_fail_p,
+            dc_link_fail_exact,
+            sm_link_fail_exact,
+            sm_full_fail_exact,
+            link_status,
+            sm_status,
+            *reports,
+            weight,
+        )
+
+    rows = []
+    if link_status is None:
+        for link_status, reports, weight in link_groups(n, simulate_one):
+            rows.append(row(link_status, reports, weight))
+            for _ in range(spec["simulations-per-config"] - 1):
+                rows.append(row(link_status, simulate_one(link_status), weight))
+    else:
+        rows.append(row(link_status, simulate_one(link_status)))
+
+    # The batch evaluator only runs single chains
+    if evaluated and meta_kwargs["chains"] == 1:
+        topologies, reports = zip(*evaluated)
+        diffs = compare_batch(topologies, sm_status, n_min, reports)
+        if diffs:
+            raise RuntimeError(
+                f"Batch evaluation differs from the analytic evaluation of {job}: "
+                + "; ".join(diffs)
+            )
+
+    return rows
+
+
+# Whether simulations have the times of the analytic evaluator
+def exact_times(spec):
+    return (
+        spec["virtual-time"]
+        and spec["send-latency"] == 0
+        and spec["failed-send-latency"] == 0
+    )
+
+
+# Options of the shared memory network managers
+def network_options(spec):
+    return {
+        "zero_copy": spec["zero-copy"],
+        "latency": aggft.network.LatencyModel(
+            spec["send-latency"], spec["failed-send-latency"]
+        ),
+    }
+
+
+# Options of the DCs and SMs themselves
+def actor_options(spec):
+    return {
+        "probe_width": int(spec["probe-width"]),
+    }
+
+
+# Slot packing of the homomorphic rounds of n SMs, or None to aggregate one
+# reading per SM
+def slot_packing(spec, n):
+    if spec["homomorphic-slots"] == 1:
+        return None
+    return aggft.crypto.SlotPacking(
+        spec["homomorphic-slots"], spec["homomorphic-slot-bits"], n
+    )
+
+
+# Options of the DC and SM metadata
+def metadata_options(spec):
+    return {
+        "id_encoding": aggft.network.ID_ENCODING[spec["id-encoding"].upper()],
+        "codec": aggft.codec.CODEC[spec["codec"].upper()],
+        "chains": int(spec["phase-2-chains"]),
+    }
+
+
+################################################################################
+# Configurations
+################################################################################
+
+
+def failure_probabilities(spec):
+    dc_link_fail_probs = spec["dc-link-failure-probabilities"]
+    sm_link_fail_probs = spec["sm-link-failure-probabilities"]
+    sm_full_fail_probs = spec["sm-full-failure-probabilities"]
+
+    if spec["zip-failure-probabilities"]:
+        return list(zip(dc_link_fail_probs, sm_link_fail_probs, sm_full_fail_probs))
+
+    return list(product(dc_link_fail_probs, sm_link_fail_probs, sm_full_fail_probs))
+
+
+def some_configuration(
     n,
-    zip_failure_probs,
-    dc_link_fail_probs,
-    sm_link_fail_probs,
-    sm_full_fail_probs,
+    dc_link_fail_p,
+    sm_link_fail_p,
+    sm_full_fail_p,
     dc_link_fail_exact,
     sm_link_fail_exact,
     sm_full_fail_exact,
 ):
-    if zip_failure_probs:
-        all_failure_probs = list(
-            zip(dc_link_fail_probs, sm_link_fail_probs, sm_full_fail_probs)
-        )
-    else:
-        all_failure_probs = list(
-            product(dc_link_fail_probs, sm_link_fail_probs, sm_full_fail_probs)
-        )
+    link_status = generate_link_status(
+        n, dc_link_fail_p, sm_link_fail_p, dc_link_fail_exact, sm_link_fail_exact
+    )
+    sm_status = generate_sm_status(n, sm_full_fail_p, sm_full_fail_exact)
+    return link_status, sm_status, dc_link_fail_p, sm_link_fail_p, sm_full_fail_p
 
-    for dc_link_fail_p, sm_link_fail_p, sm_full_fail_p in all_failure_probs:
-        link_status = generate_link_status(
-            n, dc_link_fail_p, sm_link_fail_p, dc_link_fail_exact, sm_link_fail_exact
-        )
-        sm_status = generate_sm_status(n, sm_full_fail_p, sm_full_fail_exact)
-        yield link_status, sm_status, dc_link_fail_p, sm_link_fail_p, sm_full_fail_p
+
+# Number of links between the DC and SMs and between SMs
+def link_count(n):
+    return (n + 1) * n // 2
 
 
-def all_configurations(n):
+# The `idx`-th combination of link failures.
+# Combinations are ordered like `product(*([[0, 1]] * link_count(n)))`.
+# With `idx` None, there are no links yet, see `link_groups`.
+def configuration(n, idx):
     sm_status = [True] * n
-    all_link_status = product(*([[0, 1]] * ((n + 1) * n // 2)))
-    for s in all_link_status:
-        link_status = {}
-        link_idx = 0
-        for i in range(0, n):
-            link_status[(i, -1)] = link_status[(-1, i)] = s[link_idx]
-            link_idx += 1
-        for i in range(0, n):
-            for j in range(i + 1, n):
-                link_status[(i, j)] = link_status[(j, i)] = s[link_idx]
-                link_idx += 1
-        for i in range(-1, n):
-            link_status[(i, i)] = False
-        yield link_status, sm_status, "N/A", "N/A", "N/A"
+    if idx is None:
+        return None, sm_status, "N/A", "N/A", "N/A"
+    count = link_count(n)
+    s = [bool((idx >> (count - 1 - i)) & 1) for i in range(count)]
+    link_status = topology_from_status(n, s[:n], s[n:])
+    return link_status, sm_status, "N/A", "N/A", "N/A"
+
+
+# Run all combinations of link failures, in groups with the same protocol run.
+#
+# A round only depends on the links that the DC and SMs try, e.g. the links
+# between consecutive SMs of a phase 2 chain, and not on the others. So each
+# run is done with links that are not decided yet working, while recording the
+# links that are tried. All combinations that agree on the tried links have the
+# same run, and form one group. The other combinations are split into the
+# groups where the first k - 1 tried links agree, and the k-th one is flipped.
+# Those are explored in turn, until every combination is in one group.
+#
+# Requires runs that only depend on the links, i.e. a virtual clock.
+#
+# Yields the topology, the reports of the run, and the number of combinations
+# of each group. `simulate_one` runs one simulation of a topology.
+def link_groups(n, simulate_one):
+    count = link_count(n)
+    links = [(-1, i) for i in range(n)]
+    links += [(i, j) for i in range(n) for j in range(i + 1, n)]
+
+    # Link status of the links decided for the combinations left to explore
+    pending = [{}]
+    while pending:
+        decided = pending.pop()
+        s = [decided.get(link, True) for link in links]
+        link_status = RecordingTopology(topology_from_status(n, s[:n], s[n:]).matrix)
+        reports = simulate_one(link_status)
+
+        tried = list(link_status.looked_up)
+        yield link_status, reports, 2 ** (count - len(decided.keys() | tried))
+
+        prefix = dict(decided)
+        for link in tried:
+            ok = link_status.matrix.item(link)
+            if link not in decided:
+                pending.append({**prefix, link: not ok})
+            prefix[link] = ok
@@ -4,9 +4,14 @@ from itertools import product
 
 import aggft
 
-from .report import report
+from . import sim
+from .keystore import fill_spec_pools, key_indexes, spec_key_store
+from .report import report_row
+from .results import add_arguments, writer_from_args
+from .sim import job_seed, run_jobs
 from .validate import validate_fig_spec as validate_spec
 from .sim_one import simulate_one_mask, simulate_one_homomorphic
+from .topology import topology_from_links
 
 
 def main():
@@ -15,9 +20,8 @@ def main():
 
     validate_spec(spec)
 
-    random.seed(spec["random-seed"])
-
-    simulate(spec)
+    with writer_from_args(args) as writer:
+        simulate(spec, writer)
 
 
 def parse_args():
@@ -31,6 +35,8 @@ def parse_args():
         help=f"Path to the JSON specification file.",
     )
 
+    add_arguments(parser)
+
     return parser.parse_args()
 
 
@@ -38,7 +44,28 @@ def get_spec(args):
     return json.loads(args.spec.read())
 
 
-def simulate(spec):
+def simulate(spec, writer):
+    fill_spec_pools(spec, 4)
+    for rows in run_jobs(simulate_job, spec, jobs(spec)):
+        for row in rows:
+            writer.write(row)
+
+
+# Each job runs one simulation of a privacy type, which is repeated
+# `simulations-per-config` times
+def jobs(spec):
+    for privacy_type, repetition in product(
+        spec["privacy-types"], range(spec["simulations-per-config"])
+    ):
+        yield job_seed(spec, privacy_type, repetition), privacy_type
+
+
+def simulate_job(job):
+    spec = sim.worker_spec
+    seed, privacy_type = job
+
+    random.seed(seed)
+
     if "mask" in spec["privacy-types"]:
         masking_modulus = spec["masking-modulus"]
         prf_key_len = spec["prf-key-len"]
@@ -48,8 +75,10 @@ def simulate(spec):
 
     n = 4
     startup_wait = spec["startup-wait"]
-    round_len = spec["round-len"]
-    phase_1_len = spec["phase-1-len"]
+    virtual_time = spec["virtual-time"]
+    net_kwargs = sim.network_options(spec)
+    meta_kwargs = sim.metadata_options(spec)
+    actor_kwargs = sim.actor_options(spec)
     n_min_const = "N/A"
     n_min = spec["n-min"]
     failure_probs = ["N/A"] * 3
@@ -57,93 +86,107 @@ def simulate(spec):
     round_len = spec["round-len"]
     phase_1_len = spec["phase-1-len"]
     sm_status, link_status, link_valid = fig_topology()
-
-    for privacy_type in spec["privacy-types"]:
-        for _ in range(spec["simulations-per-config"]):
-            if privacy_type == "mask":
-                dc_report, sm_reports = simulate_one_mask(
-                    n,
-                    n_min,
-                    link_status,
-                    sm_status,
-                    startup_wait,
-                    round_len,
-                    phase_1_len,
-                    prf_key_len,
-                    masking_modulus,
-                    link_valid,
-                )
-            else:
-                dc_report, sm_reports = simulate_one_homomorphic(
-                    n,
-                    n_min,
-                    link_status,
-                    sm_status,
-                    startup_wait,
-                    round_len,
-                    phase_1_len,
-                    homomorphic_key_len,
-                    link_valid,
-                )
-
-            report(
-                n,
-                n_min_const,
-                n_min,
-                privacy_type,
-                *failure_probs,
-                *failure_exact,
-                link_status,
-                sm_status,
-                dc_report,
-                sm_reports,
+    key_store = spec_key_store(spec)
+    key_index = key_indexes(seed)
+
+    keys = {}
+    if privacy_type == "mask":
+        if key_store is not None:
+            keys["prf_keys"] = key_store.prf_keys(prf_key_len, n, next(key_index))
+        dc_report, sm_reports = simulate_one_mask(
+            n,
+            n_min,
+            link_status,
+            sm_status,
+            startup_wait,
+            round_len,
+            phase_1_len,
+            prf_key_len,
+            masking_modulus,
+            link_valid,
+            virtual_time,
+            net_kwargs,
+            meta_kwargs,
+            actor_kwargs,
+            **keys,
+        )
+    else:
+        if key_store is not None:
+            keys["keypair"] = key_store.homomorphic_keypair(
+                homomorphic_key_len, next(key_index)
             )
+        dc_report, sm_reports = simulate_one_homomorphic(
+            n,
+            n_min,
+            link_status,
+            sm_status,
+            startup_wait,
+            round_len,
+            phase_1_len,
+            homomorphic_key_len,
+            link_valid,
+            virtual_time,
+            net_kwargs,
+            meta_kwargs,
+            actor_kwargs,
+            packing=sim.slot_packing(spec, n),
+            **keys,
+        )
+
+    return [
+        report_row(
+            n,
+            n_min_const,
+            n_min,
+            privacy_type,
+            *failure_probs,
+            *failure_exact,
+            link_status,
+            sm_status,
+            dc_report,
+            sm_reports,
+        )
+    ]
 
 
 def fig_topology():
     n = 4
     sm_status = [True] * n
-    link_status = {}
-    link_valid = {}
-
-    # Links to DC
-    for i in range(0, n):
-        link_status[(i, -1)] = link_status[(-1, i)] = True
-    # All working but one
-    link_status[(3, -1)] = link_status[(-1, 3)] = False
-
-    # Links between SMs
-    for i in range(0, n):
-        for j in range(i + 1, n):
-            link_status[(i, j)] = link_status[(j, i)] = False
-    # All failed but four
-    link_status[(0, 2)] = link_status[(2, 0)] = True
-    link_status[(1, 2)] = link_status[(2, 1)] = True
-    link_status[(1, 3)] = link_status[(3, 1)] = True
-    link_status[(2, 3)] = link_status[(3, 2)] = True
-
-    # No loops
-    for i in range(-1, n):
-        link_status[(i, i)] = False
-
-    # Links to DC
-    # All valid (exist)
-    for i in range(0, n):
-        link_valid[(i, -1)] = link_valid[(-1, i)] = True
-
-    # Links between SMs
-    for i in range(0, n):
-        for j in range(i + 1, n):
-            link_valid[(i, j)] = link_valid[(j, i)] = False
-    # All failed but five
-    link_valid[(0, 1)] = link_valid[(1, 0)] = True
-    link_valid[(0, 2)] = link_valid[(2, 0)] = True
-    link_valid[(1, 2)] = link_valid[(2, 1)] = True
-    link_valid[(1, 3)] = link_valid[(3, 1)] = True
-    link_valid[(2, 3)] = link_valid[(3, 2)] = True
-
-    # No loops exist
-    for i in range(-1, n):
-        link_valid[(i, i)] = False
+
+    link_status = topology_from_links(
+        n,
+        [
+            # Links to DC
+            # All working but one
+            (0, -1),
+            (1, -1),
+            (2, -1),
+            # Links between SMs
+            # All failed but four
+            (0, 2),
+            (1, 2),
+            (1, 3),
+            (2, 3),
+        ],
+    )
+
+    link_valid = topology_from_links(
+        n,
+        [
+            # Links to DC
+            # All valid (exist)
+            (0, -1),
+            (1, -1),
+            (2, -1),
+            (3, -1),
+            # Links between SMs
+            # All missing but five
+            (0, 1),
+            (0, 2),
+            (1, 2),
+            (1, 3),
+            (2, 3),
+        ],
+    )
 
     return sm_status, link_status, link_valid
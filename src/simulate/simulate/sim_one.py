@@ -1,6 +1,7 @@
 import threading
 
 from collections import defaultdict
+from dataclasses import replace
 from time import time as now
 
 import aggft
@@ -23,8 +24,15 @@ def simulate_one_mask(
     prf_key_len,
     masking_modulus,
     link_valid=defaultdict(lambda: True),
+    virtual_time=False,
+    net_kwargs={},
+    meta_kwargs={},
+    actor_kwargs={},
+    prf_keys=None,
 ):
-    prf_keys = [aggft.crypto.generate_prf_key(prf_key_len) for _ in range(n)]
+    # Pre-generated keys, e.g. from a key store, skip key generation
+    if prf_keys is None:
+        prf_keys = [aggft.crypto.generate_prf_key(prf_key_len) for _ in range(n)]
 
     base_dc_meta = utils.base_dc_masking_meta(
         n_min, round_len, phase_1_len, masking_modulus, prf_keys
@@ -35,7 +43,17 @@ def simulate_one_mask(
     )
 
     return simulate_one(
-        n, link_status, sm_status, startup_wait, base_dc_meta, base_sm_meta, link_valid
+        n,
+        link_status,
+        sm_status,
+        startup_wait,
+        base_dc_meta,
+        base_sm_meta,
+        link_valid,
+        virtual_time,
+        actor_kwargs,
+        net_kwargs,
+        meta_kwargs,
     )
 
 
@@ -49,39 +67,85 @@ def simulate_one_homomorphic(
     phase_1_len,
     homomorphic_key_len,
     link_valid=defaultdict(lambda: True),
+    virtual_time=False,
+    net_kwargs={},
+    meta_kwargs={},
+    actor_kwargs={},
+    keypair=None,
+    packing=None,
 ):
-    sk, pk = aggft.crypto.generate_homomorphic_keypair(homomorphic_key_len)
-
-    base_dc_meta = utils.base_dc_homomorphic_meta(n_min, round_len, phase_1_len, sk, pk)
+    # Pre-generated keys, e.g. from a key store, skip key generation
+    if keypair is None:
+        keypair = aggft.crypto.generate_homomorphic_keypair(homomorphic_key_len)
+    sk, pk = keypair
+
+    # One obfuscator per encryption in the round, precomputed up front and
+    # shared by all actors, so the round only pays for cheap encryptions
+    obfuscators = aggft.crypto.ObfuscatorPool(pk, n + 1)
+    obfuscators.fill()
+
+    base_dc_meta = utils.base_dc_homomorphic_meta(
+        n_min, round_len, phase_1_len, sk, pk, packing
+    )
 
-    base_sm_meta = utils.base_sm_homomorphic_meta(n_min, round_len, phase_1_len, pk)
+    base_sm_meta = utils.base_sm_homomorphic_meta(
+        n_min, round_len, phase_1_len, pk, packing
+    )
 
     return simulate_one(
-        n, link_status, sm_status, startup_wait, base_dc_meta, base_sm_meta, link_valid
+        n,
+        link_status,
+        sm_status,
+        startup_wait,
+        base_dc_meta,
+        base_sm_meta,
+        link_valid,
+        virtual_time,
+        {"obfuscators": obfuscators, **actor_kwargs},
+        net_kwargs,
+        meta_kwargs,
     )
 
 
 def simulate_one(
-    n, link_status, sm_status, startup_wait, base_dc_meta, base_sm_meta, link_valid
+    n,
+    link_status,
+    sm_status,
+    startup_wait,
+    base_dc_meta,
+    base_sm_meta,
+    link_valid,
+    virtual_time=False,
+    actor_kwargs={},
+    net_kwargs={},
+    meta_kwargs={},
 ):
-    registry = utils.make_registry(n)
-
     test_start = now()
 
+    # Options shared by all actors, e.g. wire encodings
+    base_dc_meta = replace(base_dc_meta, **meta_kwargs)
+    base_sm_meta = utils.with_options(base_sm_meta, **meta_kwargs)
+
+    # With virtual time, actors take turns on a simulated clock instead of
+    # sleeping in parallel, so the simulation runs as fast as the CPU allows.
+    clock = aggft.time.VirtualClock(test_start) if virtual_time else None
+
+    registry = utils.make_registry(n, clock)
+
     dc = utils.dc_factory(
         n,
         test_start,
         startup_wait,
         base_dc_meta,
-        utils.make_net_mngr(-1, registry, link_status, sm_status),
+        utils.make_net_mngr(-1, registry, link_status, sm_status, clock, **net_kwargs),
         link_status,
         sm_status,
         link_valid,
+        clock,
+        **actor_kwargs,
     )
-    dc_thread = threading.Thread(target=dc.run_once)
 
     sms = []
-    sm_threads = []
     for id in range(n):
         # Don't create failed smart meters
         if not sm_status[id]:
@@ -93,26 +157,21 @@ def simulate_one(
             test_start,
             startup_wait,
             base_sm_meta(id),
-            utils.make_net_mngr(id, registry, link_status, sm_status),
+            utils.make_net_mngr(
+                id, registry, link_status, sm_status, clock, **net_kwargs
+            ),
             link_status,
             sm_status,
             link_valid,
+            clock,
+            **actor_kwargs,
         )
-        sm_thread = threading.Thread(target=sm.run_once)
-        sm_threads.append(sm_thread)
         sms.append(sm)
 
-    # Start all threads
-    dc_thread.start()
-    for thread in sm_threads:
-        thread.start()
-
-    # Wait for DC thread
-    dc_thread.join()
-    for sm in sms:
-        sm.killed = True
-    for thread in sm_threads:
-        thread.join()
+    if virtual_time:
+        run_virtual(clock, dc, sms)
+    else:
+        run_threaded(dc, sms)
 
     dc_report = dc.reports[0]
 
@@ -126,3 +185,34 @@ def simulate_one(
             sm_reports.append(None)
 
     return dc_report, tuple(sm_reports)
+
+
+def run_threaded(dc, sms):
+    dc_thread = threading.Thread(target=dc.run_once)
+    sm_threads = [threading.Thread(target=sm.run_once) for sm in sms]
+
+    # Start all threads
+    dc_thread.start()
+    for thread in sm_threads:
+        thread.start()
+
+    # Wait for DC thread
+    dc_thread.join()
+    for sm in sms:
+        sm.kill()
+    for thread in sm_threads:
+        thread.join()
+
+
+def run_virtual(clock, dc, sms):
+    def run_dc():
+        dc.run_once()
+        for sm in sms:
+            sm.kill()
+
+    clock.spawn(run_dc)
+    for sm in sms:
+        clock.spawn(sm.run_once)
+
+    # Returns once every actor finished its round
+    clock.run()
@@ -0,0 +1,73 @@
+from typing import Dict, Iterable, Sequence, Tuple
+
+import numpy as np
+
+################################################################################
+# Topology
+################################################################################
+
+# Status of the links between the DC and n SMs, as an (n + 1) x (n + 1) boolean
+# matrix. SMs are rows and columns 0 to n - 1, and the DC is the last one, so it
+# is at index -1, like its ID.
+#
+# Indexed like a dict of links, e.g. `topology[(i, -1)]` is the status of the
+# link from SM i to the DC, so it can be passed as the `link_status` of shared
+# memory network managers. Links to self are always failed.
+
+
+class Topology:
+    def __init__(self, matrix: np.ndarray):
+        self.matrix = matrix
+        self.n = len(matrix) - 1
+
+    def __getitem__(self, link: Tuple[int, int]) -> bool:
+        return self.matrix.item(link)
+
+    def __setitem__(self, link: Tuple[int, int], ok: bool):
+        self.matrix[link] = ok
+
+    # Status of the links from `id` to all others, indexed like the matrix
+    def links_from(self, id: int) -> np.ndarray:
+        return self.matrix[id]
+
+
+# Records the links that are looked up, in order of their first lookup
+# Links are recorded as (i, j) with i < j, since they work in both directions.
+# Lookups of the matrix itself are not recorded.
+class RecordingTopology(Topology):
+    def __init__(self, matrix: np.ndarray):
+        super().__init__(matrix)
+        self.looked_up: Dict[Tuple[int, int], None] = {}
+
+    def __getitem__(self, link: Tuple[int, int]) -> bool:
+        i, j = link
+        if i != j:
+            self.looked_up.setdefault((min(i, j), max(i, j)))
+        return self.matrix.item(link)
+
+
+def empty_topology(n: int) -> Topology:
+    return Topology(np.zeros((n + 1, n + 1), dtype=bool))
+
+
+# Topology where only the given links work, in both directions
+def topology_from_links(n: int, links: Iterable[Tuple[int, int]]) -> Topology:
+    topology = empty_topology(n)
+    for i, j in links:
+        topology[(i, j)] = topology[(j, i)] = True
+    np.fill_diagonal(topology.matrix, False)
+    return topology
+
+
+# Topology from the status of each link, in both directions
+# DC links come first, for SMs 0 to n - 1. Then SM links (i, j) with i < j, in
+# the order of i then j.
+def topology_from_status(
+    n: int, dc_links: Sequence[bool], sm_links: Sequence[bool]
+) -> Topology:
+    topology = empty_topology(n)
+    m = topology.matrix
+    m[:n, -1] = m[-1, :n] = dc_links
+    i, j = np.triu_indices(n, 1)
+    m[i, j] = m[j, i] = sm_links
+    return topology
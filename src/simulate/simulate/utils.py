@@ -1,27 +1,38 @@
 import random
 
 from dataclasses import replace
-from queue import Queue
-from typing import Dict, List, Tuple
+from typing import List
 
-from aggft import sm, dc, metadata, network
+import numpy as np
+
+from aggft import sm, dc, metadata, network, time
+
+from .topology import Topology, topology_from_status
 
 ################################################################################
 # Shared Memory Networking Helpers
 ################################################################################
 
 
-def make_registry(sm_count: int) -> network.Registry:
+def make_registry(sm_count: int, clock: time.Clock | None = None) -> network.Registry:
+    clock = clock or time.REAL_CLOCK
     registry = {}
     for i in range(-1, sm_count):
-        registry[("localhost", i)] = Queue()
+        registry[("localhost", i)] = clock.make_queue()
     return registry
 
 
 def make_net_mngr(
-    id, registry: network.Registry, link_status, sm_status
+    id,
+    registry: network.Registry,
+    link_status,
+    sm_status,
+    clock: time.Clock | None = None,
+    **kwargs,
 ) -> network.SharedMemoryNetworkManager:
-    return network.SharedMemoryNetworkManager(id, registry, link_status, sm_status)
+    return network.SharedMemoryNetworkManager(
+        id, registry, link_status, sm_status, clock=clock or time.REAL_CLOCK, **kwargs
+    )
 
 
 ################################################################################
@@ -29,48 +40,34 @@ def make_net_mngr(
 ################################################################################
 
 
+# Topology with random link failures
+# Draws come from a NumPy generator seeded from `random`, so they follow the
+# seed of the job.
 def generate_link_status(
     n, dc_link_fail_prob, sm_link_fail_prob, dc_link_fail_exact, sm_link_fail_exact
-):
-    status = {}
+) -> Topology:
+    rng = np.random.default_rng(random.getrandbits(64))
 
     # DC Links
-    if dc_link_fail_exact:
-        dc_link_fails = int(dc_link_fail_prob * n)
-        dc_link_status = [False] * dc_link_fails + [True] * (n - dc_link_fails)
-        random.shuffle(dc_link_status)
-    else:
-        dc_link_status = [
-            False if random.random() <= dc_link_fail_prob else True for _ in range(n)
-        ]
-
-    for i in range(0, n):
-        status[(i, -1)] = status[(-1, i)] = dc_link_status[i]
+    dc_link_status = _draw_links(rng, n, dc_link_fail_prob, dc_link_fail_exact)
 
     # SM Links
-    sm_link_count = int(n * (n - 1) / 2)
-    if sm_link_fail_exact:
-        sm_link_fails = int(sm_link_fail_prob * sm_link_count)
-        sm_link_status = [False] * sm_link_fails + [True] * (
-            sm_link_count - sm_link_fails
-        )
-        random.shuffle(sm_link_status)
-    else:
-        sm_link_status = [
-            False if random.random() <= sm_link_fail_prob else True
-            for _ in range(sm_link_count)
-        ]
+    sm_link_count = n * (n - 1) // 2
+    sm_link_status = _draw_links(
+        rng, sm_link_count, sm_link_fail_prob, sm_link_fail_exact
+    )
 
-    sm_link_idx = 0
-    for i in range(0, n):
-        for j in range(i + 1, n):
-            status[(i, j)] = status[(j, i)] = sm_link_status[sm_link_idx]
-            sm_link_idx += 1
+    return topology_from_status(n, dc_link_status, sm_link_status)
 
-    # No Loops
-    for i in range(-1, n):
-        status[(i, i)] = False
 
+# Status of `count` links failing with probability `fail_prob`
+# With `exact`, exactly int(fail_prob * count) of them fail.
+def _draw_links(rng, count, fail_prob, exact) -> np.ndarray:
+    if not exact:
+        return rng.random(count) > fail_prob
+    status = np.ones(count, dtype=bool)
+    status[: int(fail_prob * count)] = False
+    rng.shuffle(status)
     return status
 
 
@@ -123,7 +120,7 @@ def base_sm_masking_meta(n_min, round_len, phase_1_len, masking_modulus, prf_key
     return inner
 
 
-def base_dc_homomorphic_meta(n_min, round_len, phase_1_len, sk, pk):
+def base_dc_homomorphic_meta(n_min, round_len, phase_1_len, sk, pk, packing=None):
     return metadata.DCHomomorphicMetadata(
         metadata.AGGFT_MODE.HOMOMORPHIC,
         None,  # Will be set by the DC factory
@@ -134,10 +131,11 @@ def base_dc_homomorphic_meta(n_min, round_len, phase_1_len, sk, pk):
         phase_1_len,
         pk,
         sk,
+        packing=packing,
     )
 
 
-def base_sm_homomorphic_meta(n_min, round_len, phase_1_len, pk):
+def base_sm_homomorphic_meta(n_min, round_len, phase_1_len, pk, packing=None):
     def inner(_: int):
         return metadata.SMHomomorphicMetadata(
             metadata.AGGFT_MODE.HOMOMORPHIC,
@@ -148,11 +146,20 @@ def base_sm_homomorphic_meta(n_min, round_len, phase_1_len, pk):
             round_len,
             phase_1_len,
             pk,
+            packing=packing,
         )
 
     return inner
 
 
+# Apply options to the base metadata of all SMs
+def with_options(base_sm_meta, **kwargs):
+    def inner(id: int):
+        return replace(base_sm_meta(id), **kwargs)
+
+    return inner
+
+
 ################################################################################
 # DC / SM Factories
 ################################################################################
@@ -164,9 +171,11 @@ def dc_factory(
     startup_wait: float,
     base_meta: metadata.DCMaskingMetadata | metadata.DCHomomorphicMetadata,
     net_mngr: network.NetworkManager,
-    link_status: Dict[Tuple[int, int], bool],
+    link_status: Topology,
     sm_status: List[bool],
     link_valid,
+    clock: time.Clock | None = None,
+    **kwargs,
 ) -> dc.DC:
     dc_addr = network.Address("localhost", -1, link_valid[(-1, -1)])
 
@@ -179,7 +188,7 @@ def dc_factory(
         t_start=test_start + startup_wait,
     )
 
-    return dc.make_dc(meta, net_mngr)
+    return dc.make_dc(meta, net_mngr, clock=clock or time.REAL_CLOCK, **kwargs)
 
 
 def sm_factory(
@@ -189,9 +198,11 @@ def sm_factory(
     startup_wait: float,
     base_meta: metadata.SMMaskingMetadata | metadata.SMHomomorphicMetadata,
     net_mngr: network.NetworkManager,
-    link_status: Dict[Tuple[int, int], bool],
+    link_status: Topology,
     sm_status: List[bool],
     link_valid,
+    clock: time.Clock | None = None,
+    **kwargs,
 ) -> sm.SM:
     dc_addr = network.Address("localhost", -1, link_valid[(id, -1)])
 
@@ -204,4 +215,4 @@ def sm_factory(
         t_start=test_start + startup_wait,
     )
 
-    return sm.make_sm(id, meta, net_mngr)
+    return sm.make_sm(id, meta, net_mngr, clock=clock or time.REAL_CLOCK, **kwargs)
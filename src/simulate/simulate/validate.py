@@ -55,6 +55,10 @@ def validate_spec(spec):
         require(spec, key)
         require_bool(spec, key)
 
+    key = "group-failure-possibilities"
+    optional(spec, key, False)
+    require_bool(spec, key)
+
     key = "privacy-types"
     require(spec, key)
     require_list_of_enum(spec, key, ["mask", "encr"])
@@ -74,10 +78,83 @@ def validate_spec(spec):
         require(spec, key)
         require_int_leq(spec, key, 1)
 
+    key = "homomorphic-slots"
+    optional(spec, key, 1)
+    require_int_leq(spec, key, 1)
+
+    key = "homomorphic-slot-bits"
+    optional(spec, key, 32)
+    require_int_leq(spec, key, 1)
+
+    # Sums of all SMs should fit in a plaintext, which has at least as many
+    # bits as the key, minus 3
+    if "encr" in spec["privacy-types"] and spec["homomorphic-slots"] > 1:
+        slot_bits = spec[key] + (max(spec["sm-counts"]) - 1).bit_length()
+        if spec["homomorphic-slots"] * slot_bits > spec["homomorphic-key-len"] - 3:
+            sys.exit("ERROR: homomorphic-slots don't fit in homomorphic-key-len.")
+
+    key = "key-pool-size"
+    optional(spec, key, 0)
+    require_int_leq(spec, key, 0)
+
+    key = "key-cache"
+    optional(spec, key, None)
+    if spec[key] is not None and not is_str(spec[key]):
+        sys.exit(f"ERROR: {key} is not a string.")
+
     key = "startup-wait"
     require(spec, key)
     require_float_l(spec, key, 0)
 
+    key = "virtual-time"
+    optional(spec, key, False)
+    require_bool(spec, key)
+
+    if spec["group-failure-possibilities"] and not spec[key]:
+        sys.exit("ERROR: group-failure-possibilities requires virtual-time.")
+
+    key = "zero-copy"
+    optional(spec, key, False)
+    require_bool(spec, key)
+
+    key = "send-latency"
+    optional(spec, key, 0.0)
+    require_float_leq(spec, key, 0)
+
+    key = "failed-send-latency"
+    optional(spec, key, 0.0)
+    require_float_leq(spec, key, 0)
+
+    key = "id-encoding"
+    optional(spec, key, "list")
+    require_enum(spec, key, ["list", "bitmap", "ranges", "compact"])
+
+    key = "codec"
+    optional(spec, key, "json")
+    require_enum(spec, key, ["json", "binary"])
+
+    key = "phase-2-chains"
+    optional(spec, key, 1)
+    require_int_leq(spec, key, 1)
+
+    key = "probe-width"
+    optional(spec, key, 1)
+    require_int_leq(spec, key, 1)
+
+    key = "analytic"
+    optional(spec, key, False)
+    require_bool(spec, key)
+
+    if spec[key] and spec["probe-width"] != 1:
+        sys.exit("ERROR: analytic requires a probe-width of 1.")
+
+    key = "analytic-cross-check"
+    optional(spec, key, False)
+    require_bool(spec, key)
+
+    if spec[key] and not spec["analytic"]:
+        sys.exit("ERROR: analytic-cross-check requires analytic.")
+
     key = "round-len-constant"
     require(spec, key)
     require_float_l(spec, key, 0)
@@ -126,10 +203,66 @@ def validate_fig_spec(spec):
         require(spec, key)
         require_int_leq(spec, key, 1)
 
+    key = "homomorphic-slots"
+    optional(spec, key, 1)
+    require_int_leq(spec, key, 1)
+
+    key = "homomorphic-slot-bits"
+    optional(spec, key, 32)
+    require_int_leq(spec, key, 1)
+
+    # Sums of all SMs should fit in a plaintext, which has at least as many
+    # bits as the key, minus 3
+    if "encr" in spec["privacy-types"] and spec["homomorphic-slots"] > 1:
+        slot_bits = spec[key] + (4 - 1).bit_length()
+        if spec["homomorphic-slots"] * slot_bits > spec["homomorphic-key-len"] - 3:
+            sys.exit("ERROR: homomorphic-slots don't fit in homomorphic-key-len.")
+
+    key = "key-pool-size"
+    optional(spec, key, 0)
+    require_int_leq(spec, key, 0)
+
+    key = "key-cache"
+    optional(spec, key, None)
+    if spec[key] is not None and not is_str(spec[key]):
+        sys.exit(f"ERROR: {key} is not a string.")
+
     key = "startup-wait"
     require(spec, key)
     require_float_l(spec, key, 0)
 
+    key = "virtual-time"
+    optional(spec, key, False)
+    require_bool(spec, key)
+
+    key = "zero-copy"
+    optional(spec, key, False)
+    require_bool(spec, key)
+
+    key = "send-latency"
+    optional(spec, key, 0.0)
+    require_float_leq(spec, key, 0)
+
+    key = "failed-send-latency"
+    optional(spec, key, 0.0)
+    require_float_leq(spec, key, 0)
+
+    key = "id-encoding"
+    optional(spec, key, "list")
+    require_enum(spec, key, ["list", "bitmap", "ranges", "compact"])
+
+    key = "codec"
+    optional(spec, key, "json")
+    require_enum(spec, key, ["json", "binary"])
+
+    key = "phase-2-chains"
+    optional(spec, key, 1)
+    require_int_leq(spec, key, 1)
+
+    key = "probe-width"
+    optional(spec, key, 1)
+    require_int_leq(spec, key, 1)
+
     key = "round-len"
     require(spec, key)
     require_float_leq(spec, key, 2)
@@ -178,6 +311,12 @@ def require(spec, key):
         sys.exit(f"ERROR: {key} not found in spec.")
 
 
+# Use a default value if an optional key is not defined in the spec
+def optional(spec, key, default):
+    if key not in spec:
+        spec[key] = default
+
+
 # Require value to be a boolean
 def require_bool(spec, key):
     if not is_bool(spec[key]):
@@ -246,6 +385,14 @@ def require_list_of_probability(spec, key):
         spec[key][i] = float(spec[key][i])
 
 
+# Require value to be a string with finite allowed values
+def require_enum(spec, key, values):
+    if not is_str(spec[key]):
+        sys.exit(f"ERROR: {key} is not a string.")
+    if spec[key] not in values:
+        sys.exit(f"ERROR: {key} should be in {values}.")
+
+
 # Require value to be a list of strings with finite allowed values
 def require_list_of_enum(spec, key, values):
     if not is_list(spec[key]):
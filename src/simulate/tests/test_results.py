@@ -0,0 +1,46 @@
+import io
+
+from simulate.results import COLUMNS, INT, TEXT, NpzWriter, export_csv, load_results
+
+
+def make_row(weight):
+    row = []
+    for name, kind in COLUMNS:
+        if name == "WEIGHT":
+            row.append(weight)
+        elif kind == TEXT:
+            row.append("mask")
+        elif kind == INT:
+            row.append(1)
+        else:
+            row.append("0.50")
+    return row
+
+
+def test_weight_past_64_bits(tmp_path):
+    weights = [1, 2**63, 2**67]
+    with NpzWriter(str(tmp_path)) as writer:
+        for weight in weights:
+            writer.write(make_row(weight))
+
+    assert [int(i) for i in load_results(str(tmp_path))["WEIGHT"]] == weights
+
+    out = io.StringIO()
+    export_csv(str(tmp_path), out, header=False)
+    assert [line.split(",")[-1] for line in out.getvalue().split()] == [
+        str(i) for i in weights
+    ]
+
+
+def test_param_round_trip(tmp_path):
+    params = [0.1, 0.123456789, 1 / 3]
+    index = [name for name, _ in COLUMNS].index("DC_LINK_FAIL_P")
+    with NpzWriter(str(tmp_path)) as writer:
+        for param in params:
+            row = make_row(1)
+            row[index] = param
+            writer.write(row)
+
+    out = io.StringIO()
+    export_csv(str(tmp_path), out, header=False)
+    assert [float(line.split(",")[index]) for line in out.getvalue().split()] == params